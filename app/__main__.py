@@ -10,16 +10,10 @@ from app.modules.console import (
     openvpn_console_main,
     tools_console_main,
 )
+from app.data.config import migrate
 from app.utilities.logger import logger
 
 
-from app.domain.entities import *
-from app.data.config import Base, DBConnection
-
-with DBConnection() as db:
-    Base.metadata.create_all(db.engine)
-
-
 def connection_choices():
     console = Console('GERENCIADOR DE CONEXÕES')
     console.append_item(FuncItem('SOCKS HTTP', socks_console_main, 'http'))
@@ -32,10 +26,13 @@ def connection_choices():
 
 
 def main_cli():
+    migrate()
     user_cli_main(sys.argv[1:])
 
 
 def main_console():
+    migrate()
+
     console = Console('GERENCIADOR')
     console.append_item(FuncItem('GERENCIADOR DE USUÁRIOS', user_console_main))
     console.append_item(FuncItem('GERENCIADOR DE CONEXÕES', connection_choices))
@@ -1,2 +1,3 @@
 from .db_config import DBConnection
-from .db_base import Base
\ No newline at end of file
+from .db_base import Base
+from .db_migrations import Migrator, migrate
@@ -1,7 +1,14 @@
+import contextlib
+import json
 import os
+import re
+import threading
+import typing as t
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
 DATABASE_PATH = '/etc/GLManager/'
 DATABASE_NAME = 'db.sqlite3'
@@ -17,28 +24,152 @@ if not os.path.exists(DATABASE_PATH):
 
 DATABASE_URI = 'sqlite:///' + os.path.join(DATABASE_PATH, DATABASE_NAME)
 
+SQLITE_CONFIG = os.path.join(DATABASE_PATH, 'sqlite.json')
+SQLITE_PRAGMAS = {
+    'busy_timeout': 10000,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 64 * 1024 * 1024,
+}
+
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+
+
+def engine_options(uri: str) -> dict:
+    if not uri.startswith('sqlite'):
+        return {
+            'pool_size': POOL_SIZE,
+            'max_overflow': POOL_MAX_OVERFLOW,
+            'pool_timeout': POOL_TIMEOUT,
+            'pool_pre_ping': True,
+        }
+
+    options = {'connect_args': {'check_same_thread': False}}
+
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        options['poolclass'] = StaticPool
+    else:
+        options['poolclass'] = QueuePool
+        options['pool_size'] = POOL_SIZE
+        options['max_overflow'] = POOL_MAX_OVERFLOW
+        options['pool_timeout'] = POOL_TIMEOUT
+
+    return options
+
+
+def sqlite_pragmas(path: str = SQLITE_CONFIG) -> t.Dict[str, t.Union[int, str]]:
+    pragmas = dict(SQLITE_PRAGMAS)
+
+    if os.path.exists(path):
+        with open(path) as f:
+            pragmas.update(json.load(f))
+
+    pragmas = dict((name, value) for name, value in pragmas.items() if value is not None)
+
+    for name, value in pragmas.items():
+        if not re.match(r'^[a-z_]+$', name) or not re.match(r'^-?\w+$', str(value)):
+            raise ValueError('Invalid SQLite pragma %s = %s' % (name, value))
+
+    return pragmas
+
+
+def apply_pragmas(connection, pragmas: t.Dict[str, t.Union[int, str]]) -> None:
+    cursor = connection.cursor()
+
+    try:
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+    finally:
+        cursor.close()
+
 
 class DBConnection:
+    __engines: t.Dict[str, Engine] = {}
+    __sessions: t.Dict[str, scoped_session] = {}
+    __lock = threading.Lock()
+
     def __init__(self, uri: str = DATABASE_URI):
         self.__uri = uri
-        self.__engine = create_engine(self.__uri)
+        self.__engine, self.__registry = self.registry(uri)
         self.__session = None
+        self.__owner = False
+
+    @classmethod
+    def registry(cls, uri: str = DATABASE_URI) -> t.Tuple[Engine, scoped_session]:
+        with cls.__lock:
+            engine = cls.__engines.get(uri)
+
+            if engine is None:
+                engine = create_engine(uri, **engine_options(uri))
+
+                if uri.startswith('sqlite'):
+                    pragmas = sqlite_pragmas()
+                    event.listen(
+                        engine,
+                        'connect',
+                        lambda connection, record: apply_pragmas(connection, pragmas),
+                    )
+                cls.__engines[uri] = engine
+                cls.__sessions[uri] = scoped_session(
+                    sessionmaker(bind=engine, expire_on_commit=False)
+                )
+
+            return engine, cls.__sessions[uri]
+
+    @classmethod
+    def dispose(cls, uri: t.Optional[str] = None) -> None:
+        with cls.__lock:
+            uris = [uri] if uri is not None else list(cls.__engines)
+
+            for item in uris:
+                sessions = cls.__sessions.pop(item, None)
+                if sessions is not None:
+                    sessions.remove()
+
+                engine = cls.__engines.pop(item, None)
+                if engine is not None:
+                    engine.dispose()
+
+    @classmethod
+    def _after_fork(cls) -> None:
+        cls.__lock = threading.Lock()
+        cls.__engines = {}
+        cls.__sessions = {}
+
+    @classmethod
+    @contextlib.contextmanager
+    def unit_of_work(cls, uri: str = DATABASE_URI) -> t.Iterator[Session]:
+        with cls(uri) as db:
+            yield db.session
+            db.session.commit()
 
     @property
     def uri(self) -> str:
         return self.__uri
 
     @property
-    def engine(self) -> create_engine:
+    def engine(self) -> Engine:
         return self.__engine
 
     @property
-    def session(self) -> sessionmaker:
+    def session(self) -> Session:
         return self.__session
 
     def __enter__(self) -> 'DBConnection':
-        self.__session = sessionmaker()(bind=self.engine)
+        self.__owner = not self.__registry.registry.has()
+        self.__session = self.__registry()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        self.session.close()
+        if exc_type is not None:
+            self.session.rollback()
+
+        if self.__owner:
+            self.__registry.remove()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=DBConnection._after_fork)
@@ -0,0 +1,96 @@
+import datetime
+import importlib
+import logging
+import pkgutil
+import re
+import typing as t
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
+
+from .db_config import DATABASE_URI, DBConnection
+
+MIGRATIONS_TABLE = 'schema_migrations'
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+migrations_table = Table(
+    MIGRATIONS_TABLE,
+    metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(100), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+class Migration(t.NamedTuple):
+    version: int
+    name: str
+    upgrade: t.Callable[[Connection], None]
+
+
+class Migrator:
+    def __init__(self, package: str, uri: str = DATABASE_URI):
+        self.__package = package
+        self.__uri = uri
+
+    @property
+    def migrations(self) -> t.List[Migration]:
+        package = importlib.import_module(self.__package)
+        migrations = []
+
+        for module in pkgutil.iter_modules(package.__path__):
+            match = re.match(r'^(\d+)_(\w+)$', module.name)
+            if not match:
+                continue
+
+            script = importlib.import_module('%s.%s' % (self.__package, module.name))
+            migrations.append(Migration(int(match.group(1)), match.group(2), script.upgrade))
+
+        migrations.sort(key=lambda migration: migration.version)
+
+        versions = [migration.version for migration in migrations]
+        if len(versions) != len(set(versions)):
+            raise ValueError('Duplicate migration version in %s' % self.__package)
+
+        return migrations
+
+    def applied(self) -> t.Set[int]:
+        with DBConnection(self.__uri).engine.begin() as connection:
+            connection.execute(CreateTable(migrations_table, if_not_exists=True))
+            return set(connection.execute(select(migrations_table.c.version)).scalars())
+
+    def pending(self) -> t.List[Migration]:
+        applied = self.applied()
+        return [migration for migration in self.migrations if migration.version not in applied]
+
+    def run(self) -> t.List[Migration]:
+        engine = DBConnection(self.__uri).engine
+        applied = []
+
+        for migration in self.pending():
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        migrations_table.insert().values(
+                            version=migration.version,
+                            name=migration.name,
+                            applied_at=datetime.datetime.now(),
+                        )
+                    )
+                    migration.upgrade(connection)
+            except IntegrityError:
+                logger.debug('Migração %04d já aplicada por outro processo', migration.version)
+                continue
+
+            logger.info('Migração %04d_%s aplicada', migration.version, migration.name)
+            applied.append(migration)
+
+        return applied
+
+
+def migrate(package: str = 'app.data.migrations', uri: str = DATABASE_URI) -> t.List[Migration]:
+    return Migrator(package, uri).run()
@@ -0,0 +1,21 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func
+from sqlalchemy.engine import Connection
+
+
+def upgrade(connection: Connection) -> None:
+    metadata = MetaData()
+
+    Table(
+        'users',
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('username', String(50), nullable=False, unique=True),
+        Column('password', String(50), nullable=False),
+        Column('connection_limit', Integer, nullable=False),
+        Column('expiration_date', DateTime, nullable=False),
+        Column('v2ray_uuid', String(50), nullable=True, unique=True),
+        Column('created_at', DateTime, default=func.now()),
+        Column('updated_at', DateTime, default=func.now(), onupdate=func.now()),
+    )
+
+    metadata.create_all(connection)
@@ -0,0 +1,7 @@
+from sqlalchemy.engine import Connection
+
+
+def upgrade(connection: Connection) -> None:
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_users_expiration_date ON users (expiration_date)'
+    )
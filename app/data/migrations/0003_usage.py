@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Date, Integer, MetaData, String, Table
+from sqlalchemy.engine import Connection
+
+
+def upgrade(connection: Connection) -> None:
+    metadata = MetaData()
+
+    Table(
+        'usage',
+        metadata,
+        Column('username', String, primary_key=True),
+        Column('date', Date, primary_key=True),
+        Column('upload', Integer, nullable=False, server_default='0'),
+        Column('download', Integer, nullable=False, server_default='0'),
+    )
+
+    metadata.create_all(connection)
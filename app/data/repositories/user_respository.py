@@ -1,14 +1,34 @@
+import datetime
+import typing as t
+
+from sqlalchemy import bindparam, delete, func, select, update
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
 from app.data.config import DBConnection
+from app.domain.dtos import BulkResult, UserDtoFilter
 from app.domain.entities import User
 
+BULK_CHUNK_SIZE = 500
+
+PAGE_SIZE = 200
+LIST_COLUMNS = ('id', 'username', 'password', 'connection_limit', 'expiration_date')
+
+
+def chunks(items: list, size: int = BULK_CHUNK_SIZE) -> t.Iterator[list]:
+    for index in range(0, len(items), size):
+        yield items[index : index + size]
+
 
 class UserRepository:
     @staticmethod
     def create(user: User) -> User:
-        with DBConnection() as db:
-            db.session.add(user)
-            db.session.commit()
-            db.session.refresh(user)
+        with DBConnection.unit_of_work() as session:
+            session.add(user)
+            session.flush()
+            session.refresh(user)
 
         return user
 
@@ -38,21 +58,235 @@ class UserRepository:
         with DBConnection() as db:
             return db.session.query(User).all()
 
+    @staticmethod
+    def _filter(query: Select, user_filter: t.Optional[UserDtoFilter]) -> Select:
+        if user_filter is None:
+            return query
+
+        if user_filter.username_prefix:
+            query = query.where(
+                User.username.startswith(user_filter.username_prefix, autoescape=True)
+            )
+
+        now = datetime.datetime.now()
+
+        if user_filter.expired is not None:
+            query = query.where(
+                User.expiration_date < now if user_filter.expired else User.expiration_date >= now
+            )
+
+        if user_filter.expiring_in_days is not None:
+            query = query.where(
+                User.expiration_date >= now,
+                User.expiration_date < now + datetime.timedelta(days=user_filter.expiring_in_days),
+            )
+
+        return query
+
+    @staticmethod
+    def _id_chunks(
+        user_filter: t.Optional[UserDtoFilter], after_id: int = 0
+    ) -> t.Iterator[t.Optional[t.List[int]]]:
+        if user_filter is None or user_filter.ids is None:
+            yield None
+            return
+
+        yield from chunks(sorted(id for id in set(user_filter.ids) if id > after_id))
+
+    @staticmethod
+    def get_page(
+        user_filter: t.Optional[UserDtoFilter] = None,
+        after_id: int = 0,
+        limit: int = PAGE_SIZE,
+        columns: t.Sequence[str] = LIST_COLUMNS,
+    ) -> t.List[Row]:
+        names = ['id'] + [name for name in columns if name != 'id']
+        unknown = set(names) - set(User.__table__.columns.keys())
+        if unknown:
+            raise ValueError('Unknown user columns: %s' % ', '.join(sorted(unknown)))
+
+        query = select(*(User.__table__.columns[name] for name in names))
+        query = UserRepository._filter(query, user_filter).where(User.id > after_id)
+        rows = []
+
+        with DBConnection() as db:
+            for chunk in UserRepository._id_chunks(user_filter, after_id):
+                page = query if chunk is None else query.where(User.id.in_(chunk))
+                page = page.order_by(User.id).limit(limit - len(rows))
+                rows.extend(db.session.execute(page).all())
+
+                if len(rows) >= limit:
+                    break
+
+        return rows
+
+    @staticmethod
+    def iter_all(
+        user_filter: t.Optional[UserDtoFilter] = None,
+        columns: t.Sequence[str] = LIST_COLUMNS,
+        page_size: int = PAGE_SIZE,
+    ) -> t.Iterator[Row]:
+        after_id = 0
+
+        while True:
+            rows = UserRepository.get_page(user_filter, after_id, page_size, columns)
+            yield from rows
+
+            if len(rows) < page_size:
+                return
+
+            after_id = rows[-1].id
+
+    @staticmethod
+    def count(user_filter: t.Optional[UserDtoFilter] = None) -> int:
+        query = UserRepository._filter(select(func.count(User.id)), user_filter)
+        total = 0
+
+        with DBConnection() as db:
+            for chunk in UserRepository._id_chunks(user_filter):
+                page = query if chunk is None else query.where(User.id.in_(chunk))
+                total += db.session.execute(page).scalar()
+
+        return total
+
     @staticmethod
     def update(user: User) -> User:
         if not user.id:
             raise Exception('User id is required')
 
-        with DBConnection() as db:
-            db.session.merge(user)
-            db.session.commit()
+        with DBConnection.unit_of_work() as session:
+            session.merge(user)
 
         return user
 
     @staticmethod
     def delete(id: int) -> User:
-        with DBConnection() as db:
-            user = db.session.query(User).filter(User.id == id).first()
-            db.session.delete(user)
-            db.session.commit()
-            return user
+        with DBConnection.unit_of_work() as session:
+            user = session.query(User).filter(User.id == id).first()
+            session.delete(user)
+
+        return user
+
+    @staticmethod
+    def _get_many(session: Session, ids: t.List[int]) -> t.Dict[int, User]:
+        users = {}
+
+        for chunk in chunks(ids):
+            query = select(User).where(User.id.in_(chunk))
+            for user in session.scalars(query.execution_options(populate_existing=True)):
+                users[user.id] = user
+
+        return users
+
+    @staticmethod
+    def create_many(users: t.List[User]) -> BulkResult:
+        result = BulkResult()
+
+        if not users:
+            return result
+
+        with DBConnection.unit_of_work() as session:
+            try:
+                with session.begin_nested():
+                    session.add_all(users)
+                    session.flush()
+
+                result.succeeded.extend(users)
+            except IntegrityError:
+                for user in users:
+                    try:
+                        with session.begin_nested():
+                            session.add(user)
+                            session.flush()
+
+                        result.succeeded.append(user)
+                    except IntegrityError as e:
+                        result.failed.append((user, str(e.orig)))
+
+        return result
+
+    @staticmethod
+    def _update_rows(session: Session, rows: t.List[dict]) -> None:
+        table = User.__table__
+        groups: t.Dict[t.Tuple[str, ...], t.List[dict]] = {}
+
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        for group in groups.values():
+            session.execute(
+                update(table).where(table.c.id == bindparam('b_id')),
+                [
+                    dict(('b_id' if key == 'id' else key, value) for key, value in row.items())
+                    for row in group
+                ],
+            )
+
+    @staticmethod
+    def update_many(users: t.List[User]) -> BulkResult:
+        result = BulkResult()
+
+        if not users:
+            return result
+
+        with DBConnection.unit_of_work() as session:
+            existing = UserRepository._get_many(session, [user.id for user in users if user.id])
+            rows = []
+
+            for user in users:
+                if user.id not in existing:
+                    result.failed.append((user, 'User not found'))
+                    continue
+
+                row = dict(
+                    (column.key, getattr(user, column.key))
+                    for column in User.__table__.columns
+                    if column.key not in ('created_at', 'updated_at')
+                    and getattr(user, column.key) is not None
+                )
+                rows.append((user, row))
+
+            try:
+                with session.begin_nested():
+                    UserRepository._update_rows(session, [row for _, row in rows])
+            except IntegrityError:
+                for user, row in list(rows):
+                    try:
+                        with session.begin_nested():
+                            UserRepository._update_rows(session, [row])
+                    except IntegrityError as e:
+                        result.failed.append((user, str(e.orig)))
+                        rows.remove((user, row))
+
+            ids = [row['id'] for _, row in rows]
+            updated = UserRepository._get_many(session, ids)
+            result.succeeded.extend(updated[id] for id in ids)
+
+        return result
+
+    @staticmethod
+    def delete_many(ids: t.List[int]) -> BulkResult:
+        result = BulkResult()
+
+        if not ids:
+            return result
+
+        with DBConnection.unit_of_work() as session:
+            existing = UserRepository._get_many(session, ids)
+
+            for id in ids:
+                if id not in existing:
+                    result.failed.append((id, 'User not found'))
+
+            for chunk in chunks(list(existing)):
+                session.execute(
+                    delete(User).where(User.id.in_(chunk)),
+                    execution_options={'synchronize_session': False},
+                )
+
+            for user in existing.values():
+                session.expunge(user)
+
+            result.succeeded.extend(existing.values())
+
+        return result
@@ -2,4 +2,6 @@ from .user import (
     UserDtoCreate,
     UserDtoUpdate,
     UserDto,
+    UserDtoFilter,
 )
+from .bulk import BulkResult
@@ -0,0 +1,17 @@
+import typing as t
+
+from app.serializers import Serializer
+
+
+class BulkResult(Serializer):
+    succeeded: list = None
+    failed: t.List[t.Tuple[t.Any, str]] = None
+
+    def __init__(self, **kwargs):
+        self.succeeded = []
+        self.failed = []
+        super().__init__(**kwargs)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
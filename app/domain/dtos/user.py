@@ -25,3 +25,10 @@ class UserDto(Serializer):
     v2ray_uuid: str = None
     connection_limit: int = None
     expiration_date: str = None
+
+
+class UserDtoFilter(Serializer):
+    ids: list = None
+    username_prefix: str = None
+    expired: bool = None
+    expiring_in_days: int = None
@@ -9,7 +9,7 @@ class User(BaseEntity):
     username = Column(String(50), nullable=False, unique=True)
     password = Column(String(50), nullable=False)
     connection_limit = Column(Integer, nullable=False)
-    expiration_date = Column(DateTime, nullable=False)
+    expiration_date = Column(DateTime, nullable=False, index=True)
 
     v2ray_uuid = Column(String(50), nullable=True, unique=True)
 
@@ -1,30 +1,68 @@
 import typing as t
 import datetime
+import re
+import shlex
 
 from app.data.repositories import UserRepository
-from app.domain.dtos import UserDto
+from app.data.repositories.user_respository import LIST_COLUMNS, PAGE_SIZE
+from app.domain.dtos import BulkResult, UserDto, UserDtoFilter
 from app.domain.entities import User
-from app.utilities.shellscript import exec_command
+from app.utilities.shellscript import exec_command, exec_with_input
+
+
+def parse_expiration_date(expiration_date: t.Union[str, datetime.datetime]) -> datetime.datetime:
+    if not isinstance(expiration_date, str):
+        return expiration_date
+
+    for date_format in ('%b %d, %Y', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(expiration_date, date_format)
+        except ValueError:
+            pass
+
+    return datetime.datetime.strptime(expiration_date, '%d/%m/%Y')
 
 
 class UserUseCase:
     def __init__(self, user_repository: UserRepository):
         self.user_repository = user_repository
 
-    def create(self, user_dto: UserDto) -> t.Optional[UserDto]:
-        expiration_date = user_dto.expiration_date
+    @staticmethod
+    def _to_entity(user_dto: UserDto) -> User:
+        user_entity = User.of(user_dto.to_dict())
+        user_entity.expiration_date = parse_expiration_date(user_dto.expiration_date)
+        return user_entity
+
+    @staticmethod
+    def _exec_for_each(command: t.Callable[[User], str], users: t.List[User]) -> t.Set[str]:
+        script = ''.join(
+            '%s >/dev/null 2>&1 || echo %s\n' % (command(user), shlex.quote(user.username))
+            for user in users
+        )
+        output = exec_with_input(['bash', '-s'], script).stdout
+        return set(output.split())
 
-        if isinstance(expiration_date, str):
-            try:
-                expiration_date = datetime.datetime.strptime(expiration_date, '%b %d, %Y')
-            except ValueError:
-                try:
-                    expiration_date = datetime.datetime.strptime(expiration_date, '%Y-%m-%d')
-                except ValueError:
-                    expiration_date = datetime.datetime.strptime(expiration_date, '%d/%m/%Y')
+    @staticmethod
+    def _set_passwords(users: t.List[User]) -> t.Dict[str, str]:
+        if not users:
+            return {}
 
-        user_entity = User.of(user_dto.to_dict())
-        user_entity.expiration_date = expiration_date
+        data = ''.join('%s:%s\n' % (user.username, user.password) for user in users)
+        process = exec_with_input(['chpasswd'], data)
+        failed = {}
+
+        for line in process.stderr.splitlines():
+            match = re.search(r'line (\d+)', line)
+            if match and 0 < int(match.group(1)) <= len(users):
+                failed[users[int(match.group(1)) - 1].username] = line.strip()
+
+        if process.returncode != 0 and not failed:
+            failed = dict((user.username, process.stderr.strip()) for user in users)
+
+        return failed
+
+    def create(self, user_dto: UserDto) -> t.Optional[UserDto]:
+        user_entity = self._to_entity(user_dto)
 
         data = self.user_repository.create(user_entity)
         data = data.to_dict()
@@ -61,20 +99,30 @@ class UserUseCase:
         data = self.user_repository.get_all()
         return [UserDto.of(item.to_dict()) for item in data]
 
-    def update(self, user_dto: UserDto) -> t.Optional[UserDto]:
-        expiration_date = user_dto.expiration_date
-
-        if isinstance(expiration_date, str):
-            try:
-                expiration_date = datetime.datetime.strptime(expiration_date, '%b %d, %Y')
-            except ValueError:
-                try:
-                    expiration_date = datetime.datetime.strptime(expiration_date, '%Y-%m-%d')
-                except ValueError:
-                    expiration_date = datetime.datetime.strptime(expiration_date, '%d/%m/%Y')
+    def get_page(
+        self,
+        user_filter: t.Optional[UserDtoFilter] = None,
+        after_id: int = 0,
+        limit: int = PAGE_SIZE,
+        columns: t.Sequence[str] = LIST_COLUMNS,
+    ) -> t.Tuple[t.List[UserDto], t.Optional[int]]:
+        rows = self.user_repository.get_page(user_filter, after_id, limit, columns)
+        next_id = rows[-1].id if len(rows) == limit else None
+        return [UserDto(**row._asdict()) for row in rows], next_id
+
+    def iter_all(
+        self,
+        user_filter: t.Optional[UserDtoFilter] = None,
+        columns: t.Sequence[str] = LIST_COLUMNS,
+    ) -> t.Iterator[UserDto]:
+        for row in self.user_repository.iter_all(user_filter, columns):
+            yield UserDto(**row._asdict())
+
+    def count(self, user_filter: t.Optional[UserDtoFilter] = None) -> int:
+        return self.user_repository.count(user_filter)
 
-        user_entity = User.of(user_dto.to_dict())
-        user_entity.expiration_date = expiration_date
+    def update(self, user_dto: UserDto) -> t.Optional[UserDto]:
+        user_entity = self._to_entity(user_dto)
         data = self.user_repository.update(user_entity)
         return UserDto.of(data.to_dict())
 
@@ -86,3 +134,92 @@ class UserUseCase:
             exec_command(cmd_delete_user)
 
         return UserDto.of(data.to_dict())
+
+    def create_many(self, user_dtos: t.List[UserDto]) -> BulkResult:
+        result = BulkResult()
+        users = []
+
+        for user_dto in user_dtos:
+            try:
+                users.append(self._to_entity(user_dto))
+            except ValueError as e:
+                result.failed.append((user_dto, str(e)))
+
+        created = self.user_repository.create_many(users)
+        result.failed.extend(
+            (UserDto.of(user.to_dict()), reason) for user, reason in created.failed
+        )
+
+        if not created.succeeded:
+            return result
+
+        not_added = self._exec_for_each(
+            lambda user: 'useradd --no-create-home --shell /bin/false --expiredate %s %s'
+            % (user.expiration_date.strftime('%Y-%m-%d'), shlex.quote(user.username)),
+            created.succeeded,
+        )
+        failed = dict((username, 'useradd failed') for username in not_added)
+
+        no_password = self._set_passwords(
+            [user for user in created.succeeded if user.username not in failed]
+        )
+        if no_password:
+            self._exec_for_each(
+                lambda user: 'userdel --force %s' % shlex.quote(user.username),
+                [user for user in created.succeeded if user.username in no_password],
+            )
+            failed.update(no_password)
+
+        if failed:
+            self.user_repository.delete_many(
+                [user.id for user in created.succeeded if user.username in failed]
+            )
+
+        for user in created.succeeded:
+            user_dto = UserDto.of(user.to_dict())
+
+            if user.username in failed:
+                result.failed.append((user_dto, failed[user.username]))
+            else:
+                result.succeeded.append(user_dto)
+
+        return result
+
+    def update_many(self, user_dtos: t.List[UserDto]) -> BulkResult:
+        result = BulkResult()
+        users = []
+
+        for user_dto in user_dtos:
+            try:
+                users.append(self._to_entity(user_dto))
+            except ValueError as e:
+                result.failed.append((user_dto, str(e)))
+
+        updated = self.user_repository.update_many(users)
+        result.failed.extend(
+            (UserDto.of(user.to_dict()), reason) for user, reason in updated.failed
+        )
+        result.succeeded.extend(UserDto.of(user.to_dict()) for user in updated.succeeded)
+        return result
+
+    def delete_many(self, ids: t.List[int]) -> BulkResult:
+        deleted = self.user_repository.delete_many(ids)
+        result = BulkResult(failed=list(deleted.failed))
+
+        if not deleted.succeeded:
+            return result
+
+        failed = self._exec_for_each(
+            lambda user: 'userdel --force %s' % shlex.quote(user.username),
+            deleted.succeeded,
+        )
+
+        for user in deleted.succeeded:
+            user_dto = UserDto.of(user.to_dict())
+
+            if user.username in failed:
+                result.failed.append((user_dto, 'userdel failed'))
+            else:
+                result.succeeded.append(user_dto)
+
+        return result
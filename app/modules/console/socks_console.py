@@ -1,10 +1,13 @@
 import typing as t
+import glob
 import os
+import time
 
 from console import Console, FuncItem, COLOR_NAME
 from console.formatter import create_menu_bg, create_line, Formatter
 
 from scripts import SOCKS_PATH, CERT_PATH
+from scripts.socks import CONTROL_SOCKET, ControlClient
 
 from app.utilities.logger import logger
 
@@ -83,17 +86,12 @@ class Flag:
 
     @staticmethod
     def current_flag(flag_name: str) -> str:
-        flag_name_parsed = flag_name
-        if '-' in flag_name:
-            flag_name_parsed = '\-'.join(flag_name.split('-'))
+        backend = flag_name.replace('--', '').replace('-port', '')
 
-        command = 'ps -aux | grep -i ' + flag_name_parsed + ' | grep -v grep'
-        output = os.popen(command).read().strip()
-
-        for line in output.split('\n'):
-            data = line.split(flag_name)
-            if len(data) > 1:
-                return data[1].split()[0]
+        for status in SocksManager.statuses():
+            address = status['backends'].get(backend)
+            if address:
+                return str(address[1])
 
         return ''
 
@@ -152,12 +150,68 @@ class FlagUtils:
 
 
 class SocksManager:
+    START_TIMEOUT = 10
+
+    @staticmethod
+    def call(path: str, command: str, **params) -> t.Optional[dict]:
+        try:
+            with ControlClient(path, 5) as client:
+                response, _ = client.call(command, **params)
+        except (OSError, ValueError):
+            return None
+
+        return response
+
+    @staticmethod
+    def statuses() -> t.List[dict]:
+        statuses = []
+
+        for path in sorted(glob.glob(CONTROL_SOCKET % '*')):
+            try:
+                with ControlClient(path, 5) as client:
+                    status, _ = client.call('status')
+            except (OSError, ValueError):
+                continue
+
+            if status.get('accepting', True):
+                status['control'] = path
+                statuses.append(status)
+
+        return statuses
+
+    @staticmethod
+    def status(port: int) -> t.Optional[dict]:
+        for status in SocksManager.statuses():
+            if any(listener['port'] == port for listener in status['listeners']):
+                return status
+
+        return None
+
     @staticmethod
     def is_running(mode: str = 'http') -> bool:
-        cmd = 'screen -ls | grep -i "socks:[0-9]*:%s\\b"' % mode
-        return os.system(cmd) == 0
+        return mode in SocksManager.get_running_socks().values()
 
-    def start(self, mode: str = 'http', src_port: int = 80, flag_utils: FlagUtils = None):
+    @staticmethod
+    def wait_started(port: int, started_after: float, timeout: float = START_TIMEOUT) -> bool:
+        deadline = time.monotonic() + timeout
+
+        while True:
+            status = SocksManager.status(port)
+            if status is not None and status.get('started_at', 0) >= started_after:
+                return True
+
+            if time.monotonic() >= deadline:
+                return False
+
+            time.sleep(0.1)
+
+    def start(
+        self,
+        mode: str = 'http',
+        src_port: int = 80,
+        flag_utils: FlagUtils = None,
+        takeover: bool = False,
+    ):
         cmd = 'screen -mdS socks:%s:%s python3 %s --port %s %s --%s' % (
             src_port,
             mode,
@@ -170,38 +224,59 @@ class SocksManager:
         if mode == 'https':
             cmd += ' --cert %s' % CERT_PATH
 
-        return os.system(cmd) == 0 and self.is_running(mode)
+        if takeover:
+            cmd += ' --takeover'
+
+        started_after = time.time()
+        return os.system(cmd) == 0 and self.wait_started(src_port, started_after)
+
+    def restart(self, mode: str = 'http', src_port: int = 80, flag_utils: FlagUtils = None):
+        session = 'socks:%s:%s' % (src_port, mode)
+        draining = 'socks-draining:%s:%s:%d' % (src_port, mode, time.time())
+
+        os.system('screen -S %s -X sessionname %s' % (session, draining))
+
+        if self.start(mode=mode, src_port=src_port, flag_utils=flag_utils, takeover=True):
+            return True
+
+        self.stop(mode=mode, src_port=src_port)
+        os.system('screen -S %s -X sessionname %s' % (draining, session))
+        return False
 
     def stop(self, mode: str = 'http', src_port: int = 80) -> None:
         cmd = 'screen -X -S socks:%s:%s quit' % (src_port, mode)
         return os.system(cmd) == 0
 
     @staticmethod
-    def get_running_port(mode: str = 'http') -> int:
-        cmd = 'screen -ls | grep -ie "socks:[0-9]*:%s\\b"' % mode
-        output = os.popen(cmd).read().strip()
+    def set_backend(port: int, backend: str, backend_port: int) -> bool:
+        status = SocksManager.status(port)
+        if status is None:
+            return False
 
-        for line in output.split('\n'):
-            data = line.split(':')
-            if len(data) > 1:
-                return int(data[1].split(' ')[0])
+        response = SocksManager.call(
+            status['control'], 'set-backend', backend=backend, port=backend_port
+        )
+        return response is not None and 'error' not in response
+
+    @staticmethod
+    def get_running_port(mode: str = 'http') -> int:
+        for port, running_mode in SocksManager.get_running_socks().items():
+            if running_mode == mode:
+                return port
 
         return 0
 
     @staticmethod
     def get_running_ports() -> t.List[int]:
-        cmd = 'screen -ls | grep socks: | awk \'{print $1}\' | awk -F: \'{print $2}\''
-        output = os.popen(cmd).read()
-        return [int(port) for port in output.split('\n') if port]
+        return list(SocksManager.get_running_socks())
 
     @staticmethod
     def get_running_socks() -> t.Dict[int, str]:
-        cmd = 'screen -ls | grep socks: | awk \'{print $1}\''
-        output = os.popen(cmd).readlines()
-        socks = dict(
-            (int(port), mode.strip()) for port, mode in (line.split(':')[1:] for line in output)
+        return dict(
+            (listener['port'], listener['mode'])
+            for status in SocksManager.statuses()
+            for listener in status['listeners']
         )
-        return socks
 
 
 class ConsoleMode:
@@ -231,14 +306,13 @@ class FormatterSocks(Formatter):
         if self.port <= 0:
             return menu
 
-        flag_utils = FlagUtils()
-        values = []
+        status = SocksManager.status(self.port)
+        if status is None:
+            return menu
 
-        for flag in flag_utils.values():
-            name, port = flag.split()
-            name = name.replace('--', '')
-            name = name.split('-')[0]
-            values.append(name + ' ' + str(port))
+        values = [
+            name + ' ' + str(address[1]) for name, address in sorted(status['backends'].items())
+        ]
 
         for value in values:
             menu += '%s <-> %s <-> %s\n' % (
@@ -247,6 +321,11 @@ class FormatterSocks(Formatter):
                 COLOR_NAME.GREEN + str(value).rjust(15) + COLOR_NAME.END,
             )
 
+        menu += '%s %s\n' % (
+            COLOR_NAME.YELLOW + 'Túneis ativos:' + COLOR_NAME.END,
+            COLOR_NAME.GREEN + str(status['tunnels']) + COLOR_NAME.END,
+        )
+
         return menu + create_line(color=COLOR_NAME.BLUE, show=False) + '\n'
 
 
@@ -266,7 +345,7 @@ class SocksActions:
                 src_port = input(COLOR_NAME.YELLOW + 'Porta de escuta: ' + COLOR_NAME.RESET)
                 src_port = int(src_port)
 
-                if SocksManager().is_running(src_port):
+                if src_port in ports:
                     logger.error('Porta %s já está em uso' % src_port)
                     continue
 
@@ -329,11 +408,16 @@ class SocksActions:
                 return
 
         running_port = socks_manager.get_running_port(mode)
-
-        socks_manager.stop(mode, running_port)
         flag_utils.set_flag(flag)
 
-        if not socks_manager.start(mode=mode, src_port=running_port, flag_utils=flag_utils):
+        backend = flag.name.replace('-port', '')
+
+        if socks_manager.set_backend(running_port, backend, flag.port):
+            logger.info('Porta alterada com sucesso!')
+            Console.pause()
+            return
+
+        if not socks_manager.restart(mode=mode, src_port=running_port, flag_utils=flag_utils):
             logger.error('Falha ao iniciar proxy!')
             Console.pause()
             return
@@ -1,5 +1,6 @@
 import os
 import subprocess
+import typing as t
 
 
 def clear_screen() -> None:
@@ -11,3 +12,13 @@ def exec_command(command: str) -> str:
     bash += ' "' + command + '"'
     data = os.popen(bash).read()
     return data.strip()
+
+
+def exec_with_input(command: t.List[str], data: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        command,
+        input=data,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
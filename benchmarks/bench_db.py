@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.data.config import Base, DBConnection
+from app.domain.entities import User
+
+
+class LegacyDBConnection:
+    def __init__(self, uri: str):
+        self.engine = create_engine(uri)
+        self.session = None
+
+    def __enter__(self) -> 'LegacyDBConnection':
+        self.session = sessionmaker()(bind=self.engine)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.session.close()
+
+
+def populate(uri: str, users: int) -> None:
+    with DBConnection.unit_of_work(uri) as session:
+        Base.metadata.create_all(session.get_bind())
+
+        expiration_date = datetime.datetime.now() + datetime.timedelta(days=30)
+        session.add_all(
+            User(
+                username='user%s' % index,
+                password='password',
+                connection_limit=1,
+                expiration_date=expiration_date,
+            )
+            for index in range(users)
+        )
+
+
+def measure(connection, uri: str, users: int, queries: int) -> list:
+    latencies = []
+
+    for index in range(queries):
+        started_at = time.perf_counter()
+
+        with connection(uri) as db:
+            username = 'user%s' % (index % users)
+            db.session.query(User).filter(User.username == username).first()
+
+        latencies.append(time.perf_counter() - started_at)
+
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DBConnection per-query latency')
+    parser.add_argument('--users', type=int, default=1000, help='Users in the database')
+    parser.add_argument('--queries', type=int, default=2000, help='Lookups per connection type')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        uri = 'sqlite:///' + os.path.join(directory, 'bench.sqlite3')
+        populate(uri, args.users)
+
+        print('%-10s %12s %12s %12s' % ('conexão', 'média (ms)', 'p50 (ms)', 'p99 (ms)'))
+
+        for name, connection in (('legacy', LegacyDBConnection), ('registry', DBConnection)):
+            latencies = measure(connection, uri, args.users, args.queries)
+
+            print(
+                '%-10s %12.3f %12.3f %12.3f'
+                % (
+                    name,
+                    sum(latencies) / len(latencies) * 1000,
+                    latencies[len(latencies) // 2] * 1000,
+                    latencies[int(len(latencies) * 0.99)] * 1000,
+                )
+            )
+
+        DBConnection.dispose(uri)
+
+
+if __name__ == '__main__':
+    main()
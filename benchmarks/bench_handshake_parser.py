@@ -0,0 +1,100 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts.socks import (
+    HandshakeParser,
+    HandshakeState,
+    HttpParser,
+    ParserType,
+    ProtocolTable,
+    RemoteTypes,
+)
+
+PROTOCOLS = ProtocolTable.of()
+
+PAYLOADS = {
+    'ssh': [b'SSH-2.0-OpenSSH_8.9p1\r\n'],
+    'http': [
+        b'GET / HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\n'
+        b'Connection: Upgrade\r\nUser-Agent: Mozilla/5.0\r\n\r\n'
+    ],
+    'http+ssh': [
+        b'GET / HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\n\r\n'
+        b'SSH-2.0-OpenSSH_8.9p1\r\n'
+    ],
+    'split': [b'GET / HTTP/1.1\r\nHo', b'st: example.com\r\n\r\n', b'SS', b'H-2.0-OpenSSH\r\n'],
+}
+
+
+def legacy_parse_type(data: bytes) -> RemoteTypes:
+    if data.startswith(b'\x0068'):
+        return RemoteTypes.OPENVPN
+
+    remote = None
+    if data.startswith(b'\x00'):
+        remote = RemoteTypes.V2RAY
+
+    if data.startswith(b'SSH-'):
+        remote = RemoteTypes.SSH
+
+    return remote
+
+
+def legacy(chunks: list) -> None:
+    http_parser = HttpParser()
+
+    for chunk in chunks:
+        if legacy_parse_type(chunk) is not None:
+            return
+
+        http_parser.parse(chunk)
+
+
+def incremental(chunks: list) -> None:
+    parser = HandshakeParser(ParserType(PROTOCOLS))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+
+        state, _ = parser.next()
+        while state is HandshakeState.HTTP:
+            state, _ = parser.next()
+
+        if state is HandshakeState.ROUTE:
+            return
+
+
+def measure(func, chunks: list, iterations: int) -> float:
+    started_at = time.perf_counter()
+
+    for _ in range(iterations):
+        func(chunks)
+
+    return iterations / (time.perf_counter() - started_at)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handshake parser benchmark')
+    parser.add_argument('--iterations', type=int, default=100000, help='Iterations')
+    args = parser.parse_args()
+
+    print('%-10s %15s %15s %8s' % ('payload', 'legacy ops/s', 'stream ops/s', 'ratio'))
+
+    for name, chunks in PAYLOADS.items():
+        new = measure(incremental, chunks, args.iterations)
+
+        try:
+            old = measure(legacy, chunks, args.iterations)
+        except ValueError:
+            print('%-10s %15s %15.0f %8s' % (name, 'error', new, '-'))
+            continue
+
+        print('%-10s %15.0f %15.0f %7.2fx' % (name, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import select
+import selectors
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scripts import CERT_PATH, SOCKS_PATH
+from scripts.socks import DEFAULT_RESPONSE
+
+PAYLOAD = b'GET / HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\n\r\n'
+BANNER = b'SSH-2.0-bench\r\n'
+CHUNK = b'x' * 65536
+
+
+def free_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def raise_nofile_limit() -> None:
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def echo_server(port: int) -> None:
+    raise_nofile_limit()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(1024)
+    listener.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    buffers = {}
+
+    while True:
+        for key, mask in selector.select():
+            sock = key.fileobj
+
+            if sock is listener:
+                try:
+                    conn, _ = listener.accept()
+                except BlockingIOError:
+                    continue
+
+                conn.setblocking(False)
+                buffers[conn] = bytearray()
+                selector.register(conn, selectors.EVENT_READ)
+                continue
+
+            buffer = buffers[sock]
+
+            try:
+                if mask & selectors.EVENT_READ:
+                    data = sock.recv(65536)
+                    if not data:
+                        raise ConnectionError()
+                    buffer += data
+
+                if buffer:
+                    del buffer[: sock.send(buffer)]
+            except BlockingIOError:
+                pass
+            except OSError:
+                selector.unregister(sock)
+                sock.close()
+                del buffers[sock]
+                continue
+
+            events = selectors.EVENT_WRITE if buffer else selectors.EVENT_READ
+            if key.events != events:
+                selector.modify(sock, events)
+
+
+def wait_ready(connect, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            connect().close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def recv_exactly(conn: socket.socket, size: int) -> bytes:
+    data = b''
+
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed after %s bytes' % len(data))
+        data += chunk
+
+    return data
+
+
+def rss(pid: int) -> int:
+    pids = [pid]
+
+    try:
+        with open('/proc/%s/task/%s/children' % (pid, pid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+
+    total = 0
+    for pid in pids:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+
+    return total
+
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Bench:
+    def __init__(self, port: int, https: bool) -> None:
+        self.port = port
+        self.context = None
+
+        if https:
+            self.context = ssl.create_default_context()
+            self.context.check_hostname = False
+            self.context.verify_mode = ssl.CERT_NONE
+
+    def open(self) -> socket.socket:
+        conn = socket.create_connection(('127.0.0.1', self.port), 10)
+
+        if self.context is not None:
+            conn = self.context.wrap_socket(conn)
+
+        conn.sendall(PAYLOAD + BANNER)
+        recv_exactly(conn, len(DEFAULT_RESPONSE) + len(BANNER))
+        return conn
+
+    def _run(self, clients: int, target, *args) -> list:
+        results = [None] * clients
+
+        def run(index: int) -> None:
+            try:
+                results[index] = target(*args)
+            except OSError as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print('  %s clientes falharam: %s' % (len(errors), errors[0]))
+
+        return [result for result in results if not isinstance(result, Exception)]
+
+    def _handshakes(self, count: int) -> list:
+        latencies = []
+
+        for _ in range(count):
+            started_at = time.perf_counter()
+            self.open().close()
+            latencies.append(time.perf_counter() - started_at)
+
+        return latencies
+
+    def _bulk(self, size: int) -> int:
+        conn = self.open()
+        conn.setblocking(False)
+
+        sent = received = 0
+        retry = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+        while received < size:
+            wlist = [conn] if sent < size else []
+            r, w, _ = select.select([conn], wlist, [], 10)
+
+            if not r and not w:
+                raise socket.timeout('Bulk transfer stalled')
+
+            if w:
+                try:
+                    sent += conn.send(CHUNK[: size - sent])
+                except retry:
+                    pass
+
+            try:
+                while True:
+                    data = conn.recv(1024 * 1024)
+                    if not data:
+                        raise ConnectionError('Connection closed after %s bytes' % received)
+                    received += len(data)
+            except retry:
+                pass
+
+        conn.close()
+        return received
+
+    def handshakes(self, clients: int, tunnels: int) -> None:
+        started_at = time.perf_counter()
+        results = self._run(clients, self._handshakes, tunnels)
+        elapsed = time.perf_counter() - started_at
+
+        latencies = [latency for result in results for latency in result]
+        if not latencies:
+            return
+
+        print('  conexões/s         %10.0f' % (len(latencies) / elapsed))
+        print('  handshake p50      %10.2f ms' % (percentile(latencies, 0.5) * 1000))
+        print('  handshake p99      %10.2f ms' % (percentile(latencies, 0.99) * 1000))
+
+    def bulk(self, clients: int, size: int) -> None:
+        started_at = time.perf_counter()
+        results = self._run(clients, self._bulk, size)
+        elapsed = time.perf_counter() - started_at
+
+        print('  vazão              %10.2f Gbit/s' % (sum(results) * 8 / elapsed / 1e9))
+
+    def idle(self, pid: int, count: int) -> None:
+        before = rss(pid)
+        conns = self._run(count, self.open)
+
+        time.sleep(0.5)
+        after = rss(pid)
+
+        for conn in conns:
+            conn.close()
+
+        if conns:
+            per_thousand = (after - before) / len(conns) * 1000
+            print('  RSS por 1k túneis  %10.2f MiB' % (per_thousand / 1024 / 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scripts/socks.py load test')
+    parser.add_argument('--mode', nargs='+', default=['http', 'https'], choices=['http', 'https'])
+    parser.add_argument(
+        '--engine',
+        nargs='+',
+        default=['thread', 'epoll'],
+        choices=['thread', 'epoll'],
+    )
+    parser.add_argument('--workers', type=int, default=1, help='Proxy worker processes')
+    parser.add_argument('--clients', type=int, default=50, help='Concurrent clients')
+    parser.add_argument('--tunnels', type=int, default=20, help='Handshakes per client')
+    parser.add_argument('--bulk', type=int, default=64, help='MiB echoed per bulk client')
+    parser.add_argument('--bulk-clients', type=int, default=8, help='Concurrent bulk clients')
+    parser.add_argument('--idle', type=int, default=1000, help='Idle tunnels for the RSS sample')
+    parser.add_argument('--proxy-arg', action='append', default=[], help='Extra socks.py option')
+    args = parser.parse_args()
+
+    raise_nofile_limit()
+
+    echo_port = free_port()
+    echo = multiprocessing.Process(target=echo_server, args=(echo_port,))
+    echo.daemon = True
+    echo.start()
+    wait_ready(lambda: socket.create_connection(('127.0.0.1', echo_port), 1))
+
+    for mode in args.mode:
+        for engine in args.engine:
+            port = free_port()
+            command = [
+                sys.executable,
+                SOCKS_PATH,
+                '--host', '127.0.0.1',
+                '--port', str(port),
+                '--backlog', '1024',
+                '--ssh-port', str(echo_port),
+                '--openvpn-port', str(echo_port),
+                '--v2ray-port', str(echo_port),
+                '--engine', engine,
+                '--workers', str(args.workers),
+                '--cert', CERT_PATH,
+                '--log', 'ERROR',
+                '--%s' % mode,
+            ] + args.proxy_arg
+
+            proxy = subprocess.Popen(command)
+
+            try:
+                bench = Bench(port, mode == 'https')
+                wait_ready(bench.open)
+
+                print('%s / %s' % (mode, engine))
+                bench.handshakes(args.clients, args.tunnels)
+                bench.bulk(args.bulk_clients, args.bulk * 1024 * 1024)
+                bench.idle(proxy.pid, args.idle)
+            finally:
+                proxy.terminate()
+                proxy.wait()
+
+    echo.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,7 @@ def send_message_deleted(message: types.Message, username: str):
 def callback_query_delete_user(query: types.CallbackQuery):
     user_use_case = UserUseCase(UserRepository())
 
-    if not user_use_case.get_all():
+    if not user_use_case.count():
         send_message_users_not_found(query.message, query.message.message_id)
         return
 
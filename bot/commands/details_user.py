@@ -10,7 +10,7 @@ from ..utilities.utils import callback_query_back, callback_query_back_menu
 from ..middleware import AdminPermission, DealerPermission, permission_required
 from .message_helper import send_message_user_not_found, send_message_users_not_found
 
-from .helpers.dealer import find_account_by_id, get_all_users_of_dealer, is_dealer
+from .helpers.dealer import find_account_by_id, iter_users_of
 
 
 def create_message_details(user_dto: UserDto) -> str:
@@ -35,11 +35,7 @@ def callback_query_get_user(query: types.CallbackQuery):
     user_id = query.from_user.id
 
     user_use_case = UserUseCase(UserRepository())
-    users = (
-        user_use_case.get_all()
-        if not is_dealer(user_id)
-        else get_all_users_of_dealer(user_id, user_use_case)
-    )
+    users = list(iter_users_of(user_id, user_use_case, ('username',)))
 
     if not users:
         send_message_users_not_found(query.message, query.message.message_id)
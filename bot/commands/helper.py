@@ -9,7 +9,7 @@ from ..middleware import AdminPermission, DealerPermission, permission_required
 from .helpers.dealer import (
     find_dealer_by_id,
     is_dealer,
-    get_all_users_of_dealer,
+    get_user_filter,
     get_available_limit_creation_accounts,
 )
 
@@ -56,7 +56,7 @@ def create_message_menu(user_id: int = None) -> str:
             find_dealer_by_id(user_id).expires_at
         )
         text += '<b>TOTAL CONTAS CRIADAS:</b> <code>{}</code>\n'.format(
-            len(get_all_users_of_dealer(user_id, UserUseCase(UserRepository())))
+            UserUseCase(UserRepository()).count(get_user_filter(user_id))
         )
         text += '\n'
     else:
@@ -1,5 +1,6 @@
 import typing as t
 
+from app.domain.dtos import UserDto, UserDtoFilter
 from app.domain.use_cases import UserUseCase
 
 from bot.dealer import DealerRepository, AccountRepository
@@ -67,7 +68,18 @@ def find_dealer_by_id(user_id: int) -> t.Optional[DealerDTO]:
     return dealer_use_case.get_by_id(user_id)
 
 
-def get_all_users_of_dealer(user_id: int, user_use_case: UserUseCase) -> t.List[AccountDTO]:
+def get_user_filter(user_id: int) -> t.Optional[UserDtoFilter]:
+    if not is_dealer(user_id):
+        return None
+
     account_use_case = AccountUseCase(AccountRepository())
     accounts = account_use_case.get_all_by_dealer_id(user_id)
-    return [user_use_case.get_by_id(account.id) for account in accounts]
+    return UserDtoFilter(ids=[account.id for account in accounts])
+
+
+def iter_users_of(
+    user_id: int,
+    user_use_case: UserUseCase,
+    columns: t.Sequence[str] = ('username', 'password', 'connection_limit', 'expiration_date'),
+) -> t.Iterator[UserDto]:
+    return user_use_case.iter_all(get_user_filter(user_id), columns)
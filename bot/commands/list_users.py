@@ -1,6 +1,9 @@
+import typing as t
+
 from telebot import types
 
 from app.data.repositories import UserRepository
+from app.domain.dtos import UserDto
 from app.domain.use_cases import UserUseCase
 
 from .. import bot
@@ -8,27 +11,16 @@ from ..utilities.utils import callback_query_back_menu
 from ..middleware import AdminPermission, DealerPermission, permission_required
 from .message_helper import send_message_users_not_found
 
-from .helpers.dealer import get_all_users_of_dealer, is_dealer
+from .helpers.dealer import iter_users_of
 
 
-@bot.callback_query_handler(func=lambda query: query.data == 'list_users')
-@permission_required([AdminPermission(), DealerPermission()])
-def callback_query_list_users(query: types.CallbackQuery):
-    user_id = query.from_user.id
+def create_message_users(users: t.Iterable[UserDto]) -> t.Optional[str]:
+    message_reply = None
 
-    user_use_case = UserUseCase(UserRepository())
-    users = (
-        user_use_case.get_all()
-        if not is_dealer(user_id)
-        else get_all_users_of_dealer(user_id, user_use_case)
-    )
-
-    if not users:
-        send_message_users_not_found(query.message, query.message.message_id)
-        return
-
-    message_reply = '<b>📝Lista de usuarios📝</b>\n\n'
     for user in users:
+        if message_reply is None:
+            message_reply = '<b>📝Lista de usuarios📝</b>\n\n'
+
         message_reply += '<b>👤Nome:</b> <code>{}</code>\n'.format(user.username)
         message_reply += '<b>🔐Senha:</b> <code>{}</code>\n'.format(user.password)
         message_reply += '<b>🚫Limite de conexões:</b> <code>{}</code>\n'.format(
@@ -39,6 +31,21 @@ def callback_query_list_users(query: types.CallbackQuery):
         )
         message_reply += '\n'
 
+    return message_reply
+
+
+@bot.callback_query_handler(func=lambda query: query.data == 'list_users')
+@permission_required([AdminPermission(), DealerPermission()])
+def callback_query_list_users(query: types.CallbackQuery):
+    user_id = query.from_user.id
+
+    user_use_case = UserUseCase(UserRepository())
+    message_reply = create_message_users(iter_users_of(user_id, user_use_case))
+
+    if message_reply is None:
+        send_message_users_not_found(query.message, query.message.message_id)
+        return
+
     try:
         bot.edit_message_text(
             message_reply,
@@ -70,28 +77,12 @@ def list_users(message: types.Message):
     user_id = message.from_user.id
 
     user_use_case = UserUseCase(UserRepository())
-    users = (
-        user_use_case.get_all()
-        if not is_dealer(user_id)
-        else get_all_users_of_dealer(user_id, user_use_case)
-    )
+    message_reply = create_message_users(iter_users_of(user_id, user_use_case))
 
-    if not users:
+    if message_reply is None:
         send_message_users_not_found(message, reply_message_id=message.message_id)
         return
 
-    message_reply = '<b>📝Lista de usuarios📝</b>\n\n'
-    for user in users:
-        message_reply += '<b>👤Nome:</b> <code>{}</code>\n'.format(user.username)
-        message_reply += '<b>🔐Senha:</b> <code>{}</code>\n'.format(user.password)
-        message_reply += '<b>🚫Limite de conexões:</b> <code>{}</code>\n'.format(
-            user.connection_limit
-        )
-        message_reply += '<b>📆Data de expiração:</b> <code>{}</code>\n'.format(
-            user.expiration_date.strftime('%d/%m/%Y')
-        )
-        message_reply += '\n'
-
     try:
         bot.reply_to(
             message,
@@ -8,18 +8,16 @@ from .. import bot
 from ..utilities.utils import callback_query_back_menu
 from ..middleware import AdminPermission, DealerPermission, permission_required
 
-from .helpers.dealer import get_all_users_of_dealer, is_dealer
+from .helpers.dealer import iter_users_of
+
+MONITOR_COLUMNS = ('username', 'connection_limit', 'expiration_date')
 
 
 @bot.message_handler(regexp='/monitor')
 @permission_required([AdminPermission(), DealerPermission()])
 def monitor(message: types.Message):
     user_use_case = UserUseCase(UserRepository())
-    users = (
-        user_use_case.get_all()
-        if not is_dealer(message.from_user.id)
-        else get_all_users_of_dealer(message.from_user.id, user_use_case)
-    )
+    users = list(iter_users_of(message.from_user.id, user_use_case, MONITOR_COLUMNS))
 
     if not users:
         bot.reply_to(message, '❌ <b>Nao foi possivel encontrar usuarios</b>')
@@ -49,11 +47,7 @@ def monitor(message: types.Message):
 @permission_required([AdminPermission(), DealerPermission()])
 def callback_query__monitor(query: types.CallbackQuery):
     user_use_case = UserUseCase(UserRepository())
-    users = (
-        user_use_case.get_all()
-        if not is_dealer(query.from_user.id)
-        else get_all_users_of_dealer(query.from_user.id, user_use_case)
-    )
+    users = list(iter_users_of(query.from_user.id, user_use_case, MONITOR_COLUMNS))
 
     if not users:
         bot.edit_message_text(
@@ -0,0 +1,39 @@
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    func,
+)
+from sqlalchemy.engine import Connection
+
+
+def upgrade(connection: Connection) -> None:
+    metadata = MetaData()
+
+    Table(
+        'dealers',
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', String, nullable=False),
+        Column('username', String, nullable=False),
+        Column('account_creation_limit', Integer, nullable=False, default=0),
+        Column('expires_at', DateTime, nullable=False, default=func.now()),
+        Column('active', Boolean, nullable=False, default=True),
+        Column('created_at', DateTime, nullable=False, default=func.now()),
+        Column('updated_at', DateTime, nullable=False, default=func.now(), onupdate=func.now()),
+    )
+    Table(
+        'accounts',
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('dealer_id', Integer, ForeignKey('dealers.id'), nullable=False),
+        Column('created_at', DateTime, nullable=False, default=func.now()),
+        Column('updated_at', DateTime, nullable=False, default=func.now(), onupdate=func.now()),
+    )
+
+    metadata.create_all(connection)
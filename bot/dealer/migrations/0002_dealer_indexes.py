@@ -0,0 +1,10 @@
+from sqlalchemy.engine import Connection
+
+
+def upgrade(connection: Connection) -> None:
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_accounts_dealer_id ON accounts (dealer_id)'
+    )
+    connection.exec_driver_sql(
+        'CREATE INDEX IF NOT EXISTS ix_dealers_username ON dealers (username)'
+    )
@@ -1,42 +1,28 @@
-from typing import List
+from typing import List, Set
 
 from sqlalchemy.ext.declarative import declarative_base
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session
 
 from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, func
 
+from app.data.config import DBConnection as BaseDBConnection, migrate
+
 DB_URI = 'sqlite:///db.sqlite3'
 BASE = declarative_base()
 
 
-class DBConnection:
-    def __init__(self, uri: str = DB_URI):
-        self.__uri = uri
-        self.__engine = create_engine(self.__uri)
-        self.__session = None
-
-        BASE.metadata.create_all(self.__engine)
+class DBConnection(BaseDBConnection):
+    migrated: Set[str] = set()
 
-    @property
-    def uri(self) -> str:
-        return self.__uri
-
-    @property
-    def engine(self):
-        return self.__engine
-
-    @property
-    def session(self) -> sessionmaker:
-        return self.__session
+    def __init__(self, uri: str = DB_URI):
+        super().__init__(uri)
 
-    def __enter__(self) -> 'DBConnection':
-        self.__session = sessionmaker()(bind=self.engine)
-        return self.__session
+        if uri not in DBConnection.migrated:
+            migrate('bot.dealer.migrations', uri)
+            DBConnection.migrated.add(uri)
 
-    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        self.session.close()
+    def __enter__(self) -> Session:
+        return super().__enter__().session
 
 
 class Model(BASE):
@@ -52,7 +38,7 @@ class Dealer(Model):
     id = Column(Integer, primary_key=True)
 
     name = Column(String, nullable=False)
-    username = Column(String, nullable=False)
+    username = Column(String, nullable=False, index=True)
 
     account_creation_limit = Column(Integer, nullable=False, default=0)
     expires_at = Column(DateTime, nullable=False, default=func.now())
@@ -73,7 +59,7 @@ class Account(Model):
     __tablename__ = 'accounts'
 
     id = Column(Integer, primary_key=True)
-    dealer_id = Column(Integer, ForeignKey('dealers.id'), nullable=False)
+    dealer_id = Column(Integer, ForeignKey('dealers.id'), nullable=False, index=True)
 
 
 class DealerRepository:
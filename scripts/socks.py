@@ -1,21 +1,39 @@
+import array
+import base64
+import hashlib
 import socket
 import ssl
 import select
+import selectors
 import threading
+import collections
+import itertools
+import heapq
+import errno
 import os
+import signal
+import time
 import argparse
+import json
+import math
 import logging
+import logging.handlers
+import queue
+import re
 import resource
+import sqlite3
+import struct
+import uuid
+import socketserver
 
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse
-from typing import List, Tuple, Union, Optional
+from typing import Callable, Dict, List, Tuple, Union, Optional
 from enum import Enum
 
 __author__ = 'Glemison C. Dutra'
 __version__ = '1.0.3'
 
-resource.setrlimit(resource.RLIMIT_NOFILE, (65536, 65536))
-
 logger = logging.getLogger(__name__)
 
 DEFAULT_RESPONSE = b'\r\n'.join(
@@ -25,6 +43,10 @@ DEFAULT_RESPONSE = b'\r\n'.join(
     ]
 )
 
+CONTROL_SOCKET = '/run/glmanager/socks-%s.sock'
+USERS_DATABASE = '/etc/GLManager/db.sqlite3'
+AUTH_LOG = '/var/log/auth.log'
+
 REMOTES_ADDRESS = {
     'ssh': ('0.0.0.0', 22),
     'openvpn': ('0.0.0.0.0', 1194),
@@ -32,30 +54,656 @@ REMOTES_ADDRESS = {
 }
 
 
+def set_keepalive(sock: socket.socket, idle: int, interval: int, count: int) -> None:
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+def wait_sockets(
+    rlist: List[socket.socket],
+    wlist: List[socket.socket],
+    timeout: float,
+) -> Tuple[List[socket.socket], List[socket.socket]]:
+    poller = select.poll()
+    sockets = {}
+
+    for sock in rlist:
+        sockets[sock.fileno()] = sock
+        poller.register(sock, select.POLLIN)
+
+    for sock in wlist:
+        events = select.POLLIN | select.POLLOUT if sock.fileno() in sockets else select.POLLOUT
+        sockets[sock.fileno()] = sock
+        poller.register(sock, events)
+
+    r, w = [], []
+    for fd, events in poller.poll(timeout * 1000):
+        if events & (select.POLLIN | select.POLLHUP | select.POLLERR):
+            r.append(sockets[fd])
+
+        if events & select.POLLOUT:
+            w.append(sockets[fd])
+
+    return r, w
+
+
+def set_nofile_limit(limit: int = 65536) -> None:
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, limit))
+    except (ValueError, OSError):
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class Metrics:
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    DESCRIPTIONS = {
+        'socks_connections_total': ('counter', 'Client connections accepted'),
+        'socks_bytes_received_total': ('counter', 'Bytes received per side of the tunnel'),
+        'socks_bytes_sent_total': ('counter', 'Bytes sent per side of the tunnel'),
+        'socks_upstream_connect_seconds': ('histogram', 'Time to connect to the backend'),
+        'socks_upstream_errors_total': ('counter', 'Backend connection failures'),
+        'socks_upstream_pool_total': ('counter', 'Backend connections requested from the pool'),
+        'socks_upstream_pool_idle': ('gauge', 'Pre-connected backend sockets waiting in the pool'),
+        'socks_handshake_seconds': ('histogram', 'Time from accept to backend routing'),
+        'socks_handshake_parse_seconds': ('histogram', 'Time spent parsing handshake payloads'),
+        'socks_tls_handshake_seconds': ('histogram', 'Time to complete the TLS handshake'),
+        'socks_tls_handshakes_total': ('counter', 'TLS handshakes per result'),
+        'socks_tls_cert_reloads_total': ('counter', 'Certificate reloads per result'),
+        'socks_connection_limit_total': ('counter', 'Tunnels closed by the per-user limit'),
+        'socks_sessions_identified': ('gauge', 'Tunnels attributed to a user'),
+        'socks_tunnels_reaped_total': ('counter', 'Tunnels closed by the idle/lifetime reaper'),
+        'socks_usage_flushes_total': ('counter', 'Usage batches written to the database'),
+        'socks_websocket_upgrades_total': ('counter', 'WebSocket handshakes completed'),
+        'socks_proxy_headers_total': ('counter', 'PROXY protocol headers read from clients'),
+        'socks_tunnels_active': ('gauge', 'Open tunnels per remote type'),
+        'socks_queue_bytes': ('gauge', 'Bytes queued for writing per side of the tunnel'),
+        'socks_log_suppressed_total': ('counter', 'Log records dropped by the sampler'),
+        'socks_log_dropped_total': ('counter', 'Log records dropped because the queue was full'),
+    }
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__values: Dict[str, Dict[tuple, float]] = {}
+        self.__histograms: Dict[str, Dict[tuple, List[float]]] = {}
+        self.__collectors: List[Callable[[], Dict[str, Dict[tuple, float]]]] = []
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+
+        with self.__lock:
+            values = self.__values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+
+        with self.__lock:
+            histogram = self.__histograms.setdefault(name, {}).get(key)
+            if histogram is None:
+                histogram = [0] * (len(self.BUCKETS) + 2)
+                self.__histograms[name][key] = histogram
+
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[index] += 1
+
+            histogram[-2] += 1
+            histogram[-1] += value
+
+    def add_collector(self, collector: Callable[[], Dict[str, Dict[tuple, float]]]) -> None:
+        self.__collectors.append(collector)
+
+    @staticmethod
+    def _format_labels(key: tuple, **extra: str) -> str:
+        labels = list(key) + sorted(extra.items())
+        if not labels:
+            return ''
+
+        return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+    def render(self) -> str:
+        with self.__lock:
+            values = {name: dict(items) for name, items in self.__values.items()}
+            histograms = {
+                name: {key: list(histogram) for key, histogram in items.items()}
+                for name, items in self.__histograms.items()
+            }
+
+        for collector in self.__collectors:
+            values.update(collector())
+
+        lines = []
+        for name, (kind, description) in self.DESCRIPTIONS.items():
+            if name not in values and name not in histograms:
+                continue
+
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+            for key, value in values.get(name, {}).items():
+                lines.append('%s%s %s' % (name, self._format_labels(key), value))
+
+            for key, histogram in histograms.get(name, {}).items():
+                for bound, count in zip(self.BUCKETS, histogram):
+                    labels = self._format_labels(key, le=str(bound))
+                    lines.append('%s_bucket%s %s' % (name, labels, count))
+
+                labels = self._format_labels(key, le='+Inf')
+                lines.append('%s_bucket%s %s' % (name, labels, histogram[-2]))
+                lines.append('%s_count%s %s' % (name, self._format_labels(key), histogram[-2]))
+                lines.append('%s_sum%s %s' % (name, self._format_labels(key), histogram[-1]))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class LogSampler(logging.Filter):
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+
+        self.__buckets: Dict[tuple, 'TokenBucket'] = {}
+        self.__suppressed: Dict[tuple, int] = {}
+        self.__lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.levelno, record.msg)
+
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket is None:
+                bucket = self.__buckets[key] = TokenBucket(self.rate, self.burst)
+
+            if not bucket.take(1):
+                self.__suppressed[key] = self.__suppressed.get(key, 0) + 1
+                metrics.inc('socks_log_suppressed_total', level=record.levelname.lower())
+                return False
+
+            record.suppressed = self.__suppressed.pop(key, 0)
+
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': '%s.%03d' % (self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), record.msecs),
+            'level': record.levelname.lower(),
+            'pid': record.process,
+            'event': str(record.msg),
+            'message': record.getMessage(),
+        }
+
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, target: logging.Handler, size: int = 10000) -> None:
+        super().__init__(queue.Queue(size))
+        self.target = target
+        self.size = size
+
+        self.__listener: Optional[logging.handlers.QueueListener] = None
+
+    def start(self) -> None:
+        self.queue = queue.Queue(self.size)
+        self.__listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.__listener.start()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('socks_log_dropped_total')
+
+    def close(self) -> None:
+        listener, self.__listener = self.__listener, None
+
+        if listener is not None:
+            try:
+                listener.stop()
+            except queue.Full:
+                pass
+
+        self.target.close()
+        super().close()
+
+
+def setup_logging(
+    level: int,
+    json_format: bool = False,
+    rate: float = 0,
+    queue_size: int = 10000,
+) -> None:
+    handler = logging.StreamHandler()
+
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s', '%H:%M:%S')
+        )
+
+    if queue_size > 0 and hasattr(os, 'register_at_fork'):
+        queue_handler = LogQueueHandler(handler, queue_size)
+        queue_handler.start()
+        os.register_at_fork(after_in_child=queue_handler.start)
+        handler = queue_handler
+
+    if rate > 0:
+        handler.addFilter(LogSampler(rate))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(handler)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug('Metrics %s - ' + format, self.address_string(), *args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        logger.info('Metricas disponiveis em http://%s:%s/metrics', *self.server_address)
+
+
 class RemoteTypes(Enum):
     SSH = 'ssh'
     OPENVPN = 'openvpn'
     V2RAY = 'v2ray'
 
 
-class ParserType:
+def parse_address(value: Union[str, int, list], host: str = '0.0.0.0') -> Tuple[str, int]:
+    if isinstance(value, (list, tuple)):
+        return value[0], int(value[1])
+
+    value = str(value)
+    if ':' not in value:
+        return host, int(value)
+
+    host, port = value.rsplit(':', 1)
+    return host, int(port)
+
+
+def parse_sni(data: bytes) -> Tuple[bool, Optional[str]]:
+    if len(data) < 5:
+        return False, None
+
+    size = int.from_bytes(data[3:5], 'big')
+    if len(data) < 5 + size:
+        return False, None
+
+    record = memoryview(data)[5 : 5 + size]
+
+    try:
+        if record[0] != 0x01:
+            return True, None
+
+        pos = 4 + 2 + 32
+        pos += 1 + record[pos]
+        pos += 2 + int.from_bytes(record[pos : pos + 2], 'big')
+        pos += 1 + record[pos]
+
+        end = pos + 2 + int.from_bytes(record[pos : pos + 2], 'big')
+        pos += 2
+
+        while pos + 4 <= end:
+            kind = int.from_bytes(record[pos : pos + 2], 'big')
+            size = int.from_bytes(record[pos + 2 : pos + 4], 'big')
+            pos += 4
+
+            if kind == 0 and record[pos + 2] == 0:
+                length = int.from_bytes(record[pos + 3 : pos + 5], 'big')
+                return True, bytes(record[pos + 5 : pos + 5 + length]).decode('ascii').lower()
+
+            pos += size
+    except (IndexError, UnicodeDecodeError):
+        pass
+
+    return True, None
+
+
+class ProxyHeader:
+    V2_SIGNATURE = b'\r\n\r\n\x00\r\nQUIT\n'
+    V1_MAX_SIZE = 107
+    MIN_SIZE = 15
+
+    def __init__(
+        self,
+        source: Optional[Tuple[str, int]] = None,
+        destination: Optional[Tuple[str, int]] = None,
+        version: int = 1,
+    ) -> None:
+        self.source = source
+        self.destination = destination
+        self.version = version
+
+    @staticmethod
+    def _family(host: str) -> int:
+        return socket.AF_INET6 if ':' in host else socket.AF_INET
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'ProxyHeader':
+        if data.startswith(cls.V2_SIGNATURE):
+            return cls._parse_v2(data)
+
+        if data.startswith(b'PROXY ') and data.endswith(b'\r\n'):
+            return cls._parse_v1(data)
+
+        raise ValueError('Cabeçalho PROXY inválido')
+
+    @classmethod
+    def _parse_v1(cls, data: bytes) -> 'ProxyHeader':
+        parts = data[:-2].decode('ascii').split(' ')
+
+        if parts[1] == 'UNKNOWN':
+            return cls(version=1)
+
+        if parts[1] not in ('TCP4', 'TCP6') or len(parts) != 6:
+            raise ValueError('Cabeçalho PROXY v1 inválido: %s' % parts[1])
+
+        family = socket.AF_INET6 if parts[1] == 'TCP6' else socket.AF_INET
+        source, destination = (parts[2], int(parts[4])), (parts[3], int(parts[5]))
+
+        for host, port in (source, destination):
+            try:
+                socket.inet_pton(family, host)
+            except OSError:
+                raise ValueError('Endereço inválido no cabeçalho PROXY: %s' % host)
+
+            if not 0 <= port < 65536:
+                raise ValueError('Porta inválida no cabeçalho PROXY: %s' % port)
+
+        return cls(source, destination, 1)
+
+    @classmethod
+    def _parse_v2(cls, data: bytes) -> 'ProxyHeader':
+        command, family = data[12], data[13] >> 4
+        body = data[16:]
+
+        if command >> 4 != 2 or command & 0x0F > 1:
+            raise ValueError('Cabeçalho PROXY v2 inválido: comando %#x' % command)
+
+        if command & 0x0F == 0:
+            return cls(version=2)
+
+        if family == 1 and len(body) >= 12:
+            family, size = socket.AF_INET, 4
+        elif family == 2 and len(body) >= 36:
+            family, size = socket.AF_INET6, 16
+        else:
+            return cls(version=2)
+
+        source_port, destination_port = struct.unpack('!HH', body[2 * size : 2 * size + 4])
+        source = (socket.inet_ntop(family, body[:size]), source_port)
+        destination = (socket.inet_ntop(family, body[size : 2 * size]), destination_port)
+
+        return cls(source, destination, 2)
+
+    def record(self) -> None:
+        metrics.inc(
+            'socks_proxy_headers_total',
+            result='proxy' if self.source is not None else 'local',
+            version=str(self.version),
+        )
+
+    def encode(self, version: int) -> bytes:
+        known = (
+            self.source is not None
+            and self.destination is not None
+            and self._family(self.source[0]) == self._family(self.destination[0])
+        )
+
+        if version == 1:
+            if not known:
+                return b'PROXY UNKNOWN\r\n'
+
+            protocol = 'TCP6' if self._family(self.source[0]) == socket.AF_INET6 else 'TCP4'
+            addresses = (self.source[0], self.destination[0], self.source[1], self.destination[1])
+            return ('PROXY %s %s %s %s %s\r\n' % ((protocol,) + addresses)).encode('ascii')
+
+        if not known:
+            return self.V2_SIGNATURE + b'\x21\x00\x00\x00'
+
+        family = self._family(self.source[0])
+        body = (
+            socket.inet_pton(family, self.source[0])
+            + socket.inet_pton(family, self.destination[0])
+            + struct.pack('!HH', self.source[1], self.destination[1])
+        )
+        protocol = 0x21 if family == socket.AF_INET6 else 0x11
+
+        return self.V2_SIGNATURE + struct.pack('!BBH', 0x21, protocol, len(body)) + body
+
+
+class ProxyHeaderReader:
     def __init__(self) -> None:
+        self.__buffer = bytearray()
+
+    def _recv(self, sock: socket.socket, size: int, flags: int = 0) -> bytes:
+        data = socket.socket.recv(sock, size, flags)
+        if not data:
+            raise ConnectionError('Conexão encerrada antes do cabeçalho PROXY')
+
+        return data
+
+    def _missing(self, sock: socket.socket) -> int:
+        buffer = self.__buffer
+
+        if buffer.startswith(ProxyHeader.V2_SIGNATURE):
+            if len(buffer) < 16:
+                return 16 - len(buffer)
+
+            return 16 + struct.unpack('!H', buffer[14:16])[0] - len(buffer)
+
+        if not buffer.startswith(b'PROXY '):
+            raise ValueError('Cabeçalho PROXY ausente')
+
+        if buffer.endswith(b'\n'):
+            return 0
+
+        if len(buffer) >= ProxyHeader.V1_MAX_SIZE:
+            raise ValueError('Cabeçalho PROXY v1 muito longo')
+
+        peek = self._recv(sock, ProxyHeader.V1_MAX_SIZE - len(buffer), socket.MSG_PEEK)
+        end = peek.find(b'\n')
+
+        return end + 1 if end >= 0 else len(peek)
+
+    def read(self, sock: socket.socket) -> Optional[ProxyHeader]:
+        buffer = self.__buffer
+
+        try:
+            if len(buffer) < ProxyHeader.MIN_SIZE:
+                buffer += self._recv(sock, ProxyHeader.MIN_SIZE - len(buffer))
+                if len(buffer) < ProxyHeader.MIN_SIZE:
+                    return None
+
+            missing = self._missing(sock)
+
+            while missing > 0:
+                buffer += self._recv(sock, missing)
+                missing = self._missing(sock)
+        except (BlockingIOError, InterruptedError):
+            return None
+
+        return ProxyHeader.parse(bytes(buffer))
+
+
+class ProtocolTable:
+    TLS_RECORD_SIZE = 16384 + 5
+
+    SIGNATURES = (
+        (b'\x0068', RemoteTypes.OPENVPN.value),
+        (b'\x00', RemoteTypes.V2RAY.value),
+        (b'SSH-', RemoteTypes.SSH.value),
+    )
+
+    def __init__(self, backends: Dict[str, Tuple[str, int]]) -> None:
+        self.backends = dict(backends)
+        self.sni: Dict[str, str] = {}
+        self.websocket: Optional[str] = None
+        self.websocket_frames = False
+        self.default: Optional[str] = None
+        self.proxy_protocol: Dict[str, int] = {}
+
+        self.__table: Dict[int, List[Tuple[bytes, str]]] = {}
+
+    @classmethod
+    def of(cls, backends: Dict[str, Tuple[str, int]] = None) -> 'ProtocolTable':
+        table = cls(backends if backends is not None else REMOTES_ADDRESS)
+
+        for prefix, backend in cls.SIGNATURES:
+            if backend in table.backends:
+                table.add(prefix, backend)
+
+        return table
+
+    @classmethod
+    def load(cls, path: str, backends: Dict[str, Tuple[str, int]] = None) -> 'ProtocolTable':
+        with open(path) as f:
+            config = json.load(f)
+
+        table = cls.of(backends)
+
+        for name, address in config.get('backends', {}).items():
+            table.backends[name] = parse_address(address)
+
+        for signature in config.get('signatures', []):
+            if 'hex' in signature:
+                prefix = bytes.fromhex(signature['hex'])
+            else:
+                prefix = signature['prefix'].encode('latin-1')
+
+            table.add(prefix, signature['backend'])
+
+        for server_name, backend in config.get('sni', {}).items():
+            table.add_sni(server_name, backend)
+
+        for backend, version in config.get('proxy_protocol', {}).items():
+            table.add_proxy_protocol(backend, version)
+
+        table.websocket = table._check(config.get('websocket'))
+        table.websocket_frames = bool(config.get('websocket_frames', False))
+        table.default = table._check(config.get('default'))
+
+        return table
+
+    def _check(self, backend: Optional[str]) -> Optional[str]:
+        if backend is not None and backend not in self.backends:
+            raise ValueError('Backend %s não configurado' % backend)
+
+        return backend
+
+    def add(self, prefix: bytes, backend: str) -> None:
+        if not prefix:
+            raise ValueError('Prefix is empty')
+
+        self._check(backend)
+
+        entries = [entry for entry in self.__table.get(prefix[0], []) if entry[0] != prefix]
+        entries.append((prefix, backend))
+        entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+
+        self.__table[prefix[0]] = entries
+
+    def add_sni(self, server_name: str, backend: str) -> None:
+        self.sni[server_name.lower()] = self._check(backend)
+
+    def add_proxy_protocol(self, backend: str, version: int = 1) -> None:
+        if version not in (1, 2):
+            raise ValueError('Versão do PROXY protocol inválida: %s' % version)
+
+        self.proxy_protocol[self._check(backend)] = version
+
+    def match(self, data: bytes) -> Tuple[Optional[str], bool]:
+        if not data:
+            return None, True
+
+        if self.sni and data[0] == 0x16:
+            complete, server_name = parse_sni(data)
+
+            if not complete and len(data) < self.TLS_RECORD_SIZE:
+                return None, True
+
+            if server_name in self.sni:
+                return self.sni[server_name], False
+
+        for prefix, backend in self.__table.get(data[0], ()):
+            if len(data) < len(prefix):
+                if prefix.startswith(data):
+                    return None, True
+                continue
+
+            if data.startswith(prefix):
+                return backend, False
+
+        return None, False
+
+
+class ParserType:
+    def __init__(self, protocols: Optional[ProtocolTable] = None) -> None:
+        self.protocols = protocols or ProtocolTable.of()
+
         self.type = None
+        self.backend = None
         self.address = None
 
-    def parse(self, data: bytes) -> None:
-        if data.startswith(b'\x0068'):
-            self.type = RemoteTypes.OPENVPN
-            self.address = REMOTES_ADDRESS[self.type.value]
-            return
+    def route(self, backend: str) -> None:
+        self.backend = backend
+        self.address = self.protocols.backends[backend]
+
+        try:
+            self.type = RemoteTypes(backend)
+        except ValueError:
+            self.type = None
+
+    def is_partial(self, data: bytes) -> bool:
+        return self.protocols.match(data)[1]
 
-        if data.startswith(b'\x00'):
-            self.type = RemoteTypes.V2RAY
-            self.address = REMOTES_ADDRESS[self.type.value]
+    def parse(self, data: bytes) -> None:
+        backend, _ = self.protocols.match(data)
 
-        if data.startswith(b'SSH-'):
-            self.type = RemoteTypes.SSH
-            self.address = REMOTES_ADDRESS[self.type.value]
+        if backend is not None:
+            self.route(backend)
 
 
 class HttpParser:
@@ -87,13 +735,228 @@ class HttpParser:
         return base + headers.encode('utf-8') + self.body
 
 
+class HandshakeState(Enum):
+    NEED_MORE = 'need_more'
+    HTTP = 'http'
+    WEBSOCKET = 'websocket'
+    ROUTE = 'route'
+    INVALID = 'invalid'
+
+
+class HandshakeParser:
+    MAX_HEADER_SIZE = 8192
+
+    def __init__(self, parser_type: ParserType) -> None:
+        self.parser_type = parser_type
+
+        self.__buffer = bytearray()
+        self.__scanned = 0
+
+    def __len__(self) -> int:
+        return len(self.__buffer)
+
+    def feed(self, data: bytes) -> None:
+        self.__buffer += data
+
+    def _find_head_end(self) -> Tuple[int, int]:
+        buffer = self.__buffer
+        start = self.__scanned
+
+        crlf = buffer.find(b'\r\n\r\n', start)
+        lf = buffer.find(b'\n\n', start, crlf if crlf >= 0 else len(buffer))
+
+        if lf >= 0:
+            return lf, 2
+
+        if crlf >= 0:
+            return crlf, 4
+
+        self.__scanned = max(0, len(buffer) - 3)
+        return -1, 0
+
+    def take(self) -> bytes:
+        data = bytes(self.__buffer)
+        self.__buffer.clear()
+        self.__scanned = 0
+
+        return data
+
+    def _route(self, backend: str) -> Tuple[HandshakeState, Optional[bytes]]:
+        self.parser_type.route(backend)
+        return HandshakeState.ROUTE, self.take()
+
+    def next(self) -> Tuple[HandshakeState, Optional[bytes]]:
+        buffer = self.__buffer
+        protocols = self.parser_type.protocols
+
+        backend, partial = protocols.match(buffer)
+
+        if partial:
+            return HandshakeState.NEED_MORE, None
+
+        if backend is not None:
+            return self._route(backend)
+
+        if not 0x41 <= buffer[0] <= 0x5A:
+            if protocols.default is not None:
+                return self._route(protocols.default)
+
+            return HandshakeState.INVALID, None
+
+        end, size = self._find_head_end()
+
+        if end < 0:
+            if len(buffer) > self.MAX_HEADER_SIZE:
+                return HandshakeState.INVALID, None
+
+            return HandshakeState.NEED_MORE, None
+
+        state = HandshakeState.HTTP
+
+        if protocols.websocket_frames or protocols.websocket is not None:
+            lower = buffer.lower()
+
+            if protocols.websocket_frames and lower.find(b'\nsec-websocket-key:', 0, end) >= 0:
+                state = HandshakeState.WEBSOCKET
+            elif protocols.websocket is not None and lower.find(b'upgrade: websocket', 0, end) >= 0:
+                return self._route(protocols.websocket)
+
+        head = bytes(buffer[:end])
+        del buffer[: end + size]
+        self.__scanned = 0
+
+        return state, head
+
+
+class WebSocketCodec:
+    GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+    OP_CONTINUATION = 0x0
+    OP_TEXT = 0x1
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+
+    def __init__(self) -> None:
+        self.__buffer = bytearray()
+        self.closed = False
+
+    @classmethod
+    def accept(cls, head: bytes) -> bytes:
+        for line in head.split(b'\n')[1:]:
+            name, _, value = line.partition(b':')
+
+            if name.strip().lower() == b'sec-websocket-key':
+                digest = hashlib.sha1(value.strip() + cls.GUID).digest()
+                break
+        else:
+            raise ValueError('Sec-WebSocket-Key ausente')
+
+        return b'\r\n'.join(
+            [
+                b'HTTP/1.1 101 Switching Protocols',
+                b'Upgrade: websocket',
+                b'Connection: Upgrade',
+                b'Sec-WebSocket-Accept: ' + base64.b64encode(digest),
+                b'\r\n',
+            ]
+        )
+
+    @staticmethod
+    def mask(data: bytes, key: bytes) -> bytes:
+        size = len(data)
+        if not size:
+            return b''
+
+        key = (key * (size // 4 + 1))[:size]
+        masked = int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')
+        return masked.to_bytes(size, 'little')
+
+    @staticmethod
+    def encode(data: bytes, opcode: int = OP_BINARY) -> bytes:
+        size = len(data)
+
+        if size < 126:
+            header = struct.pack('!BB', 0x80 | opcode, size)
+        elif size < 65536:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, size)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, size)
+
+        return header + data
+
+    def decode(self, data: bytes) -> Tuple[bytes, bytes]:
+        buffer = self.__buffer
+        buffer += data
+
+        payload = []
+        replies = []
+        pos = 0
+
+        while len(buffer) - pos >= 2:
+            opcode = buffer[pos] & 0x0F
+            masked = buffer[pos + 1] & 0x80
+            size = buffer[pos + 1] & 0x7F
+            header = 2
+
+            if size == 126:
+                if len(buffer) - pos < 4:
+                    break
+                size = int.from_bytes(buffer[pos + 2 : pos + 4], 'big')
+                header = 4
+            elif size == 127:
+                if len(buffer) - pos < 10:
+                    break
+                size = int.from_bytes(buffer[pos + 2 : pos + 10], 'big')
+                header = 10
+
+            if size > self.MAX_FRAME_SIZE:
+                raise ValueError('Frame WebSocket muito grande (%s bytes)' % size)
+
+            if masked:
+                header += 4
+
+            if len(buffer) - pos < header + size:
+                break
+
+            body = bytes(buffer[pos + header : pos + header + size])
+            if masked:
+                body = self.mask(body, bytes(buffer[pos + header - 4 : pos + header]))
+
+            pos += header + size
+
+            if opcode in (self.OP_CONTINUATION, self.OP_TEXT, self.OP_BINARY):
+                payload.append(body)
+            elif opcode == self.OP_PING:
+                replies.append(self.encode(body, self.OP_PONG))
+            elif opcode == self.OP_CLOSE and not self.closed:
+                replies.append(self.encode(body[:2], self.OP_CLOSE))
+                self.closed = True
+
+        del buffer[:pos]
+        return b''.join(payload), b''.join(replies)
+
+
 class Connection:
+    SIDE = 'connection'
+
+    HIGH_WATERMARK = 1024 * 1024
+    LOW_WATERMARK = 256 * 1024
+    MAX_IOV = 64
+
     def __init__(self, conn: Union[socket.socket, ssl.SSLSocket], addr: Tuple[str, int]):
         self.__conn = conn
         self.__addr = addr
-        self.__buffer = b''
+        self.__buffer = collections.deque()
+        self.__pending = 0
+        self.__congested = False
         self.__closed = False
 
+        self.last_activity = time.monotonic()
+        self.received = 0
+
     @property
     def conn(self) -> Union[socket.socket, ssl.SSLSocket]:
         if not isinstance(self.__conn, (socket.socket, ssl.SSLSocket)):
@@ -124,11 +987,24 @@ class Connection:
 
     @property
     def buffer(self) -> bytes:
-        return self.__buffer
+        return b''.join(self.__buffer)
 
     @buffer.setter
     def buffer(self, data: bytes) -> None:
-        self.__buffer = data
+        self.__buffer.clear()
+        self.__pending = 0
+        self.__congested = False
+
+        if data:
+            self.queue(data)
+
+    @property
+    def pending(self) -> int:
+        return self.__pending
+
+    @property
+    def congested(self) -> bool:
+        return self.__congested
 
     @property
     def closed(self) -> bool:
@@ -144,7 +1020,14 @@ class Connection:
 
     def read(self, size: int = 4096) -> Optional[bytes]:
         data = self.conn.recv(size)
-        return data if len(data) > 0 else None
+
+        if len(data) > 0:
+            self.last_activity = time.monotonic()
+            self.received += len(data)
+            metrics.inc('socks_bytes_received_total', len(data), side=self.SIDE)
+            return data
+
+        return None
 
     def write(self, data: Union[bytes, str]) -> int:
         if isinstance(data, str):
@@ -162,208 +1045,2462 @@ class Connection:
         if len(data) <= 0:
             raise ValueError('Queue data is empty')
 
-        self.__buffer += data
+        self.__buffer.append(data)
+        self.__pending += len(data)
+
+        if self.__pending >= self.HIGH_WATERMARK:
+            self.__congested = True
+
         return len(data)
 
     def flush(self) -> int:
-        sent = self.write(self.__buffer)
-        self.__buffer = self.__buffer[sent:]
-        return sent
+        if isinstance(self.conn, ssl.SSLSocket) or len(self.__buffer) == 1:
+            sent = self.write(self.__buffer[0])
+        else:
+            sent = self.conn.sendmsg(list(itertools.islice(self.__buffer, self.MAX_IOV)))
 
+        self.__pending -= sent
+        if self.__pending <= self.LOW_WATERMARK:
+            self.__congested = False
 
-class Client(Connection):
-    def __str__(self):
+        metrics.inc('socks_bytes_sent_total', sent, side=self.SIDE)
+
+        remaining = sent
+        while remaining > 0:
+            chunk = self.__buffer[0]
+
+            if len(chunk) > remaining:
+                self.__buffer[0] = memoryview(chunk)[remaining:]
+                break
+
+            self.__buffer.popleft()
+            remaining -= len(chunk)
+
+        return sent
+
+
+class Client(Connection):
+    SIDE = 'client'
+
+    def __init__(
+        self,
+        conn: Union[socket.socket, ssl.SSLSocket],
+        addr: Tuple[str, int],
+        destination: Optional[Tuple[str, int]] = None,
+    ) -> None:
+        super().__init__(conn, addr)
+        self.destination = destination
+
+    def apply(self, header: ProxyHeader) -> None:
+        header.record()
+
+        if header.source is not None:
+            self.addr = header.source
+            self.destination = header.destination
+
+    def __str__(self):
+        return 'Cliente - %s:%s' % self.addr
+
+
+class Server(Connection):
+    SIDE = 'server'
+
+    def __init__(self, conn: Union[socket.socket, ssl.SSLSocket], addr: Tuple[str, int]):
+        super().__init__(conn, addr)
+        self.connecting = False
+
+    def __str__(self):
+        return 'Servidor - %s:%s' % self.addr
+
+    @classmethod
+    def of(cls, addr: Tuple[str, int]) -> 'Server':
+        return cls(socket.socket(socket.AF_INET, socket.SOCK_STREAM), addr)
+
+    def connect(self, addr: Tuple[str, int] = None, timeout: int = 5) -> None:
+        self.addr = addr or self.addr
+        self.conn = socket.create_connection(self.addr, timeout)
+        self.conn.settimeout(None)
+
+        logger.debug('%s Conexão estabelecida', self)
+
+    def connect_nowait(self, addr: Tuple[str, int] = None) -> None:
+        self.addr = addr or self.addr
+
+        conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        conn.setblocking(False)
+
+        error = conn.connect_ex(self.addr)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            conn.close()
+            raise ConnectionError('%s %s' % (self, os.strerror(error)))
+
+        self.conn.close()
+        self.conn = conn
+        self.connecting = error != 0
+
+    def finish_connect(self) -> None:
+        error = self.conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error != 0:
+            raise ConnectionError('%s %s' % (self, os.strerror(error)))
+
+        self.connecting = False
+        logger.debug('%s Conexão estabelecida', self)
+
+
+class ServerPool:
+    def __init__(
+        self,
+        name: str,
+        addr: Tuple[str, int],
+        size: int = 4,
+        max_idle: float = 30,
+        interval: float = 1,
+    ) -> None:
+        self.name = name
+        self.addr = addr
+        self.size = size
+        self.max_idle = max_idle
+        self.interval = interval
+
+        self.__sockets = collections.deque()
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__running = False
+
+    def __len__(self) -> int:
+        return len(self.__sockets)
+
+    def __str__(self) -> str:
+        return 'Pool %s - %s:%s' % (self.name, *self.addr)
+
+    @staticmethod
+    def is_alive(conn: socket.socket) -> bool:
+        try:
+            data = conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            return False
+
+        return len(data) > 0
+
+    def acquire(self) -> Optional[socket.socket]:
+        now = time.monotonic()
+        conn = None
+
+        with self.__lock:
+            while self.__sockets:
+                candidate, created_at = self.__sockets.popleft()
+
+                if now - created_at < self.max_idle and self.is_alive(candidate):
+                    conn = candidate
+                    break
+
+                candidate.close()
+
+        self.__wakeup.set()
+        metrics.inc(
+            'socks_upstream_pool_total',
+            remote=self.name,
+            result='hit' if conn is not None else 'miss',
+        )
+        return conn
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+
+        with self.__lock:
+            alive = collections.deque()
+
+            for conn, created_at in self.__sockets:
+                if now - created_at < self.max_idle and self.is_alive(conn):
+                    alive.append((conn, created_at))
+                else:
+                    conn.close()
+
+            self.__sockets = alive
+
+    def _fill(self) -> None:
+        while self.__running and len(self.__sockets) < self.size:
+            try:
+                conn = socket.create_connection(self.addr, 5)
+                conn.settimeout(None)
+            except OSError as e:
+                logger.debug('%s Erro: %s', self, e)
+                return
+
+            with self.__lock:
+                self.__sockets.append((conn, time.monotonic()))
+
+    def run(self) -> None:
+        while self.__running:
+            self._evict()
+            self._fill()
+
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+
+    def start(self) -> None:
+        self.__running = True
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+        logger.info('%s iniciado com %s conexões', self, self.size)
+
+    def close(self) -> None:
+        self.__running = False
+        self.__wakeup.set()
+
+        with self.__lock:
+            while self.__sockets:
+                conn, _ = self.__sockets.popleft()
+                conn.close()
+
+
+class AuthLogWatcher:
+    PATTERN = re.compile(r'sshd\[\d+\]: Accepted \S+ for (\S+) from \S+ port (\d+)')
+
+    def __init__(self, path: str, callback: Callable[[str, int], None], interval: float = 0.5):
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+
+    def _follow(self) -> None:
+        inode = None
+        f = None
+
+        while True:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                time.sleep(self.interval)
+                continue
+
+            if stat.st_ino != inode:
+                if f is not None:
+                    f.close()
+
+                f = open(self.path, 'r', errors='replace')
+                if inode is None:
+                    f.seek(0, os.SEEK_END)
+
+                inode = stat.st_ino
+
+            line = f.readline()
+            if not line:
+                time.sleep(self.interval)
+                continue
+
+            match = self.PATTERN.search(line)
+            if not match:
+                continue
+
+            try:
+                self.callback(match.group(1), int(match.group(2)))
+            except Exception as e:
+                logger.exception('Erro ao processar login de %s: %s', match.group(1), e)
+
+    def start(self) -> None:
+        if not os.path.exists(self.path):
+            logger.warning('%s não encontrado, limite SSH desativado', self.path)
+            return
+
+        thread = threading.Thread(target=self._follow)
+        thread.daemon = True
+        thread.start()
+
+
+class ConnectionLimiter:
+    def __init__(
+        self,
+        database: str = USERS_DATABASE,
+        interval: float = 60,
+        evict_oldest: bool = False,
+        enforce: bool = True,
+    ) -> None:
+        self.database = database
+        self.interval = interval
+        self.evict_oldest = evict_oldest
+        self.enforce = enforce
+
+        self.__limits: Dict[str, int] = {}
+        self.__uuids: Dict[str, str] = {}
+        self.__sessions: Dict[str, Dict['Tunnel', None]] = {}
+        self.__ports: Dict[int, 'Tunnel'] = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(len(sessions) for sessions in self.__sessions.values())
+
+    def load(self) -> None:
+        conn = sqlite3.connect('file:%s?mode=ro' % self.database, uri=True)
+
+        try:
+            rows = conn.execute(
+                'SELECT username, v2ray_uuid, connection_limit FROM users'
+            ).fetchall()
+        finally:
+            conn.close()
+
+        limits = {username: limit for username, _, limit in rows}
+        uuids = {value.lower(): username for username, value, _ in rows if value}
+
+        self.__limits, self.__uuids = limits, uuids
+
+    def _reload(self) -> None:
+        while True:
+            try:
+                self.load()
+            except sqlite3.Error as e:
+                logger.error('Falha ao carregar usuarios de %s: %s', self.database, e)
+
+            time.sleep(self.interval)
+
+    def start(self, auth_log: Optional[str] = AUTH_LOG) -> None:
+        self.load()
+
+        thread = threading.Thread(target=self._reload)
+        thread.daemon = True
+        thread.start()
+
+        if auth_log:
+            AuthLogWatcher(auth_log, self.on_login).start()
+
+        if self.enforce:
+            logger.info('Limite de conexões ativo para %s usuarios', len(self.__limits))
+
+    def _acquire(self, tunnel: 'Tunnel', username: str) -> Optional['Tunnel']:
+        limit = self.__limits.get(username)
+
+        with self.__lock:
+            sessions = self.__sessions.setdefault(username, {})
+
+            if not self.enforce or limit is None or len(sessions) < limit:
+                sessions[tunnel] = None
+                tunnel.identity = username
+                return None
+
+            if not self.evict_oldest or limit <= 0 or not sessions:
+                return tunnel
+
+            oldest = next(iter(sessions))
+            del sessions[oldest]
+
+            sessions[tunnel] = None
+            tunnel.identity = username
+            return oldest
+
+    def _reject(self, tunnel: 'Tunnel', username: str) -> None:
+        action = 'evict' if self.evict_oldest else 'reject'
+        metrics.inc('socks_connection_limit_total', action=action)
+
+        logger.warning('%s -> Limite de conexões excedido para %s', tunnel.client, username)
+        tunnel.terminate()
+
+    def admit(self, tunnel: 'Tunnel', payload: bytes) -> bool:
+        if tunnel.parser_type.type is not RemoteTypes.V2RAY or len(payload) < 17 or payload[0] != 0:
+            return True
+
+        username = self.__uuids.get(str(uuid.UUID(bytes=bytes(payload[1:17]))))
+        if username is None:
+            return True
+
+        excess = self._acquire(tunnel, username)
+        if excess is not None:
+            self._reject(excess, username)
+
+        return excess is not tunnel
+
+    def watch(self, tunnel: 'Tunnel') -> None:
+        if tunnel.parser_type.type is not RemoteTypes.SSH or tunnel.server is None:
+            return
+
+        port = tunnel.server.conn.getsockname()[1]
+
+        with self.__lock:
+            self.__ports[port] = tunnel
+            tunnel.identity_port = port
+
+    def on_login(self, username: str, port: int) -> None:
+        with self.__lock:
+            tunnel = self.__ports.pop(port, None)
+
+        if tunnel is None:
+            return
+
+        tunnel.identity_port = None
+        excess = self._acquire(tunnel, username)
+
+        if excess is not None:
+            self._reject(excess, username)
+
+    def release(self, tunnel: 'Tunnel') -> None:
+        with self.__lock:
+            if tunnel.identity_port is not None:
+                self.__ports.pop(tunnel.identity_port, None)
+
+            sessions = self.__sessions.get(tunnel.identity)
+            if sessions is not None:
+                sessions.pop(tunnel, None)
+
+                if not sessions:
+                    del self.__sessions[tunnel.identity]
+
+        tunnel.identity = None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+
+        self.__tokens = self.burst
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.__tokens = min(self.burst, self.__tokens + (now - self.__updated_at) * self.rate)
+        self.__updated_at = now
+
+    def consume(self, size: int) -> None:
+        with self.__lock:
+            self._refill()
+            self.__tokens -= size
+
+    def delay(self) -> float:
+        with self.__lock:
+            self._refill()
+            return -self.__tokens / self.rate if self.__tokens < 0 else 0
+
+    def take(self, size: int) -> bool:
+        with self.__lock:
+            self._refill()
+
+            if self.__tokens < size:
+                return False
+
+            self.__tokens -= size
+            return True
+
+
+class TrafficShaper:
+    MIN_BURST = 64 * 1024
+
+    def __init__(self, tunnel_rate: float = 0, user_rate: float = 0) -> None:
+        self.tunnel_rate = tunnel_rate
+        self.user_rate = user_rate
+
+        self.__users: Dict[Tuple[str, str], TokenBucket] = {}
+        self.__lock = threading.Lock()
+
+    def _bucket(self, rate: float) -> TokenBucket:
+        return TokenBucket(rate, max(rate, self.MIN_BURST))
+
+    def buckets(self, tunnel: 'Tunnel', side: str) -> List[TokenBucket]:
+        buckets = []
+
+        if self.tunnel_rate > 0:
+            bucket = tunnel.buckets.get(side)
+            if bucket is None:
+                bucket = tunnel.buckets[side] = self._bucket(self.tunnel_rate)
+
+            buckets.append(bucket)
+
+        if self.user_rate > 0 and tunnel.identity is not None:
+            key = (tunnel.identity, side)
+            bucket = self.__users.get(key)
+
+            if bucket is None:
+                with self.__lock:
+                    bucket = self.__users.setdefault(key, self._bucket(self.user_rate))
+
+            buckets.append(bucket)
+
+        return buckets
+
+    def delay(self, tunnel: 'Tunnel', side: str) -> float:
+        return max([bucket.delay() for bucket in self.buckets(tunnel, side)] or [0])
+
+    def consume(self, tunnel: 'Tunnel', side: str, size: int) -> None:
+        for bucket in self.buckets(tunnel, side):
+            bucket.consume(size)
+
+
+class UsageRecorder:
+    def __init__(self, database: str = USERS_DATABASE, interval: float = 60) -> None:
+        self.database = database
+        self.interval = interval
+
+        self.__totals: Dict[str, List[int]] = {}
+        self.__lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.database, timeout=30)
+
+    def has_table(self) -> bool:
+        conn = self._connect()
+
+        try:
+            row = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'usage'"
+            ).fetchone()
+        finally:
+            conn.close()
+
+        return row is not None
+
+    def collect(self, tunnel: 'Tunnel') -> None:
+        if tunnel.identity is None:
+            return
+
+        with self.__lock:
+            upload = tunnel.client.received
+            download = tunnel.server.received if tunnel.server is not None else 0
+
+            accounted_upload, accounted_download = tunnel.accounted
+            tunnel.accounted = (upload, download)
+
+            totals = self.__totals.setdefault(tunnel.identity, [0, 0])
+            totals[0] += upload - accounted_upload
+            totals[1] += download - accounted_download
+
+    def _merge(self, totals: Dict[str, List[int]]) -> None:
+        with self.__lock:
+            for username, (upload, download) in totals.items():
+                current = self.__totals.setdefault(username, [0, 0])
+                current[0] += upload
+                current[1] += download
+
+    def flush(self) -> int:
+        for tunnel in Tunnel.active():
+            self.collect(tunnel)
+
+        with self.__lock:
+            totals, self.__totals = self.__totals, {}
+
+        rows = [
+            (upload, download, username, time.strftime('%Y-%m-%d'))
+            for username, (upload, download) in totals.items()
+            if upload or download
+        ]
+
+        if not rows:
+            return 0
+
+        try:
+            conn = self._connect()
+
+            try:
+                with conn:
+                    conn.executemany(
+                        'INSERT OR IGNORE INTO usage (username, date) VALUES (?, ?)',
+                        [row[2:] for row in rows],
+                    )
+                    conn.executemany(
+                        'UPDATE usage SET upload = upload + ?, download = download + ? '
+                        'WHERE username = ? AND date = ?',
+                        rows,
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.error('Falha ao gravar consumo em %s: %s', self.database, e)
+            self._merge(totals)
+            return 0
+
+        metrics.inc('socks_usage_flushes_total')
+        return len(rows)
+
+    def run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def start(self) -> None:
+        try:
+            if not self.has_table():
+                logger.warning(
+                    'Tabela usage ausente em %s, execute o GLManager para aplicar as migrações',
+                    self.database,
+                )
+        except sqlite3.Error as e:
+            logger.error('Falha ao verificar consumo em %s: %s', self.database, e)
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+
+class TimerWheel:
+    def __init__(self, slots: int = 64, resolution: float = 1) -> None:
+        self.resolution = resolution
+
+        self.__slots: List[set] = [set() for _ in range(slots)]
+        self.__where: Dict[object, int] = {}
+        self.__position = 0
+        self.__tick = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__where)
+
+    def schedule(self, item: object, when: float) -> None:
+        ticks = math.ceil((when - self.__tick) / self.resolution)
+        ticks = min(max(ticks, 1), len(self.__slots) - 1)
+
+        with self.__lock:
+            self._discard(item)
+
+            slot = (self.__position + ticks) % len(self.__slots)
+            self.__slots[slot].add(item)
+            self.__where[item] = slot
+
+    def _discard(self, item: object) -> None:
+        slot = self.__where.pop(item, None)
+        if slot is not None:
+            self.__slots[slot].discard(item)
+
+    def cancel(self, item: object) -> None:
+        with self.__lock:
+            self._discard(item)
+
+    def advance(self, now: float) -> List[object]:
+        expired = []
+
+        with self.__lock:
+            while self.__tick + self.resolution <= now:
+                self.__tick += self.resolution
+                self.__position = (self.__position + 1) % len(self.__slots)
+
+                slot = self.__slots[self.__position]
+                for item in slot:
+                    del self.__where[item]
+
+                expired.extend(slot)
+                slot.clear()
+
+        return expired
+
+
+class Reaper:
+    def __init__(
+        self,
+        idle_timeout: float = 0,
+        max_lifetime: float = 0,
+        resolution: float = 1,
+    ) -> None:
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.wheel = TimerWheel(resolution=resolution)
+
+    def deadline(self, tunnel: 'Tunnel') -> Tuple[float, str]:
+        deadlines = []
+
+        if self.idle_timeout > 0:
+            deadlines.append((tunnel.last_activity + self.idle_timeout, 'idle'))
+
+        if self.max_lifetime > 0:
+            deadlines.append((tunnel.created_at + self.max_lifetime, 'lifetime'))
+
+        return min(deadlines)
+
+    def add(self, tunnel: 'Tunnel') -> None:
+        self.wheel.schedule(tunnel, self.deadline(tunnel)[0])
+
+    def remove(self, tunnel: 'Tunnel') -> None:
+        self.wheel.cancel(tunnel)
+
+    def reap(self) -> int:
+        now = time.monotonic()
+        reaped = 0
+
+        for tunnel in self.wheel.advance(now):
+            when, reason = self.deadline(tunnel)
+
+            if when > now:
+                self.wheel.schedule(tunnel, when)
+                continue
+
+            logger.info('%s -> Conexão encerrada por inatividade (%s)', tunnel.client, reason)
+            metrics.inc('socks_tunnels_reaped_total', reason=reason)
+
+            tunnel.terminate()
+            reaped += 1
+
+        return reaped
+
+    def start(self, loop: Optional['EventLoop'] = None) -> None:
+        resolution = self.wheel.resolution
+
+        if loop is not None:
+
+            def tick() -> None:
+                self.reap()
+                loop.call_later(resolution, tick)
+
+            loop.call_later(resolution, tick)
+            return
+
+        def run() -> None:
+            while True:
+                time.sleep(resolution)
+                self.reap()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+
+class SplicePipe:
+    SIZE = 65536
+
+    def __init__(self, src: Connection, dst: Connection) -> None:
+        self.src = src
+        self.dst = dst
+        self.pending = 0
+
+        self.__flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+        self.__read_fd, self.__write_fd = os.pipe()
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.SIZE
+
+    def pump_in(self) -> int:
+        size = os.splice(
+            self.src.conn.fileno(),
+            self.__write_fd,
+            self.SIZE - self.pending,
+            flags=self.__flags,
+        )
+        self.pending += size
+        self.src.last_activity = time.monotonic()
+        self.src.received += size
+        metrics.inc('socks_bytes_received_total', size, side=self.src.SIDE)
+        return size
+
+    def pump_out(self) -> int:
+        size = os.splice(
+            self.__read_fd,
+            self.dst.conn.fileno(),
+            self.pending,
+            flags=self.__flags,
+        )
+        self.pending -= size
+        metrics.inc('socks_bytes_sent_total', size, side=self.dst.SIDE)
+        return size
+
+    def close(self) -> None:
+        os.close(self.__read_fd)
+        os.close(self.__write_fd)
+
+
+class Tunnel:
+    READ_SIZE = 8192
+
+    splice = hasattr(os, 'splice')
+    pools: Dict[Tuple[str, int], ServerPool] = {}
+    limiter: Optional[ConnectionLimiter] = None
+    reaper: Optional[Reaper] = None
+    shaper: Optional[TrafficShaper] = None
+    usage: Optional[UsageRecorder] = None
+    keepalive: Optional[Tuple[int, int, int]] = None
+
+    tunnels = set()
+    tunnels_lock = threading.Lock()
+
+    def __init__(
+        self,
+        client: Client,
+        server: Optional[Server] = None,
+        protocols: Optional[ProtocolTable] = None,
+    ) -> None:
+        self.client = client
+        self.server = server
+
+        self.parser_type = ParserType(protocols)
+        self.handshake = HandshakeParser(self.parser_type)
+
+        self.pipes: Dict[Connection, Tuple[SplicePipe, SplicePipe]] = {}
+        self.created_at = time.monotonic()
+
+        self.identity: Optional[str] = None
+        self.identity_port: Optional[int] = None
+
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.accounted = (0, 0)
+
+        self.codec: Optional[WebSocketCodec] = None
+
+    @property
+    def remote(self) -> str:
+        return self.parser_type.backend or 'none'
+
+    @property
+    def last_activity(self) -> float:
+        if self.server is None:
+            return self.client.last_activity
+
+        return max(self.client.last_activity, self.server.last_activity)
+
+    @classmethod
+    def active(cls) -> List['Tunnel']:
+        with cls.tunnels_lock:
+            return list(cls.tunnels)
+
+    def _track(self) -> None:
+        with Tunnel.tunnels_lock:
+            Tunnel.tunnels.add(self)
+
+        if self.reaper is not None:
+            self.reaper.add(self)
+
+    def _untrack(self) -> None:
+        if self.reaper is not None:
+            self.reaper.remove(self)
+
+        if self.usage is not None:
+            self.usage.collect(self)
+
+        if self.limiter is not None:
+            self.limiter.release(self)
+
+        with Tunnel.tunnels_lock:
+            Tunnel.tunnels.discard(self)
+
+    def terminate(self) -> None:
+        for connection in (self.client, self.server):
+            if connection is None or connection.closed:
+                continue
+
+            try:
+                socket.socket.shutdown(connection.conn, socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _read(self, connection: Connection) -> Optional[bytes]:
+        data = connection.read(self.READ_SIZE)
+
+        if data and isinstance(connection.conn, ssl.SSLSocket):
+            pending = connection.conn.pending()
+            while data and pending > 0:
+                chunk = connection.read(pending)
+                if not chunk:
+                    break
+                data += chunk
+                pending = connection.conn.pending()
+
+        return data
+
+    def _throttle(self, connection: Connection) -> float:
+        if self.shaper is None:
+            return 0
+
+        return self.shaper.delay(self, connection.SIDE)
+
+    def _received(self, connection: Connection, size: int) -> None:
+        if self.shaper is not None:
+            self.shaper.consume(self, connection.SIDE, size)
+
+    def _create_pipes(self) -> Tuple[SplicePipe, SplicePipe]:
+        upstream = SplicePipe(self.client, self.server)
+        downstream = SplicePipe(self.server, self.client)
+
+        self.pipes[self.client] = (upstream, downstream)
+        self.pipes[self.server] = (downstream, upstream)
+
+        logger.debug('%s -> relay via splice', self.client)
+        return upstream, downstream
+
+    def _close_pipes(self) -> None:
+        for pipe in self.pipes.get(self.client, ()):
+            pipe.close()
+
+        self.pipes.clear()
+
+    def _can_splice(self) -> bool:
+        return (
+            self.splice
+            and self.parser_type.backend is not None
+            and self.server is not None
+            and self.codec is None
+            and not self.server.closed
+            and not self.server.connecting
+            and not self.client.pending
+            and not self.server.pending
+            and not isinstance(self.client.conn, ssl.SSLSocket)
+            and not isinstance(self.server.conn, ssl.SSLSocket)
+        )
+
+    def _acquire(self, addr: Tuple[str, int]) -> Optional[Server]:
+        pool = self.pools.get(addr)
+        conn = pool.acquire() if pool is not None else None
+        return Server(conn, addr) if conn is not None else None
+
+    def _connect(self, addr: Tuple[str, int]) -> None:
+        self.server = self._acquire(addr)
+        if self.server is not None:
+            return
+
+        self.server = Server.of(addr)
+        started_at = time.monotonic()
+
+        try:
+            self.server.connect()
+        except OSError:
+            metrics.inc('socks_upstream_errors_total', remote=self.remote)
+            raise
+
+        metrics.observe(
+            'socks_upstream_connect_seconds',
+            time.monotonic() - started_at,
+            remote=self.remote,
+        )
+
+    def _reply(self, data: bytes) -> None:
+        self.client.queue(self.codec.encode(data) if self.codec is not None else data)
+
+    def _decode(self, data: bytes) -> bytes:
+        payload, replies = self.codec.decode(data)
+
+        if replies:
+            self.client.queue(replies)
+
+        return payload
+
+    def _process_request(self, data: bytes) -> None:
+        if self.codec is not None:
+            data = self._decode(data)
+            if not data:
+                return
+
+        if self.parser_type.backend is not None and self.server and not self.server.closed:
+            self.server.queue(data)
+            return
+
+        started_at = time.monotonic()
+        responded = False
+        self.handshake.feed(data)
+
+        while True:
+            state, payload = self.handshake.next()
+
+            if state is HandshakeState.NEED_MORE:
+                break
+
+            if state is HandshakeState.INVALID:
+                raise ValueError('Solicitação inválida (%s bytes)' % len(self.handshake))
+
+            if state is HandshakeState.HTTP:
+                logger.info('%s -> Solicitação: %s', self.client, payload.split(b'\n', 1)[0])
+
+                if not responded:
+                    self._reply(DEFAULT_RESPONSE)
+                    responded = True
+
+                continue
+
+            if state is HandshakeState.WEBSOCKET:
+                logger.info('%s -> WebSocket: %s', self.client, payload.split(b'\n', 1)[0])
+                metrics.inc('socks_websocket_upgrades_total')
+
+                self.client.queue(WebSocketCodec.accept(payload))
+                self.codec = WebSocketCodec()
+                responded = True
+
+                self.handshake.feed(self._decode(self.handshake.take()))
+                continue
+
+            host, port = self.parser_type.address
+
+            metrics.observe('socks_handshake_parse_seconds', time.monotonic() - started_at)
+            metrics.observe(
+                'socks_handshake_seconds',
+                time.monotonic() - self.created_at,
+                remote=self.remote,
+            )
+            logger.info(
+                '%s -> Modo %s - %s:%s', self.client, self.parser_type.backend.upper(), host, port
+            )
+
+            if self.limiter is not None and not self.limiter.admit(self, payload):
+                return
+
+            self._connect((host, port))
+
+            version = self.parser_type.protocols.proxy_protocol.get(self.parser_type.backend)
+            if version is not None:
+                destination = self.client.destination or self.client.conn.getsockname()[:2]
+                self.server.queue(ProxyHeader(self.client.addr, destination).encode(version))
+
+            self.server.queue(payload)
+
+            if self.keepalive is not None:
+                set_keepalive(self.server.conn, *self.keepalive)
+
+            if self.limiter is not None:
+                self.limiter.watch(self)
+
+            return
+
+        metrics.observe('socks_handshake_parse_seconds', time.monotonic() - started_at)
+
+
+def collect_tunnel_metrics() -> Dict[str, Dict[tuple, float]]:
+    tunnels = {(('remote', remote.value),): 0 for remote in RemoteTypes}
+    tunnels[(('remote', 'none'),)] = 0
+    queues = {(('side', Client.SIDE),): 0, (('side', Server.SIDE),): 0}
+    identified = 0
+
+    for tunnel in Tunnel.active():
+        key = (('remote', tunnel.remote),)
+        tunnels[key] = tunnels.get(key, 0) + 1
+        identified += tunnel.identity is not None
+
+        for connection in (tunnel.client, tunnel.server):
+            if connection is None:
+                continue
+
+            _, outgoing = tunnel.pipes.get(connection, (None, None))
+            pending = connection.pending + (outgoing.pending if outgoing else 0)
+            queues[(('side', connection.SIDE),)] += pending
+
+    return {
+        'socks_tunnels_active': tunnels,
+        'socks_queue_bytes': queues,
+        'socks_sessions_identified': {(): identified},
+    }
+
+
+def tunnel_stats() -> dict:
+    remotes = {}
+
+    for tunnel in Tunnel.active():
+        stats = remotes.setdefault(tunnel.remote, {'tunnels': 0, 'upload': 0, 'download': 0})
+        stats['tunnels'] += 1
+        stats['upload'] += tunnel.client.received
+
+        if tunnel.server is not None:
+            stats['download'] += tunnel.server.received
+
+    return {'tunnels': sum(stats['tunnels'] for stats in remotes.values()), 'remotes': remotes}
+
+
+def merge_tunnel_stats(results: List[dict]) -> dict:
+    remotes = {}
+
+    for result in results:
+        for remote, stats in result.get('remotes', {}).items():
+            merged = remotes.setdefault(remote, {'tunnels': 0, 'upload': 0, 'download': 0})
+            for key, value in stats.items():
+                merged[key] += value
+
+    return {'tunnels': sum(stats['tunnels'] for stats in remotes.values()), 'remotes': remotes}
+
+
+def collect_pool_metrics() -> Dict[str, Dict[tuple, float]]:
+    return {
+        'socks_upstream_pool_idle': {
+            (('remote', pool.name),): len(pool) for pool in Tunnel.pools.values()
+        }
+    }
+
+
+metrics.add_collector(collect_tunnel_metrics)
+metrics.add_collector(collect_pool_metrics)
+
+
+class Proxy(Tunnel, threading.Thread):
+    def __init__(
+        self,
+        client: Client,
+        server: Optional[Server] = None,
+        handshake_timeout: Optional[float] = None,
+        protocols: Optional[ProtocolTable] = None,
+        proxy_timeout: Optional[float] = None,
+    ) -> None:
+        Tunnel.__init__(self, client, server, protocols)
+        threading.Thread.__init__(self)
+
+        self.handshake_timeout = handshake_timeout
+        self.proxy_timeout = proxy_timeout
+        self.__running = False
+        self.__timeout = 1
+
+    @property
+    def running(self) -> bool:
+        if self.server and self.server.closed and self.client.closed:
+            self.__running = False
+        return self.__running
+
+    @running.setter
+    def running(self, value: bool) -> None:
+        self.__running = value
+
+    def _readable(self, connection: Connection) -> bool:
+        delay = self._throttle(connection)
+        if delay > 0:
+            self.__timeout = min(self.__timeout, delay)
+
+        return delay <= 0
+
+    def _get_waitable_lists(self) -> Tuple[List[socket.socket]]:
+        r, w, e = [], [], []
+        self.__timeout = 1
+
+        if not self.server or self.server.closed or not self.server.congested:
+            if self._readable(self.client):
+                r.append(self.client.conn)
+
+        if self.server and not self.server.closed and not self.client.congested:
+            if self._readable(self.server):
+                r.append(self.server.conn)
+
+        if self.client.pending:
+            w.append(self.client.conn)
+
+        if self.server and not self.server.closed and self.server.pending:
+            w.append(self.server.conn)
+
+        return r, w, e
+
+    def _process_wlist(self, wlist: List[socket.socket]) -> None:
+        if self.client.conn in wlist:
+            sent = self.client.flush()
+            logger.debug('%s -> enviado %s bytes', self.client, sent)
+
+        if self.server and not self.server.closed and self.server.conn in wlist:
+            sent = self.server.flush()
+            logger.debug('%s -> enviado %s bytes', self.server, sent)
+
+    def _process_rlist(self, rlist: List[socket.socket]) -> None:
+        if self.client.conn in rlist:
+            data = self._read(self.client)
+            self.running = data is not None
+            if data and self.running:
+                self._received(self.client, len(data))
+                self._process_request(data)
+                logger.debug('%s -> recebido %s bytes', self.client, len(data))
+
+        if self.server and not self.server.closed and self.server.conn in rlist:
+            data = self._read(self.server)
+            self.running = data is not None
+            if data and self.running:
+                self._received(self.server, len(data))
+                self._reply(data)
+                logger.debug('%s -> recebido %s bytes', self.server, len(data))
+
+    def _process_splice(self) -> None:
+        upstream, downstream = self._create_pipes()
+
+        try:
+            while self.running:
+                self.__timeout = 1
+                rlist = [
+                    pipe.src.conn
+                    for pipe in (upstream, downstream)
+                    if not pipe.full and self._readable(pipe.src)
+                ]
+                wlist = [pipe.dst.conn for pipe in (upstream, downstream) if pipe.pending]
+                r, w = wait_sockets(rlist, wlist, self.__timeout)
+
+                for pipe in (upstream, downstream):
+                    if pipe.dst.conn in w:
+                        sent = pipe.pump_out()
+                        logger.debug('%s -> enviado %s bytes', pipe.dst, sent)
+
+                    if pipe.src.conn in r:
+                        received = pipe.pump_in()
+                        self.running = received > 0
+                        self._received(pipe.src, received)
+                        logger.debug('%s -> recebido %s bytes', pipe.src, received)
+        finally:
+            self._close_pipes()
+
+    def _process(self) -> None:
+        self.running = True
+
+        while self.running:
+            if self._can_splice():
+                self._process_splice()
+                break
+
+            rlist, wlist, _ = self._get_waitable_lists()
+            r, w = wait_sockets(rlist, wlist, self.__timeout)
+
+            self._process_wlist(w)
+            self._process_rlist(r)
+
+    def _read_proxy_header(self) -> None:
+        conn = self.client.conn
+        reader = ProxyHeaderReader()
+        deadline = time.monotonic() + self.proxy_timeout
+
+        conn.setblocking(False)
+
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('Tempo limite do cabeçalho PROXY excedido')
+
+                r, _ = wait_sockets([conn], [], remaining)
+                if not r:
+                    continue
+
+                header = reader.read(conn)
+                if header is not None:
+                    break
+        except socket.timeout:
+            metrics.inc('socks_proxy_headers_total', result='timeout', version='')
+            raise
+        except (ValueError, OSError):
+            metrics.inc('socks_proxy_headers_total', result='invalid', version='')
+            raise
+        finally:
+            conn.settimeout(None)
+
+        self.client.apply(header)
+
+    def _handshake(self) -> None:
+        conn = self.client.conn
+        started_at = time.monotonic()
+
+        conn.settimeout(self.handshake_timeout)
+        try:
+            conn.do_handshake()
+        except socket.timeout:
+            metrics.inc('socks_tls_handshakes_total', result='timeout')
+            raise
+        except (ssl.SSLError, OSError):
+            metrics.inc('socks_tls_handshakes_total', result='error')
+            raise
+        finally:
+            conn.settimeout(None)
+
+        metrics.observe('socks_tls_handshake_seconds', time.monotonic() - started_at)
+        metrics.inc('socks_tls_handshakes_total', result='reused' if conn.session_reused else 'ok')
+
+    def run(self) -> None:
+        try:
+            self._track()
+
+            if self.proxy_timeout is not None:
+                self._read_proxy_header()
+
+            if self.handshake_timeout is not None:
+                self._handshake()
+
+            logger.info('%s conectado', self.client)
+            self._process()
+        except Exception as e:
+            logger.exception('%s Erro: %s', self.client, e)
+        finally:
+            self._untrack()
+            self.client.close()
+            if self.server and not self.server.closed:
+                self.server.close()
+
+            logger.info('%s desconectado', self.client)
+
+
+class Timer:
+    def __init__(self, when: float, callback: Callable, args: tuple) -> None:
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other: 'Timer') -> bool:
+        return self.when < other.when
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class EventLoop:
+    def __init__(self) -> None:
+        self.selector = selectors.DefaultSelector()
+
+        self.__timers: List[Timer] = []
+        self.__callbacks = collections.deque()
+        self.__lock = threading.Lock()
+        self.__running = False
+
+        self.__waker, self.__waker_writer = socket.socketpair()
+        self.__waker.setblocking(False)
+        self.__waker_writer.setblocking(False)
+        self.selector.register(self.__waker, selectors.EVENT_READ, self._wakeup)
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    def register(self, sock: socket.socket, events: int, callback) -> None:
+        self.selector.register(sock, events, callback)
+
+    def modify(self, sock: socket.socket, events: int, callback) -> None:
+        self.selector.modify(sock, events, callback)
+
+    def unregister(self, sock: socket.socket) -> None:
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def call_soon_threadsafe(self, callback, *args) -> None:
+        with self.__lock:
+            self.__callbacks.append((callback, args))
+
+        try:
+            self.__waker_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        timer = Timer(time.monotonic() + delay, callback, args)
+        heapq.heappush(self.__timers, timer)
+        return timer
+
+    def _get_timeout(self) -> Optional[float]:
+        while self.__timers and self.__timers[0].cancelled:
+            heapq.heappop(self.__timers)
+
+        if not self.__timers:
+            return None
+
+        return max(0, self.__timers[0].when - time.monotonic())
+
+    def _run_timers(self) -> None:
+        now = time.monotonic()
+
+        while self.__timers and self.__timers[0].when <= now:
+            timer = heapq.heappop(self.__timers)
+            if timer.cancelled:
+                continue
+
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.exception('Erro no loop de eventos: %s', e)
+
+    def _wakeup(self, mask: int) -> None:
+        try:
+            while self.__waker.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _run_callbacks(self) -> None:
+        with self.__lock:
+            callbacks, self.__callbacks = self.__callbacks, collections.deque()
+
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception('Erro no loop de eventos: %s', e)
+
+    def run_forever(self) -> None:
+        self.__running = True
+
+        try:
+            while self.__running:
+                for key, mask in self.selector.select(self._get_timeout()):
+                    key.data(mask)
+
+                self._run_timers()
+                self._run_callbacks()
+        finally:
+            self.__running = False
+
+    def stop(self) -> None:
+        self.__running = False
+        self.call_soon_threadsafe(lambda: None)
+
+    def close(self) -> None:
+        self.selector.close()
+        self.__waker.close()
+        self.__waker_writer.close()
+
+
+class EventProxy(Tunnel):
+    READ_SIZE = 65536
+
+    def __init__(
+        self,
+        client: Client,
+        loop: EventLoop,
+        server: Optional[Server] = None,
+        protocols: Optional[ProtocolTable] = None,
+    ) -> None:
+        super().__init__(client, server, protocols)
+
+        self.loop = loop
+        self.__events = {}
+        self.__connect_started_at = None
+        self.__resume: Optional[Timer] = None
+
+    def _connect(self, addr: Tuple[str, int]) -> None:
+        self.server = self._acquire(addr)
+        if self.server is not None:
+            self.server.conn.setblocking(False)
+            self._watch(self.server, self._on_server_event)
+            return
+
+        self.server = Server.of(addr)
+        self.__connect_started_at = time.monotonic()
+
+        try:
+            self.server.connect_nowait()
+        except OSError:
+            metrics.inc('socks_upstream_errors_total', remote=self.remote)
+            raise
+
+        self._watch(self.server, self._on_server_event)
+
+    def _finish_connect(self) -> None:
+        try:
+            self.server.finish_connect()
+        except OSError:
+            metrics.inc('socks_upstream_errors_total', remote=self.remote)
+            raise
+
+        metrics.observe(
+            'socks_upstream_connect_seconds',
+            time.monotonic() - self.__connect_started_at,
+            remote=self.remote,
+        )
+
+    def _get_events(self, connection: Connection) -> int:
+        if isinstance(connection, Server) and connection.connecting:
+            return selectors.EVENT_WRITE
+
+        if self.pipes:
+            incoming, outgoing = self.pipes[connection]
+            readable = not incoming.full and not self._throttled(connection)
+            events = selectors.EVENT_READ if readable else 0
+            return events | selectors.EVENT_WRITE if outgoing.pending else events
+
+        peer = self.server if connection is self.client else self.client
+        readable = not (peer is not None and peer.congested) and not self._throttled(connection)
+        events = selectors.EVENT_READ if readable else 0
+        return events | selectors.EVENT_WRITE if connection.pending else events
+
+    def _throttled(self, connection: Connection) -> bool:
+        delay = self._throttle(connection)
+        if delay <= 0:
+            return False
+
+        if self.__resume is None:
+            self.__resume = self.loop.call_later(delay, self._resume)
+
+        return True
+
+    def _resume(self) -> None:
+        self.__resume = None
+
+        if not self.client.closed:
+            self._update()
+
+    def _watch(self, connection: Connection, callback) -> None:
+        events = self._get_events(connection)
+        current = self.__events.get(connection, 0)
+
+        if current == events:
+            return
+
+        if not events:
+            self.loop.unregister(connection.conn)
+        elif not current:
+            self.loop.register(connection.conn, events, callback)
+        else:
+            self.loop.modify(connection.conn, events, callback)
+
+        self.__events[connection] = events
+
+    def _update(self) -> None:
+        if not self.pipes and self._can_splice():
+            self._create_pipes()
+
+        if not self.client.closed:
+            self._watch(self.client, self._on_client_event)
+
+        if self.server and not self.server.closed:
+            self._watch(self.server, self._on_server_event)
+
+    def _splice(self, connection: Connection, mask: int) -> None:
+        incoming, outgoing = self.pipes[connection]
+
+        if mask & selectors.EVENT_WRITE:
+            sent = outgoing.pump_out()
+            logger.debug('%s -> enviado %s bytes', connection, sent)
+
+        if mask & selectors.EVENT_READ:
+            received = incoming.pump_in()
+            if received == 0:
+                self.close()
+                return
+
+            self._received(connection, received)
+
+            logger.debug('%s -> recebido %s bytes', connection, received)
+
+        self._update()
+
+    def _flush(self, connection: Connection) -> None:
+        if connection.pending:
+            sent = connection.flush()
+            logger.debug('%s -> enviado %s bytes', connection, sent)
+
+    def _on_client_event(self, mask: int) -> None:
+        try:
+            if self.pipes:
+                self._splice(self.client, mask)
+                return
+
+            if mask & selectors.EVENT_WRITE:
+                self._flush(self.client)
+
+            if mask & selectors.EVENT_READ:
+                data = self._read(self.client)
+                if data is None:
+                    self.close()
+                    return
+
+                self._received(self.client, len(data))
+                self._process_request(data)
+                logger.debug('%s -> recebido %s bytes', self.client, len(data))
+
+            self._update()
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            self._update()
+        except Exception as e:
+            logger.exception('%s Erro: %s', self.client, e)
+            self.close()
+
+    def _on_server_event(self, mask: int) -> None:
+        try:
+            if self.server.connecting:
+                self._finish_connect()
+
+            if self.pipes:
+                self._splice(self.server, mask)
+                return
+
+            if mask & selectors.EVENT_WRITE:
+                self._flush(self.server)
+
+            if mask & selectors.EVENT_READ:
+                data = self._read(self.server)
+                if data is None:
+                    self.close()
+                    return
+
+                self._received(self.server, len(data))
+                self._reply(data)
+                logger.debug('%s -> recebido %s bytes', self.server, len(data))
+
+            self._update()
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            self._update()
+        except Exception as e:
+            logger.exception('%s Erro: %s', self.client, e)
+            self.close()
+
+    def start(self) -> None:
+        self.client.conn.setblocking(False)
+        self._watch(self.client, self._on_client_event)
+        self._track()
+        logger.info('%s conectado', self.client)
+
+    def close(self) -> None:
+        for connection in (self.client, self.server):
+            if connection is None or connection.closed:
+                continue
+
+            self.loop.unregister(connection.conn)
+            connection.close()
+
+        if self.__resume is not None:
+            self.__resume.cancel()
+            self.__resume = None
+
+        self._close_pipes()
+        self._untrack()
+        self.__events.clear()
+        logger.info('%s desconectado', self.client)
+
+
+class TLSHandshake:
+    def __init__(
+        self,
+        conn: ssl.SSLSocket,
+        addr: Tuple[str, int],
+        loop: EventLoop,
+        callback: Callable[[Client], None],
+        timeout: float = 10,
+        destination: Optional[Tuple[str, int]] = None,
+    ) -> None:
+        self.conn = conn
+        self.addr = addr
+        self.loop = loop
+        self.callback = callback
+        self.timeout = timeout
+        self.destination = destination
+
+        self.__events = 0
+        self.__timer = None
+        self.__started_at = time.monotonic()
+
+    def __str__(self) -> str:
+        return 'Cliente - %s:%s' % self.addr
+
+    def _wait(self, events: int) -> None:
+        if self.__events == events:
+            return
+
+        if self.__events:
+            self.loop.modify(self.conn, events, self._on_event)
+        else:
+            self.loop.register(self.conn, events, self._on_event)
+
+        self.__events = events
+
+    def _finish(self, result: str) -> None:
+        metrics.inc('socks_tls_handshakes_total', result=result)
+
+        if self.__timer is not None:
+            self.__timer.cancel()
+
+        if self.__events:
+            self.loop.unregister(self.conn)
+            self.__events = 0
+
+        if result not in ('ok', 'reused'):
+            self.conn.close()
+
+    def _on_timeout(self) -> None:
+        logger.warning('%s Tempo limite do handshake TLS excedido', self)
+        self._finish('timeout')
+
+    def _on_event(self, mask: int) -> None:
+        try:
+            self.conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self._wait(selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self._wait(selectors.EVENT_WRITE)
+            return
+        except (ssl.SSLError, OSError) as e:
+            logger.debug('%s Erro no handshake TLS: %s', self, e)
+            self._finish('error')
+            return
+
+        metrics.observe('socks_tls_handshake_seconds', time.monotonic() - self.__started_at)
+        self._finish('reused' if self.conn.session_reused else 'ok')
+        self.callback(Client(self.conn, self.addr, self.destination))
+
+    def start(self) -> None:
+        self.__timer = self.loop.call_later(self.timeout, self._on_timeout)
+        self._on_event(0)
+
+
+class ProxyHeaderHandshake:
+    def __init__(
+        self,
+        conn: socket.socket,
+        addr: Tuple[str, int],
+        loop: EventLoop,
+        callback: Callable[[socket.socket, Tuple[str, int], Optional[Tuple[str, int]]], None],
+        timeout: float = 10,
+    ) -> None:
+        self.conn = conn
+        self.addr = addr
+        self.loop = loop
+        self.callback = callback
+        self.timeout = timeout
+
+        self.__reader = ProxyHeaderReader()
+        self.__timer = None
+
+    def __str__(self) -> str:
         return 'Cliente - %s:%s' % self.addr
 
+    def _finish(self) -> None:
+        self.__timer.cancel()
+        self.loop.unregister(self.conn)
+
+    def _on_timeout(self) -> None:
+        logger.warning('%s Tempo limite do cabeçalho PROXY excedido', self)
+        metrics.inc('socks_proxy_headers_total', result='timeout', version='')
+
+        self.loop.unregister(self.conn)
+        self.conn.close()
+
+    def _on_event(self, mask: int) -> None:
+        try:
+            header = self.__reader.read(self.conn)
+        except (ValueError, OSError) as e:
+            logger.debug('%s Erro no cabeçalho PROXY: %s', self, e)
+            metrics.inc('socks_proxy_headers_total', result='invalid', version='')
+
+            self._finish()
+            self.conn.close()
+            return
+
+        if header is None:
+            return
+
+        self._finish()
+
+        header.record()
+        self.callback(self.conn, header.source or self.addr, header.destination)
+
+    def start(self) -> None:
+        self.conn.setblocking(False)
+        self.__timer = self.loop.call_later(self.timeout, self._on_timeout)
+        self.loop.register(self.conn, selectors.EVENT_READ, self._on_event)
+
+
+def send_message(conn: socket.socket, message: dict, fds: List[int] = None) -> None:
+    data = json.dumps(message).encode() + b'\n'
+
+    if not fds:
+        conn.sendall(data)
+        return
+
+    conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+
+
+def recv_message(conn: socket.socket, max_fds: int = 16) -> Tuple[dict, List[int]]:
+    data, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_SPACE(max_fds * 4))
+
+    fds = array.array('i')
+    for level, kind, cmsg in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg[: len(cmsg) - len(cmsg) % fds.itemsize])
+
+    while data and not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+
+    if not data:
+        raise ConnectionError('Socket de controle fechado')
+
+    return json.loads(data.decode()), list(fds)
+
+
+class ControlSocket:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.commands: Dict[str, Callable[[dict], dict]] = {}
+
+        self.__sock: Optional[socket.socket] = None
+        self.__inode: Optional[int] = None
+        self.__lock = threading.RLock()
+
+    @property
+    def sock(self) -> Optional[socket.socket]:
+        return self.__sock
+
+    def command(self, name: str, handler: Callable[[dict], dict]) -> None:
+        self.commands[name] = handler
+
+    def bind(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, 0o700, exist_ok=True)
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(8)
+
+        self.__sock = sock
+        self.__inode = os.stat(self.path).st_ino
+
+    def handle(self, conn: socket.socket) -> None:
+        conn.settimeout(30)
+        reader = conn.makefile('rb')
+
+        try:
+            for line in reader:
+                try:
+                    request = json.loads(line.decode())
+                    handler = self.commands[request['command']]
+                except (ValueError, KeyError, TypeError):
+                    send_message(conn, {'error': 'Comando inválido'})
+                    continue
+
+                with self.__lock:
+                    response = handler(request)
+                    fds = response.pop('fds', None)
+
+                    if fds is not None:
+                        response['fds'] = len(fds)
+
+                    send_message(conn, response, fds)
+
+                if self.__sock is None:
+                    break
+        except OSError as e:
+            logger.debug('Socket de controle: %s', e)
+        finally:
+            reader.close()
+            conn.close()
+
+    def accept(self) -> None:
+        sock = self.__sock
+        if sock is None:
+            return
+
+        conn, _ = sock.accept()
+
+        thread = threading.Thread(target=self.handle, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self) -> None:
+        while self.__sock is not None:
+            try:
+                self.accept()
+            except OSError:
+                break
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def close(self) -> None:
+        with self.__lock:
+            sock, self.__sock = self.__sock, None
+
+        if sock is None:
+            return
+
+        try:
+            socket.socket.shutdown(sock, socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        sock.close()
+
+        try:
+            if os.stat(self.path).st_ino == self.__inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class ControlClient:
+    def __init__(self, path: str, timeout: float = 30) -> None:
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.settimeout(timeout)
+
+        try:
+            self.conn.connect(path)
+        except OSError:
+            self.conn.close()
+            raise
+
+    def call(self, command: str, **params) -> Tuple[dict, List[int]]:
+        params['command'] = command
+        send_message(self.conn, params)
+        return recv_message(self.conn)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> 'ControlClient':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class TCP:
+    drain_timeout = 0
+    proxy_protocol = False
+    proxy_timeout = 10
+
+    def __init__(
+        self,
+        addr: Tuple[str, int] = None,
+        backlog: int = 5,
+        loop: Optional[EventLoop] = None,
+        reuse_port: bool = False,
+        protocols: Optional[ProtocolTable] = None,
+        sock: Optional[socket.socket] = None,
+    ):
+        self.__addr = addr
+        self.__backlog = backlog
+        self.__listening = sock is not None
+        self.__accepting = True
+
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            if reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        self.__sock = sock
+
+        self.loop = loop
+        self.protocols = protocols or ProtocolTable.of()
+
+    @property
+    def sock(self) -> socket.socket:
+        return self.__sock
+
+    @property
+    def accepting(self) -> bool:
+        return self.__accepting
+
+    def __str__(self) -> str:
+        return '%s - %s:%s' % (self.__class__.__name__, *self.__addr)
+
+    def handle(
+        self,
+        conn: socket.socket,
+        addr: Tuple[str, int],
+        destination: Optional[Tuple[str, int]] = None,
+    ) -> None:
+        raise NotImplementedError()
+
+    def _proxy_timeout(self) -> Optional[float]:
+        return self.proxy_timeout if self.proxy_protocol else None
+
+    def _dispatch(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
+        metrics.inc('socks_connections_total', mode=self.__class__.__name__.lower())
+
+        if Tunnel.keepalive is not None:
+            set_keepalive(conn, *Tunnel.keepalive)
+
+        if self.proxy_protocol and self.loop is not None:
+            ProxyHeaderHandshake(conn, addr, self.loop, self.handle, self.proxy_timeout).start()
+            return
+
+        self.handle(conn, addr)
+
+    def _accept(self, mask: int) -> None:
+        while True:
+            try:
+                conn, addr = self.__sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error('%s Erro ao aceitar conexão: %s', self, e)
+                return
+
+            self._dispatch(conn, addr)
+
+    def register(self) -> None:
+        self.__sock.setblocking(False)
+        self.loop.register(self.__sock, selectors.EVENT_READ, self._accept)
+
+    def _serve_forever(self) -> None:
+        if self.loop is not None:
+            self.register()
+            self.loop.run_forever()
+            return
+
+        self.__sock.setblocking(False)
+
+        while self.__accepting:
+            r, _ = wait_sockets([self.__sock], [], 1)
+            if r:
+                self._accept(selectors.EVENT_READ)
+
+        self._close_listener()
+        self._drain()
+
+    def _close_listener(self) -> None:
+        self._accept(selectors.EVENT_READ)
+        self.__sock.close()
+
+        logger.info('%s parou de aceitar, drenando %s túneis', self, len(Tunnel.active()))
+
+    def _drained(self, started_at: float) -> bool:
+        if not Tunnel.active():
+            return True
+
+        if self.drain_timeout > 0 and time.monotonic() - started_at > self.drain_timeout:
+            logger.warning('%s encerrando %s túneis após drenagem', self, len(Tunnel.active()))
+            return True
+
+        return False
+
+    def _drain(self) -> None:
+        started_at = time.monotonic()
 
-class Server(Connection):
-    def __str__(self):
-        return 'Servidor - %s:%s' % self.addr
+        while not self._drained(started_at):
+            time.sleep(1)
 
-    @classmethod
-    def of(cls, addr: Tuple[str, int]) -> 'Server':
-        return cls(socket.socket(socket.AF_INET, socket.SOCK_STREAM), addr)
+    def _drain_loop(self, started_at: float) -> None:
+        if self._drained(started_at):
+            self.loop.stop()
+            return
 
-    def connect(self, addr: Tuple[str, int] = None, timeout: int = 5) -> None:
-        self.addr = addr or self.addr
-        self.conn = socket.create_connection(self.addr, timeout)
-        self.conn.settimeout(None)
+        self.loop.call_later(1, self._drain_loop, started_at)
 
-        logger.debug('%s Conexão estabelecida' % self)
+    def _stop_accepting(self) -> None:
+        if not self.__accepting:
+            return
 
+        self.__accepting = False
+        self.loop.unregister(self.__sock)
+        self._close_listener()
+        self._drain_loop(time.monotonic())
 
-class Proxy(threading.Thread):
-    def __init__(self, client: Client, server: Optional[Server] = None) -> None:
-        super().__init__()
+    def stop_accepting(self) -> None:
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stop_accepting)
+            return
 
-        self.client = client
-        self.server = server
+        self.__accepting = False
 
-        self.http_parser = HttpParser()
-        self.parser_type = ParserType()
+    def listen(self) -> None:
+        if self.__listening:
+            return
 
-        self.__running = False
+        self.__sock.bind(self.__addr)
+        self.__sock.listen(self.__backlog)
+        self.__listening = True
 
-    @property
-    def running(self) -> bool:
-        if self.server and self.server.closed and self.client.closed:
-            self.__running = False
-        return self.__running
+        logger.info('Servidor %s iniciado', self)
 
-    @running.setter
-    def running(self, value: bool) -> None:
-        self.__running = value
+    def run(self) -> None:
+        self.listen()
 
-    def _process_request(self, data: bytes) -> None:
-        if self.parser_type.type is not None and self.server and not self.server.closed:
-            self.server.queue(data)
+        try:
+            self._serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            logger.info('Finalizando servidor...')
+            self.__sock.close()
+
+
+class HTTP(TCP):
+    def handle(
+        self,
+        conn: socket.socket,
+        addr: Tuple[str, int],
+        destination: Optional[Tuple[str, int]] = None,
+    ) -> None:
+        client = Client(conn, addr, destination)
+
+        if self.loop is not None:
+            EventProxy(client, self.loop, protocols=self.protocols).start()
             return
 
-        self.parser_type.parse(data)
-        host, port = (None, None) if self.parser_type.type is None else self.parser_type.address
+        proxy = Proxy(client, protocols=self.protocols, proxy_timeout=self._proxy_timeout())
+        proxy.daemon = True
+        proxy.start()
 
-        if host and port:
-            self.server = Server.of((host, port))
-            self.server.connect()
 
-        if self.server and not self.server.closed:
-            self.server.queue(data)
-        else:
-            self.client.queue(DEFAULT_RESPONSE)
+class HTTPS(TCP):
+    def __init__(
+        self,
+        addr: Tuple[str, int],
+        cert: str,
+        backlog: int = 5,
+        loop: Optional[EventLoop] = None,
+        reuse_port: bool = False,
+        handshake_timeout: float = 10,
+        protocols: Optional[ProtocolTable] = None,
+        sock: Optional[socket.socket] = None,
+    ) -> None:
+        super().__init__(addr, backlog, loop, reuse_port, protocols, sock)
+        self.__cert = cert
+        self.__cert_mtime = os.stat(cert).st_mtime
+        self.__context_lock = threading.Lock()
 
-        if self.parser_type.type:
-            logger.info(
-                '%s -> Modo %s - %s:%s'
-                % (self.client, self.parser_type.type.value.upper(), host, port)
+        self.handshake_timeout = handshake_timeout
+        self.context = self.create_context(cert)
+
+    @staticmethod
+    def create_context(cert: str) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile=cert, keyfile=cert)
+        context.options &= ~ssl.OP_NO_TICKET
+
+        if hasattr(context, 'num_tickets'):
+            context.num_tickets = 2
+
+        return context
+
+    def reload_cert(self) -> bool:
+        try:
+            mtime = os.stat(self.__cert).st_mtime
+            self.create_context(self.__cert)
+
+            with self.__context_lock:
+                self.context.load_cert_chain(certfile=self.__cert, keyfile=self.__cert)
+        except (ssl.SSLError, OSError) as e:
+            metrics.inc('socks_tls_cert_reloads_total', result='error')
+            logger.error('Falha ao recarregar certificado %s: %s', self.__cert, e)
+            return False
+
+        self.__cert_mtime = mtime
+
+        metrics.inc('socks_tls_cert_reloads_total', result='ok')
+        logger.info('Certificado %s recarregado', self.__cert)
+        return True
+
+    def check_cert(self) -> None:
+        try:
+            mtime = os.stat(self.__cert).st_mtime
+        except OSError:
+            return
+
+        if mtime != self.__cert_mtime:
+            self.reload_cert()
+
+    def watch_cert(self, interval: float) -> None:
+        if self.loop is not None:
+
+            def check() -> None:
+                self.check_cert()
+                self.loop.call_later(interval, check)
+
+            self.loop.call_later(interval, check)
+            return
+
+        def watch() -> None:
+            while True:
+                time.sleep(interval)
+                self.check_cert()
+
+        thread = threading.Thread(target=watch)
+        thread.daemon = True
+        thread.start()
+
+    def _start_proxy(self, client: Client) -> None:
+        EventProxy(client, self.loop, protocols=self.protocols).start()
+
+    def handle(
+        self,
+        conn: socket.socket,
+        addr: Tuple[str, int],
+        destination: Optional[Tuple[str, int]] = None,
+    ) -> None:
+        if self.loop is not None:
+            conn.setblocking(False)
+
+        with self.__context_lock:
+            conn = self.context.wrap_socket(
+                conn, server_side=True, do_handshake_on_connect=False
             )
-        else:
-            self.http_parser.parse(data)
-            logger.info('%s -> Solicitação: %s' % (self.client, self.http_parser.body))
 
-    def _get_waitable_lists(self) -> Tuple[List[socket.socket]]:
-        r, w, e = [self.client.conn], [], []
+        if self.loop is not None:
+            handshake = TLSHandshake(
+                conn, addr, self.loop, self._start_proxy, self.handshake_timeout, destination
+            )
+            handshake.start()
+            return
 
-        if self.server and not self.server.closed:
-            r.append(self.server.conn)
+        proxy = Proxy(
+            Client(conn, addr),
+            handshake_timeout=self.handshake_timeout,
+            protocols=self.protocols,
+            proxy_timeout=self._proxy_timeout(),
+        )
+        proxy.daemon = True
+        proxy.start()
 
-        if self.client.buffer:
-            w.append(self.client.conn)
 
-        if self.server and not self.server.closed and self.server.buffer:
-            w.append(self.server.conn)
+class Listeners:
+    def __init__(self, servers: List[TCP], loop: Optional[EventLoop] = None) -> None:
+        self.servers = servers
+        self.loop = loop
 
-        return r, w, e
+    @property
+    def accepting(self) -> bool:
+        return any(server.accepting for server in self.servers)
 
-    def _process_wlist(self, wlist: List[socket.socket]) -> None:
-        if self.client.conn in wlist:
-            sent = self.client.flush()
-            logger.debug('%s -> enviado %s bytes' % (self.client, sent))
+    @property
+    def https(self) -> List[HTTPS]:
+        return [server for server in self.servers if isinstance(server, HTTPS)]
 
-        if self.server and not self.server.closed and self.server.conn in wlist:
-            sent = self.server.flush()
-            logger.debug('%s -> enviado %s bytes' % (self.server, sent))
+    def __str__(self) -> str:
+        return ', '.join(str(server) for server in self.servers)
 
-    def _process_rlist(self, rlist: List[socket.socket]) -> None:
-        if self.client.conn in rlist:
-            data = self.client.read(8192)
-            self.running = data is not None
-            if data and self.running:
-                self._process_request(data)
-                logger.debug('%s -> recebido %s bytes' % (self.client, len(data)))
+    def listen(self) -> None:
+        for server in self.servers:
+            server.listen()
 
-        if self.server and not self.server.closed and self.server.conn in rlist:
-            data = self.server.read(8192)
-            self.running = data is not None
-            if data and self.running:
-                self.client.queue(data)
-                logger.debug('%s -> recebido %s bytes' % (self.server, len(data)))
+    def stop_accepting(self) -> None:
+        for server in self.servers:
+            server.stop_accepting()
 
-    def _process(self) -> None:
-        self.running = True
+    def reload_cert(self) -> bool:
+        return all([server.reload_cert() for server in self.https])
 
-        while self.running:
-            rlist, wlist, xlist = self._get_waitable_lists()
-            r, w, _ = select.select(rlist, wlist, xlist, 1)
+    def _serve_forever(self) -> None:
+        if self.loop is not None:
+            for server in self.servers:
+                server.register()
 
-            self._process_wlist(w)
-            self._process_rlist(r)
+            self.loop.run_forever()
+            return
+
+        for server in self.servers:
+            server.sock.setblocking(False)
+
+        while self.accepting:
+            servers = dict(
+                (server.sock, server) for server in self.servers if server.accepting
+            )
+
+            r, _ = wait_sockets(list(servers), [], 1)
+            for sock in r:
+                servers[sock]._accept(selectors.EVENT_READ)
+
+        for server in self.servers:
+            server._close_listener()
+
+        self.servers[0]._drain()
 
     def run(self) -> None:
+        self.listen()
+
         try:
-            logger.info('%s conectado' % self.client)
-            self._process()
-        except Exception as e:
-            logger.exception('%s Erro: %s' % (self.client, e))
+            self._serve_forever()
+        except KeyboardInterrupt:
+            pass
         finally:
-            self.client.close()
-            if self.server and not self.server.closed:
-                self.server.close()
+            logger.info('Finalizando servidores...')
 
-            logger.info('%s desconectado' % self.client)
+            for server in self.servers:
+                server.sock.close()
 
 
-class TCP:
-    def __init__(self, addr: Tuple[str, int] = None, backlog: int = 5):
-        self.__addr = addr
-        self.__backlog = backlog
+def parse_listeners(value: str) -> List[Tuple[int, str]]:
+    listeners = []
 
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    for item in value.replace(',', ' ').split():
+        port, _, mode = item.partition('/')
+        mode = mode.lower() or 'http'
 
-    def __str__(self) -> str:
-        return '%s - %s:%s' % (self.__class__.__name__, *self.__addr)
+        if mode not in ('http', 'https'):
+            raise ValueError('Modo inválido em %s' % item)
 
-    def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        raise NotImplementedError()
+        port = int(port)
+        if not 0 < port < 65536:
+            raise ValueError('Porta inválida em %s' % item)
 
-    def run(self) -> None:
-        self.__sock.bind(self.__addr)
-        self.__sock.listen(self.__backlog)
+        if port in [listener[0] for listener in listeners]:
+            raise ValueError('Porta %s repetida' % port)
+
+        listeners.append((port, mode))
 
-        logger.info('Servidor %s iniciado' % self)
+    if not listeners:
+        raise ValueError('Nenhum listener informado')
 
+    return listeners
+
+
+class SignalWatcher:
+    def __init__(self) -> None:
+        self.__handlers: Dict[int, Callable[[], None]] = {}
+        self.__read, self.__write = os.pipe()
+        os.set_blocking(self.__write, False)
+
+    def register(self, signum: int, handler: Callable[[], None]) -> None:
+        self.__handlers[signum] = handler
+        signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum: int, frame) -> None:
         try:
-            while True:
-                conn, addr = self.__sock.accept()
-                self.handle(conn, addr)
-        except KeyboardInterrupt:
+            os.write(self.__write, bytes([signum]))
+        except OSError:
             pass
-        finally:
-            logger.info('Finalizando servidor...')
-            self.__sock.close()
 
+    def _watch(self) -> None:
+        while True:
+            try:
+                data = os.read(self.__read, 64)
+            except OSError:
+                return
+
+            if not data:
+                return
+
+            for signum in dict.fromkeys(data):
+                try:
+                    self.__handlers[signum]()
+                except Exception as e:
+                    logger.exception('Erro ao tratar o sinal %s: %s', signum, e)
+
+    def start(self) -> None:
+        threading.Thread(target=self._watch, name='signals', daemon=True).start()
+
+    def close(self) -> None:
+        for fd in (self.__write, self.__read):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class WorkerPool:
+    RESPAWN_DELAY = 1
+
+    def __init__(
+        self,
+        target: Callable[[int], None],
+        workers: int,
+        spawned: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        self.__target = target
+        self.__workers = workers
+        self.__spawned = spawned
+        self.__pids: Dict[int, Tuple[int, float]] = {}
+        self.__running = False
+        self.__signals: Optional[SignalWatcher] = None
 
-class HTTP(TCP):
-    def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        client = Client(conn, addr)
-        proxy = Proxy(client)
-        proxy.daemon = True
-        proxy.start()
+    @property
+    def pids(self) -> List[int]:
+        return list(self.__pids)
 
+    @property
+    def running(self) -> bool:
+        return self.__running
 
-class HTTPS(TCP):
-    def __init__(self, addr: Tuple[str, int], cert: str, backlog: int = 5) -> None:
-        super().__init__(addr, backlog)
-        self.__cert = cert
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+            if self.__signals is not None:
+                self.__signals.close()
+
+            code = 0
+            try:
+                self.__target(index)
+            except KeyboardInterrupt:
+                pass
+            except Exception as e:
+                logger.exception('Worker %s Erro: %s', index, e)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        self.__pids[pid] = (index, time.monotonic())
+        logger.info('Worker %s iniciado (pid %s)', index, pid)
+
+        if self.__spawned is not None:
+            self.__spawned(index)
+
+    def _forward(self, signum: int, frame) -> None:
+        self.broadcast(signum)
+
+    def broadcast(self, signum: int) -> None:
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def drain(self) -> None:
+        self.__running = False
+        self.broadcast(signal.SIGUSR2)
 
-    def handle_thread(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        conn = ssl.wrap_socket(
-            sock=conn,
-            keyfile=self.__cert,
-            certfile=self.__cert,
-            server_side=True,
-            ssl_version=ssl.PROTOCOL_TLSv1_2,
-        )
+        logger.info('Drenando workers...')
 
-        client = Client(conn, addr)
-        proxy = Proxy(client)
-        proxy.daemon = True
-        proxy.start()
+    def _wait(self, control: Optional[ControlSocket]) -> Tuple[int, int]:
+        while control is not None:
+            sock = control.sock
+            if sock is None:
+                break
 
-    def handle(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
-        thread = threading.Thread(target=self.handle_thread, args=(conn, addr))
-        thread.daemon = True
-        thread.start()
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                return pid, status
+
+            try:
+                r, _ = wait_sockets([sock], [], 1)
+                if r:
+                    control.accept()
+            except (OSError, ValueError):
+                continue
+
+        return os.wait()
+
+    def _stop(self, signum: int, frame) -> None:
+        self.__running = False
+
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self, control: Optional[ControlSocket] = None) -> None:
+        self.__running = True
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGHUP, self._stop)
+        signal.signal(signal.SIGUSR1, self._forward)
+
+        self.__signals = SignalWatcher()
+        self.__signals.register(signal.SIGUSR2, self.drain)
+        self.__signals.start()
+
+        for index in range(self.__workers):
+            self._spawn(index)
+
+        try:
+            while self.__pids:
+                try:
+                    pid, status = self._wait(control)
+                except ChildProcessError:
+                    break
+                except InterruptedError:
+                    continue
+
+                index, started_at = self.__pids.pop(pid, (None, 0))
+                if index is None or not self.__running:
+                    continue
+
+                logger.warning('Worker %s finalizado (pid %s, status %s)', index, pid, status)
+
+                if time.monotonic() - started_at < self.RESPAWN_DELAY:
+                    time.sleep(self.RESPAWN_DELAY)
+
+                self._spawn(index)
+        except KeyboardInterrupt:
+            self._stop(signal.SIGINT, None)
+        finally:
+            for pid in self.pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+            logger.info('Finalizando workers...')
 
 
 def main():
@@ -371,43 +3508,532 @@ def main():
 
     parser.add_argument('--host', default='0.0.0.0', help='Host')
     parser.add_argument('--port', type=int, default=80, help='Port')
+    parser.add_argument(
+        '--listen',
+        help='Listeners served by this process, e.g. "80/http, 8080/http, 443/https" '
+        '(overrides --port, --http and --https)',
+    )
     parser.add_argument('--backlog', type=int, default=5, help='Backlog')
     parser.add_argument('--openvpn-port', type=int, default=1194, help='OpenVPN Port')
     parser.add_argument('--ssh-port', type=int, default=22, help='SSH Port')
     parser.add_argument('--v2ray-port', type=int, default=1080, help='V2Ray Port')
 
+    parser.add_argument(
+        '--protocols',
+        help='JSON file with extra backends, signatures, SNI and WebSocket routes',
+    )
+    parser.add_argument(
+        '--accept-proxy',
+        action='store_true',
+        help='Require a PROXY protocol v1/v2 header from the load balancer on every connection',
+    )
+    parser.add_argument(
+        '--send-proxy',
+        action='append',
+        default=[],
+        metavar='BACKEND[:VERSION]',
+        help='Send a PROXY protocol header (v1 unless VERSION is 2) to this backend',
+    )
+    parser.add_argument(
+        '--websocket-frames',
+        action='store_true',
+        help='Complete WebSocket handshakes carrying Sec-WebSocket-Key and unwrap their frames',
+    )
+
     parser.add_argument('--cert', default='./cert.pem', help='Certificate')
 
+    parser.add_argument(
+        '--handshake-timeout',
+        type=float,
+        default=10,
+        help='Seconds a client has to complete the TLS handshake',
+    )
+
+    parser.add_argument(
+        '--cert-check-interval',
+        type=float,
+        default=30,
+        help='Seconds between certificate change checks (disabled if 0, SIGUSR1 reloads)',
+    )
+
+    parser.add_argument(
+        '--control-socket',
+        help='Unix control socket (default: %s, empty disables)' % (CONTROL_SOCKET % '<port>'),
+    )
+    parser.add_argument(
+        '--takeover',
+        action='store_true',
+        help='Inherit the listener of the running proxy on this port and let it drain',
+    )
+    parser.add_argument(
+        '--drain-timeout',
+        type=int,
+        default=0,
+        help='Seconds a replaced proxy waits for its tunnels before exiting (0 waits forever)',
+    )
+
     parser.add_argument('--http', action='store_true', help='HTTP')
     parser.add_argument('--https', action='store_true', help='HTTPS')
 
+    parser.add_argument(
+        '--engine',
+        default='thread',
+        choices=['thread', 'epoll'],
+        help='Engine (thread: one thread per connection, epoll: single event loop)',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='Worker processes, each with its own SO_REUSEPORT listener',
+    )
+
+    parser.add_argument(
+        '--high-watermark',
+        type=int,
+        default=Connection.HIGH_WATERMARK,
+        help='Stop reading from a peer when this many bytes are queued for the other side',
+    )
+    parser.add_argument(
+        '--low-watermark',
+        type=int,
+        default=Connection.LOW_WATERMARK,
+        help='Resume reading once the queue drains below this many bytes',
+    )
+    parser.add_argument(
+        '--no-splice',
+        action='store_true',
+        help='Disable the splice() zero-copy relay for plain tunnels',
+    )
+
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        default=0,
+        help='Pre-connected sockets kept per backend (disabled if 0)',
+    )
+    parser.add_argument(
+        '--pool-idle',
+        type=float,
+        default=30,
+        help='Seconds a pooled backend socket may stay idle before being replaced',
+    )
+
+    parser.add_argument(
+        '--idle-timeout',
+        type=int,
+        default=300,
+        help='Close tunnels without traffic for this many seconds (0 disables)',
+    )
+    parser.add_argument(
+        '--max-lifetime',
+        type=int,
+        default=0,
+        help='Close tunnels older than this many seconds (0 disables)',
+    )
+    parser.add_argument('--keepalive-idle', type=int, default=60, help='TCP_KEEPIDLE (0 disables)')
+    parser.add_argument('--keepalive-interval', type=int, default=10, help='TCP_KEEPINTVL')
+    parser.add_argument('--keepalive-count', type=int, default=6, help='TCP_KEEPCNT')
+
+    parser.add_argument(
+        '--limit-connections',
+        action='store_true',
+        help='Enforce users.connection_limit per SSH user / V2Ray UUID',
+    )
+    parser.add_argument(
+        '--limit-policy',
+        default='reject',
+        choices=['reject', 'evict-oldest'],
+        help='What to close when a user exceeds the limit',
+    )
+    parser.add_argument('--users-db', default=USERS_DATABASE, help='GLManager database')
+    parser.add_argument(
+        '--tunnel-rate',
+        type=float,
+        default=0,
+        help='Per tunnel speed limit in Mbit/s for each direction (0 disables)',
+    )
+    parser.add_argument(
+        '--user-rate',
+        type=float,
+        default=0,
+        help='Per user speed limit in Mbit/s for each direction (0 disables)',
+    )
+    parser.add_argument(
+        '--usage-interval',
+        type=int,
+        default=0,
+        help='Flush per user traffic to the usage table every N seconds (0 disables)',
+    )
+    parser.add_argument('--auth-log', default=AUTH_LOG, help='sshd authentication log')
+
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='Metrics host')
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='Prometheus metrics port (disabled if 0, one port per worker from here)',
+    )
+
     parser.add_argument('--log', default='INFO', help='Log level')
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'], help='Log format')
+    parser.add_argument(
+        '--log-rate',
+        type=float,
+        default=50,
+        help='Records per second kept for each log message, excess is dropped (0 disables)',
+    )
+    parser.add_argument(
+        '--log-queue',
+        type=int,
+        default=10000,
+        help='Records buffered for the background log writer (0 writes synchronously)',
+    )
     parser.add_argument('--usage', action='store_true', help='Usage')
 
     args = parser.parse_args()
 
-    REMOTES_ADDRESS['openvpn'] = (args.host, args.openvpn_port)
-    REMOTES_ADDRESS['ssh'] = (args.host, args.ssh_port)
-    REMOTES_ADDRESS['v2ray'] = (args.host, args.v2ray_port)
+    set_nofile_limit()
 
-    if args.http:
-        server = HTTP((args.host, args.port), args.backlog)
+    if args.no_splice:
+        Tunnel.splice = False
 
-    elif args.https:
-        if not os.path.exists(args.cert):
-            parser.error('Certificate %s not found' % args.cert)
+    if args.low_watermark > args.high_watermark:
+        parser.error('Low watermark must not exceed high watermark')
 
-        server = HTTPS((args.host, args.port), args.cert, args.backlog)
+    Connection.HIGH_WATERMARK = args.high_watermark
+    Connection.LOW_WATERMARK = args.low_watermark
+
+    if args.keepalive_idle > 0:
+        Tunnel.keepalive = (args.keepalive_idle, args.keepalive_interval, args.keepalive_count)
+
+    backends = {
+        RemoteTypes.OPENVPN.value: (args.host, args.openvpn_port),
+        RemoteTypes.SSH.value: (args.host, args.ssh_port),
+        RemoteTypes.V2RAY.value: (args.host, args.v2ray_port),
+    }
+
+    try:
+        if args.protocols:
+            protocols = ProtocolTable.load(args.protocols, backends)
+        else:
+            protocols = ProtocolTable.of(backends)
+    except (OSError, ValueError, KeyError) as e:
+        parser.error('Invalid protocols file %s: %s' % (args.protocols, e))
+
+    if args.websocket_frames:
+        protocols.websocket_frames = True
+
+    for value in args.send_proxy:
+        backend, _, version = value.partition(':')
+
+        try:
+            protocols.add_proxy_protocol(backend, int(version or 1))
+        except ValueError as e:
+            parser.error('Invalid --send-proxy %s: %s' % (value, e))
+
+    if args.listen:
+        try:
+            listeners = parse_listeners(args.listen)
+        except ValueError as e:
+            parser.error('Invalid listeners %s: %s' % (args.listen, e))
     else:
-        server = HTTP((args.host, args.port), args.backlog)
+        listeners = [(args.port, 'https' if args.https and not args.http else 'http')]
+
+    https = any(mode == 'https' for _, mode in listeners)
+
+    if https and not os.path.exists(args.cert):
+        parser.error('Certificate %s not found' % args.cert)
 
-    logging.basicConfig(
-        level=getattr(logging, args.log.upper()),
-        format='[%(asctime)s] %(levelname)s: %(message)s',
-        datefmt='%H:%M:%S',
+    if args.workers < 1:
+        parser.error('Workers must be greater than 0')
+
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('SO_REUSEPORT is not supported on this platform')
+
+    setup_logging(
+        getattr(logging, args.log.upper()),
+        args.log_format == 'json',
+        args.log_rate,
+        args.log_queue,
     )
 
-    server.run()
+    TCP.drain_timeout = args.drain_timeout
+    TCP.proxy_protocol = args.accept_proxy
+    TCP.proxy_timeout = args.handshake_timeout
+
+    control_path = args.control_socket
+    if control_path is None:
+        control_path = CONTROL_SOCKET % listeners[0][0]
+
+    inherited = {}
+    handoff = None
+    reuse_port = args.workers > 1
+
+    if args.takeover and control_path:
+        try:
+            handoff = ControlClient(control_path)
+            response, fds = handoff.call('takeover')
+        except (OSError, ValueError) as e:
+            logger.warning('Nenhum proxy para substituir em %s: %s', control_path, e)
+            handoff = None
+        else:
+            for fd in fds:
+                sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+                inherited[sock.getsockname()[1]] = sock
+                os.close(fd)
+
+            reuse_port = reuse_port or response.get('reuse_port', False)
+
+    control = None
+    if control_path:
+        control = ControlSocket(control_path)
+
+        try:
+            control.bind()
+        except OSError as e:
+            logger.warning('Socket de controle %s indisponível: %s', control_path, e)
+            control = None
+
+    started_at = time.time()
+
+    def describe() -> dict:
+        return {
+            'pid': os.getpid(),
+            'version': __version__,
+            'listeners': [{'port': port, 'mode': mode} for port, mode in listeners],
+            'engine': args.engine,
+            'workers': args.workers,
+            'started_at': started_at,
+            'backends': {name: list(addr) for name, addr in protocols.backends.items()},
+        }
+
+    def set_backend(request: dict) -> dict:
+        name = request.get('backend')
+        port = request.get('port')
+
+        if name not in protocols.backends:
+            return {'error': 'Backend %s não configurado' % name}
+
+        if not isinstance(port, int) or not 0 < port < 65536:
+            return {'error': 'Porta inválida: %s' % port}
+
+        old = protocols.backends[name]
+        addr = (request.get('host') or old[0], port)
+        protocols.backends[name] = addr
+
+        pool = Tunnel.pools.pop(old, None)
+        if pool is not None:
+            pool.close()
+
+            pool = ServerPool(name, addr, args.pool_size, args.pool_idle)
+            Tunnel.pools[addr] = pool
+            pool.start()
+
+        logger.info('Backend %s alterado para %s:%s', name, *addr)
+        return {'backend': name, 'address': list(addr)}
+
+    def serve_control(control: ControlSocket, server: Listeners) -> None:
+        def status(request: dict) -> dict:
+            return dict(describe(), accepting=server.accepting, **tunnel_stats())
+
+        def drain(request: dict) -> dict:
+            server.stop_accepting()
+            return {'ok': True}
+
+        def reload_cert(request: dict) -> dict:
+            if not server.https:
+                return {'error': 'Servidor sem certificado'}
+
+            return {'ok': server.reload_cert()}
+
+        control.command('status', status)
+        control.command('set-backend', set_backend)
+        control.command('drain', drain)
+        control.command('reload-cert', reload_cert)
+        control.start()
+
+    def serve(index: int = 0) -> None:
+        loop = EventLoop() if args.engine == 'epoll' else None
+
+        if args.metrics_port:
+            MetricsServer((args.metrics_host, args.metrics_port + index), MetricsHandler).start()
+
+        if args.idle_timeout > 0 or args.max_lifetime > 0:
+            Tunnel.reaper = Reaper(args.idle_timeout, args.max_lifetime)
+            Tunnel.reaper.start(loop)
+
+        if args.tunnel_rate > 0 or args.user_rate > 0:
+            Tunnel.shaper = TrafficShaper(args.tunnel_rate * 125000, args.user_rate * 125000)
+
+        if args.usage_interval > 0:
+            Tunnel.usage = UsageRecorder(args.users_db, args.usage_interval)
+            Tunnel.usage.start()
+
+        if args.limit_connections or args.user_rate > 0 or args.usage_interval > 0:
+            Tunnel.limiter = ConnectionLimiter(
+                args.users_db,
+                evict_oldest=args.limit_policy == 'evict-oldest',
+                enforce=args.limit_connections,
+            )
+
+            try:
+                Tunnel.limiter.start(args.auth_log)
+            except sqlite3.Error as e:
+                logger.error('Falha ao carregar usuarios de %s: %s', args.users_db, e)
+                return
+
+        if args.pool_size > 0:
+            for name, addr in protocols.backends.items():
+                pool = ServerPool(name, addr, args.pool_size, args.pool_idle)
+                Tunnel.pools[addr] = pool
+                pool.start()
+
+        servers = []
+
+        for port, mode in listeners:
+            sock = inherited.pop(port, None)
+
+            if mode == 'https':
+                https_server = HTTPS(
+                    (args.host, port),
+                    args.cert,
+                    args.backlog,
+                    loop,
+                    reuse_port,
+                    args.handshake_timeout,
+                    protocols,
+                    sock,
+                )
+
+                if args.cert_check_interval > 0:
+                    https_server.watch_cert(args.cert_check_interval)
+
+                servers.append(https_server)
+            else:
+                servers.append(
+                    HTTP((args.host, port), args.backlog, loop, reuse_port, protocols, sock)
+                )
+
+        for sock in inherited.values():
+            sock.close()
+
+        server = Listeners(servers, loop)
+        server.listen()
+
+        signals = SignalWatcher()
+        signals.register(signal.SIGUSR1, server.reload_cert)
+        signals.register(signal.SIGUSR2, server.stop_accepting)
+        signals.start()
+
+        if handoff is not None and index == 0:
+            try:
+                handoff.call('ready')
+            except (OSError, ValueError) as e:
+                logger.warning('Proxy anterior sem resposta: %s', e)
+            else:
+                logger.info('Proxy anterior em drenagem')
+            finally:
+                handoff.close()
+
+        local_control = None
+
+        if control is not None and args.workers == 1:
+            local_control = control
+
+            def ready(request: dict) -> dict:
+                server.stop_accepting()
+                control.close()
+                return {'ok': True}
+
+            def takeover(request: dict) -> dict:
+                return {'fds': [listener.sock.fileno() for listener in server.servers]}
+
+            control.command('takeover', takeover)
+            control.command('ready', ready)
+            serve_control(control, server)
+        elif control is not None:
+            worker_control = ControlSocket('%s.%s' % (control.path, index))
+
+            try:
+                worker_control.bind()
+            except OSError as e:
+                logger.warning('Socket de controle %s indisponível: %s', worker_control.path, e)
+            else:
+                local_control = worker_control
+                serve_control(worker_control, server)
+
+        try:
+            server.run()
+        finally:
+            if local_control is not None:
+                local_control.close()
+
+    if args.workers > 1:
+
+        def spawned(index: int) -> None:
+            nonlocal handoff
+
+            if handoff is not None and index == 0:
+                handoff.close()
+                handoff = None
+
+        pool = WorkerPool(serve, args.workers, spawned)
+
+        if control is not None:
+
+            def workers(command: str, **params) -> List[dict]:
+                results = []
+
+                for index in range(args.workers):
+                    try:
+                        with ControlClient('%s.%s' % (control.path, index), 5) as client:
+                            results.append(client.call(command, **params)[0])
+                    except (OSError, ValueError) as e:
+                        logger.warning('Worker %s sem resposta: %s', index, e)
+
+                return results
+
+            def ready(request: dict) -> dict:
+                pool.drain()
+                control.close()
+                return {'ok': True}
+
+            def status(request: dict) -> dict:
+                stats = merge_tunnel_stats(workers('status'))
+                return dict(describe(), accepting=pool.running, **stats)
+
+            def set_workers_backend(request: dict) -> dict:
+                response = set_backend(request)
+
+                if 'error' not in response:
+                    params = {key: request.get(key) for key in ('backend', 'host', 'port')}
+                    workers('set-backend', **params)
+
+                return response
+
+            def drain(request: dict) -> dict:
+                pool.drain()
+                return {'ok': True}
+
+            def reload_cert(request: dict) -> dict:
+                pool.broadcast(signal.SIGUSR1)
+                return {'ok': True}
+
+            control.command('takeover', lambda request: {'fds': [], 'reuse_port': True})
+            control.command('ready', ready)
+            control.command('status', status)
+            control.command('set-backend', set_workers_backend)
+            control.command('drain', drain)
+            control.command('reload-cert', reload_cert)
+
+        try:
+            pool.run(control)
+        finally:
+            if control is not None:
+                control.close()
+    else:
+        serve()
 
 
 if __name__ == '__main__':
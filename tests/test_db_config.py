@@ -0,0 +1,130 @@
+import datetime
+import json
+import multiprocessing
+import threading
+
+import pytest
+
+from app.data.config import Base, DBConnection
+from app.data.config.db_config import sqlite_pragmas
+from app.domain.entities import User
+
+
+@pytest.fixture
+def uri(tmp_path):
+    uri = 'sqlite:///' + str(tmp_path / 'db.sqlite3')
+    Base.metadata.create_all(DBConnection(uri).engine)
+
+    yield uri
+
+    DBConnection.dispose(uri)
+
+
+def make_user(username: str) -> User:
+    return User(
+        username=username,
+        password='test',
+        connection_limit=1,
+        expiration_date=datetime.datetime.now() + datetime.timedelta(days=30),
+    )
+
+
+def test_engine_is_shared_per_uri(uri):
+    assert DBConnection(uri).engine is DBConnection(uri).engine
+    assert DBConnection(uri).engine is not DBConnection('sqlite://').engine
+
+    DBConnection.dispose('sqlite://')
+
+
+def test_nested_connections_share_the_session(uri):
+    with DBConnection(uri) as outer:
+        with DBConnection(uri) as inner:
+            assert inner.session is outer.session
+
+        outer.session.add(make_user('nested'))
+        outer.session.commit()
+
+    with DBConnection(uri) as db:
+        assert db.session is not outer.session
+        assert db.session.query(User).filter(User.username == 'nested').count() == 1
+
+
+def test_unit_of_work_rolls_back_on_error(uri):
+    with DBConnection.unit_of_work(uri) as session:
+        session.add(make_user('kept'))
+
+    with pytest.raises(RuntimeError):
+        with DBConnection.unit_of_work(uri) as session:
+            session.add(make_user('discarded'))
+            raise RuntimeError()
+
+    with DBConnection(uri) as db:
+        usernames = [user.username for user in db.session.query(User).all()]
+
+    assert usernames == ['kept']
+
+
+def test_threads_get_their_own_session(uri):
+    sessions = []
+
+    def run():
+        with DBConnection(uri) as db:
+            sessions.append(db.session)
+
+    with DBConnection(uri) as db:
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+        assert sessions[0] is not db.session
+
+
+def test_sqlite_pragmas_are_applied(uri):
+    with DBConnection(uri).engine.connect() as connection:
+        pragma = lambda name: connection.exec_driver_sql('PRAGMA %s' % name).scalar()
+
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == 1
+        assert pragma('busy_timeout') == 10000
+
+
+def test_sqlite_pragmas_are_configurable(tmp_path):
+    path = tmp_path / 'sqlite.json'
+    path.write_text(json.dumps({'synchronous': 'FULL', 'mmap_size': None}))
+
+    pragmas = sqlite_pragmas(str(path))
+
+    assert pragmas['synchronous'] == 'FULL'
+    assert pragmas['journal_mode'] == 'WAL'
+    assert 'mmap_size' not in pragmas
+
+    path.write_text(json.dumps({'journal_mode': 'WAL; DROP TABLE users'}))
+
+    with pytest.raises(ValueError):
+        sqlite_pragmas(str(path))
+
+
+def stress(uri: str, worker: int, count: int) -> None:
+    for index in range(count):
+        with DBConnection.unit_of_work(uri) as session:
+            session.add(make_user('user-%s-%s' % (worker, index)))
+
+        with DBConnection(uri) as db:
+            db.session.query(User).filter(User.username.like('user-%s-%%' % worker)).count()
+            db.session.query(User).all()
+
+
+def test_concurrent_processes_do_not_lock(uri):
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=stress, args=(uri, worker, 50)) for worker in range(6)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join(60)
+
+    assert [process.exitcode for process in processes] == [0] * len(processes)
+
+    with DBConnection(uri) as db:
+        assert db.session.query(User).count() == 6 * 50
@@ -0,0 +1,89 @@
+import pytest
+
+from sqlalchemy import inspect
+
+from app.data.config import DBConnection, Migrator, migrate
+
+
+@pytest.fixture
+def uri(tmp_path):
+    uri = 'sqlite:///' + str(tmp_path / 'db.sqlite3')
+
+    yield uri
+
+    DBConnection.dispose(uri)
+
+
+@pytest.fixture
+def scripts(tmp_path, monkeypatch):
+    package = tmp_path / 'scripts_migrations'
+    package.mkdir()
+    (package / '__init__.py').write_text('')
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    yield package
+
+
+def indexes(uri: str, table: str) -> set:
+    return set(index['name'] for index in inspect(DBConnection(uri).engine).get_indexes(table))
+
+
+def test_migrate_creates_schema_and_indexes(uri):
+    assert [migration.version for migration in migrate(uri=uri)] == [1, 2, 3]
+    assert 'ix_users_expiration_date' in indexes(uri, 'users')
+    assert inspect(DBConnection(uri).engine).has_table('usage')
+
+    assert migrate(uri=uri) == []
+    assert Migrator('app.data.migrations', uri).pending() == []
+
+
+def test_migrate_upgrades_legacy_database(uri):
+    engine = DBConnection(uri).engine
+
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            'CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(50) NOT NULL UNIQUE, '
+            'password VARCHAR(50) NOT NULL, connection_limit INTEGER NOT NULL, '
+            'expiration_date DATETIME NOT NULL, v2ray_uuid VARCHAR(50) UNIQUE, '
+            'created_at DATETIME, updated_at DATETIME)'
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO users (username, password, connection_limit, expiration_date) "
+            "VALUES ('legacy', 'test', 1, '2030-01-01 00:00:00')"
+        )
+
+    migrate(uri=uri)
+
+    assert 'ix_users_expiration_date' in indexes(uri, 'users')
+
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql('SELECT username FROM users').scalar() == 'legacy'
+
+
+def test_migrate_dealer_schema(uri):
+    pytest.importorskip('telebot')
+
+    migrate('bot.dealer.migrations', uri)
+
+    assert 'ix_accounts_dealer_id' in indexes(uri, 'accounts')
+    assert 'ix_dealers_username' in indexes(uri, 'dealers')
+
+
+def test_failed_migration_is_rolled_back(uri, scripts):
+    (scripts / '0001_table.py').write_text(
+        'def upgrade(connection):\n'
+        '    connection.exec_driver_sql("CREATE TABLE items (id INTEGER PRIMARY KEY)")\n'
+    )
+    (scripts / '0002_broken.py').write_text(
+        'def upgrade(connection):\n'
+        '    connection.exec_driver_sql("CREATE INDEX ix_items_id ON items (id)")\n'
+        '    connection.exec_driver_sql("ALTER TABLE missing ADD COLUMN name TEXT")\n'
+    )
+
+    with pytest.raises(Exception):
+        migrate('scripts_migrations', uri)
+
+    migrator = Migrator('scripts_migrations', uri)
+    assert migrator.applied() == {1}
+    assert [migration.version for migration in migrator.pending()] == [2]
+    assert indexes(uri, 'items') == set()
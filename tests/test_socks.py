@@ -0,0 +1,1298 @@
+import base64
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import re
+import select
+import signal
+import socket
+import sqlite3
+import ssl
+import subprocess
+import sys
+import urllib.request
+import threading
+import time
+import uuid
+
+import pytest
+
+from sqlalchemy import create_engine
+
+from scripts import CERT_PATH, SOCKS_PATH, socks
+from scripts.socks import (
+    DEFAULT_RESPONSE,
+    Connection,
+    ConnectionLimiter,
+    ControlClient,
+    ControlSocket,
+    EventLoop,
+    HandshakeParser,
+    HandshakeState,
+    HTTP,
+    HTTPS,
+    JsonFormatter,
+    Listeners,
+    LogQueueHandler,
+    LogSampler,
+    MetricsHandler,
+    MetricsServer,
+    ParserType,
+    ProtocolTable,
+    ProxyHeader,
+    ProxyHeaderReader,
+    Reaper,
+    RemoteTypes,
+    ServerPool,
+    SignalWatcher,
+    TCP,
+    TimerWheel,
+    TokenBucket,
+    TrafficShaper,
+    Tunnel,
+    UsageRecorder,
+    WebSocketCodec,
+    WorkerPool,
+    parse_listeners,
+)
+
+
+def free_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_port(port: int, timeout: float = 5) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise TimeoutError('port %s not listening' % port)
+
+
+def recv_exactly(conn: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+@pytest.fixture
+def echo_backend():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    yield listener.getsockname()
+    listener.close()
+
+
+@pytest.fixture
+def protocols(echo_backend):
+    return ProtocolTable.of(dict(socks.REMOTES_ADDRESS, ssh=echo_backend))
+
+
+@pytest.fixture(params=['thread', 'epoll'])
+def proxy_port(request, protocols):
+    port = free_port()
+    loop = EventLoop() if request.param == 'epoll' else None
+    server = HTTP(('127.0.0.1', port), 128, loop, protocols=protocols)
+
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_port(port)
+
+    yield port
+
+    if loop is not None:
+        loop.stop()
+
+
+@pytest.fixture(params=['thread', 'epoll'])
+def tls_proxy_port(request, protocols):
+    port = free_port()
+    loop = EventLoop() if request.param == 'epoll' else None
+    server = HTTPS(
+        ('127.0.0.1', port),
+        CERT_PATH,
+        128,
+        loop,
+        handshake_timeout=0.5,
+        protocols=protocols,
+    )
+
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_port(port)
+
+    yield port
+
+    if loop is not None:
+        loop.stop()
+
+
+def client_context() -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def test_proxy_routes_ssh_banner_to_backend(proxy_port):
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(b'SSH-2.0-test\r\n')
+        assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+
+def test_proxy_answers_http_payload_then_relays(proxy_port):
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(b'GET / HTTP/1.1\r\nHost: example.com\r\nUpgrade: websocket\r\n\r\n')
+        assert recv_exactly(conn, len(DEFAULT_RESPONSE)) == DEFAULT_RESPONSE
+
+        payload = b'SSH-2.0-test\r\n' + b'x' * 200000
+        threading.Thread(target=conn.sendall, args=(payload,), daemon=True).start()
+        assert recv_exactly(conn, len(payload)) == payload
+
+
+def test_proxy_relays_without_splice(proxy_port, monkeypatch):
+    monkeypatch.setattr(Tunnel, 'splice', False)
+    monkeypatch.setattr(Connection, 'HIGH_WATERMARK', 16384)
+    monkeypatch.setattr(Connection, 'LOW_WATERMARK', 4096)
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        payload = b'SSH-2.0-test\r\n' + b'x' * 200000
+        threading.Thread(target=conn.sendall, args=(payload,), daemon=True).start()
+        assert recv_exactly(conn, len(payload)) == payload
+
+
+def test_proxy_routes_payload_and_banner_in_one_segment(proxy_port):
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\nSSH-2.0-test\r\n')
+        expected = DEFAULT_RESPONSE + b'SSH-2.0-test\r\n'
+        assert recv_exactly(conn, len(expected)) == expected
+
+
+def test_handshake_parser_waits_for_split_banner():
+    parser_type = ParserType()
+    parser = HandshakeParser(parser_type)
+
+    parser.feed(b'SS')
+    assert parser.next() == (HandshakeState.NEED_MORE, None)
+
+    parser.feed(b'H-2.0-test\r\n')
+    assert parser.next() == (HandshakeState.ROUTE, b'SSH-2.0-test\r\n')
+    assert parser_type.type is RemoteTypes.SSH
+
+
+def test_handshake_parser_consumes_split_http_head():
+    parser_type = ParserType()
+    parser = HandshakeParser(parser_type)
+
+    parser.feed(b'GET / HTTP/1.1\r\nHost: exa')
+    assert parser.next() == (HandshakeState.NEED_MORE, None)
+
+    parser.feed(b'mple.com\r\n\r\n\x00')
+    assert parser.next() == (HandshakeState.HTTP, b'GET / HTTP/1.1\r\nHost: example.com')
+    assert parser.next() == (HandshakeState.NEED_MORE, None)
+
+    parser.feed(b'\x01\x02')
+    assert parser.next() == (HandshakeState.ROUTE, b'\x00\x01\x02')
+    assert parser_type.type is RemoteTypes.V2RAY
+
+
+def test_handshake_parser_rejects_oversized_head(monkeypatch):
+    monkeypatch.setattr(HandshakeParser, 'MAX_HEADER_SIZE', 64)
+    parser = HandshakeParser(ParserType())
+
+    parser.feed(b'GET / HTTP/1.1\r\n' + b'X-Pad: a\r\n' * 10)
+    assert parser.next() == (HandshakeState.INVALID, None)
+
+
+def client_hello(server_name: str) -> bytes:
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    conn = client_context().wrap_bio(incoming, outgoing, server_hostname=server_name)
+
+    with pytest.raises(ssl.SSLWantReadError):
+        conn.do_handshake()
+
+    return outgoing.read()
+
+
+def test_protocol_table_prefers_longest_prefix():
+    table = ProtocolTable.of()
+
+    assert table.match(b'\x00') == (None, True)
+    assert table.match(b'\x0068\x01') == ('openvpn', False)
+    assert table.match(b'\x00\x01') == ('v2ray', False)
+    assert table.match(b'GET / HTTP/1.1') == (None, False)
+
+
+def test_protocol_table_load(tmp_path):
+    path = tmp_path / 'protocols.json'
+    path.write_text(
+        json.dumps(
+            {
+                'backends': {'tls': '127.0.0.1:8443', 'ws': 10000},
+                'signatures': [{'hex': '000e38', 'backend': 'openvpn'}],
+                'sni': {'VPN.example.com': 'tls'},
+                'websocket': 'ws',
+                'default': 'v2ray',
+            }
+        )
+    )
+
+    table = ProtocolTable.load(str(path), {'openvpn': ('127.0.0.1', 1194), 'v2ray': ('127.0.0.1', 1080)})
+
+    assert table.backends['ws'] == ('0.0.0.0', 10000)
+    assert table.match(b'\x00\x0e\x38\x01') == ('openvpn', False)
+
+    hello = client_hello('vpn.example.com')
+    assert table.match(hello[:10]) == (None, True)
+    assert table.match(hello) == ('tls', False)
+    assert table.match(client_hello('other.example.com')) == (None, False)
+
+    parser_type = ParserType(table)
+    parser = HandshakeParser(parser_type)
+    parser.feed(b'GET / HTTP/1.1\r\nUpgrade: websocket\r\n\r\n')
+    assert parser.next() == (HandshakeState.ROUTE, b'GET / HTTP/1.1\r\nUpgrade: websocket\r\n\r\n')
+    assert parser_type.backend == 'ws'
+
+    parser_type = ParserType(table)
+    parser = HandshakeParser(parser_type)
+    parser.feed(b'\x8a\x01\x02\x03')
+    assert parser.next()[0] is HandshakeState.ROUTE
+    assert parser_type.type is RemoteTypes.V2RAY
+
+
+def test_reuse_port_listeners_share_port(protocols):
+    port = free_port()
+    loops = [EventLoop(), EventLoop()]
+
+    for loop in loops:
+        server = HTTP(('127.0.0.1', port), 128, loop, reuse_port=True, protocols=protocols)
+        threading.Thread(target=server.run, daemon=True).start()
+
+    wait_port(port)
+
+    for _ in range(4):
+        with socket.create_connection(('127.0.0.1', port), 5) as conn:
+            conn.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+    for loop in loops:
+        loop.stop()
+
+
+def test_connection_queue_watermarks(monkeypatch):
+    monkeypatch.setattr(Connection, 'HIGH_WATERMARK', 1000)
+    monkeypatch.setattr(Connection, 'LOW_WATERMARK', 100)
+
+    left, right = socket.socketpair()
+    connection = Connection(left, ('127.0.0.1', 0))
+
+    for i in range(10):
+        connection.queue(bytes([i]) * 150)
+
+    assert connection.pending == 1500
+    assert connection.congested
+
+    received = b''
+    while connection.pending:
+        connection.flush()
+        received += right.recv(65536)
+
+    assert not connection.congested
+    assert received == b''.join(bytes([i]) * 150 for i in range(10))
+
+    left.close()
+    right.close()
+
+
+def test_metrics_endpoint_reports_tunnels(proxy_port):
+    metrics_server = MetricsServer(('127.0.0.1', 0), MetricsHandler)
+    metrics_server.start()
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(b'SSH-2.0-test\r\n')
+        assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+        url = 'http://127.0.0.1:%s/metrics' % metrics_server.server_address[1]
+        body = urllib.request.urlopen(url, timeout=5).read().decode()
+
+    metrics_server.shutdown()
+    metrics_server.server_close()
+
+    assert re.search(r'socks_tunnels_active\{remote="ssh"\} [1-9]', body)
+    assert 'socks_upstream_connect_seconds_count{remote="ssh"}' in body
+    assert 'socks_bytes_received_total{side="client"}' in body
+    assert 'socks_queue_bytes{side="client"}' in body
+
+
+def test_server_pool_hands_out_live_connections(echo_backend):
+    pool = ServerPool('ssh', echo_backend, size=2, max_idle=30, interval=0.05)
+    pool.start()
+
+    deadline = time.time() + 5
+    while len(pool) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    conn = pool.acquire()
+    assert conn is not None
+
+    conn.sendall(b'ping')
+    assert recv_exactly(conn, 4) == b'ping'
+    conn.close()
+
+    pool.close()
+    assert len(pool) == 0
+    assert pool.acquire() is None
+
+
+def test_server_pool_detects_closed_peer():
+    left, right = socket.socketpair()
+    assert ServerPool.is_alive(left)
+
+    right.sendall(b'SSH-2.0-banner\r\n')
+    assert ServerPool.is_alive(left)
+
+    right.close()
+    left.recv(64)
+    assert not ServerPool.is_alive(left)
+    left.close()
+
+
+def test_tls_proxy_routes_ssh_banner(tls_proxy_port):
+    context = client_context()
+
+    with socket.create_connection(('127.0.0.1', tls_proxy_port), 5) as sock:
+        with context.wrap_socket(sock) as conn:
+            conn.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+
+def test_tls_proxy_relays_full_records(tls_proxy_port):
+    context = client_context()
+    data = b'SSH-2.0-test\r\n' + b'x' * (65536 - 14)
+
+    with socket.create_connection(('127.0.0.1', tls_proxy_port), 5) as sock:
+        with context.wrap_socket(sock) as conn:
+            conn.sendall(data)
+            assert recv_exactly(conn, len(data)) == data
+
+
+def test_tls_proxy_resumes_sessions(tls_proxy_port):
+    context = client_context()
+    context.options |= ssl.OP_NO_TLSv1_3
+
+    with socket.create_connection(('127.0.0.1', tls_proxy_port), 5) as sock:
+        with context.wrap_socket(sock) as conn:
+            session = conn.session
+
+    with socket.create_connection(('127.0.0.1', tls_proxy_port), 5) as sock:
+        with context.wrap_socket(sock, session=session) as conn:
+            assert conn.session_reused
+
+
+def test_tls_proxy_drops_stalled_handshake(tls_proxy_port):
+    with socket.create_connection(('127.0.0.1', tls_proxy_port), 5) as conn:
+        conn.settimeout(5)
+        assert conn.recv(1024) == b''
+
+
+def test_https_reload_cert_keeps_context(tmp_path):
+    cert = tmp_path / 'cert.pem'
+    cert.write_bytes(open(CERT_PATH, 'rb').read())
+
+    server = HTTPS(('127.0.0.1', free_port()), str(cert))
+    context = server.context
+
+    cert.write_text('invalid')
+    assert not server.reload_cert()
+
+    cert.write_bytes(open(CERT_PATH, 'rb').read())
+    assert server.reload_cert()
+    assert server.context is context
+
+
+def test_https_check_cert_retries_failed_reload(tmp_path, monkeypatch):
+    cert = tmp_path / 'cert.pem'
+    cert.write_bytes(open(CERT_PATH, 'rb').read())
+
+    server = HTTPS(('127.0.0.1', free_port()), str(cert))
+    reload_cert = server.reload_cert
+    results = []
+    monkeypatch.setattr(server, 'reload_cert', lambda: results.append(reload_cert()))
+
+    cert.write_text('invalid')
+    os.utime(str(cert), (1, 1))
+    server.check_cert()
+    server.check_cert()
+    assert results == [False, False]
+
+    cert.write_bytes(open(CERT_PATH, 'rb').read())
+    os.utime(str(cert), (1, 1))
+    server.check_cert()
+    server.check_cert()
+    assert results == [False, False, True]
+
+
+USER_UUID = uuid.UUID('5b2d0c5e-6c43-4d2e-9a4e-1a8d2f8b3c7e')
+
+
+@pytest.fixture
+def limiter(tmp_path, monkeypatch):
+    database = tmp_path / 'db.sqlite3'
+
+    conn = sqlite3.connect(str(database))
+    conn.execute(
+        'CREATE TABLE users (username TEXT, password TEXT, '
+        'connection_limit INTEGER, v2ray_uuid TEXT)'
+    )
+    conn.execute("INSERT INTO users VALUES ('alice', '', 1, ?)", (str(USER_UUID),))
+    conn.commit()
+    conn.close()
+
+    limiter = ConnectionLimiter(str(database))
+    limiter.load()
+
+    monkeypatch.setattr(Tunnel, 'limiter', limiter)
+    return limiter
+
+
+def wait_for(predicate, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def v2ray_proxy_port(echo_backend):
+    protocols = ProtocolTable.of({RemoteTypes.V2RAY.value: echo_backend})
+
+    port = free_port()
+    server = HTTP(('127.0.0.1', port), 128, protocols=protocols)
+
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_port(port)
+
+    return port
+
+
+def test_limiter_rejects_extra_vless_session(limiter, v2ray_proxy_port):
+    request = b'\x00' + USER_UUID.bytes + b'\x00\x01'
+
+    with socket.create_connection(('127.0.0.1', v2ray_proxy_port), 5) as first:
+        first.sendall(request)
+        assert recv_exactly(first, len(request)) == request
+        assert len(limiter) == 1
+
+        with socket.create_connection(('127.0.0.1', v2ray_proxy_port), 5) as second:
+            second.settimeout(5)
+            second.sendall(request)
+            assert second.recv(1024) == b''
+
+        first.sendall(b'ping')
+        assert recv_exactly(first, 4) == b'ping'
+
+    wait_for(lambda: len(limiter) == 0)
+
+
+def test_limiter_evicts_oldest_ssh_session(limiter, proxy_port):
+    limiter.evict_oldest = True
+
+    def login(conn):
+        conn.sendall(b'SSH-2.0-test\r\n')
+        assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+        tunnel = next(t for t in Tunnel.active() if t.identity_port and t.identity is None)
+        limiter.on_login('alice', tunnel.identity_port)
+        assert tunnel.identity == 'alice'
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as first:
+        login(first)
+
+        with socket.create_connection(('127.0.0.1', proxy_port), 5) as second:
+            login(second)
+
+            first.settimeout(5)
+            assert first.recv(1024) == b''
+
+            second.sendall(b'ping')
+            assert recv_exactly(second, 4) == b'ping'
+            assert len(limiter) == 1
+
+    wait_for(lambda: len(limiter) == 0)
+
+
+def test_limiter_rejects_zero_limit_when_evicting(limiter, proxy_port):
+    conn = sqlite3.connect(limiter.database)
+    conn.execute("UPDATE users SET connection_limit = 0 WHERE username = 'alice'")
+    conn.commit()
+    conn.close()
+
+    limiter.load()
+    limiter.evict_oldest = True
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(b'SSH-2.0-test\r\n')
+        assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+        tunnel = next(t for t in Tunnel.active() if t.identity_port and t.identity is None)
+        limiter.on_login('alice', tunnel.identity_port)
+
+        conn.settimeout(5)
+        assert conn.recv(1024) == b''
+        assert len(limiter) == 0
+
+
+def test_timer_wheel_expires_in_bulk():
+    wheel = TimerWheel(slots=8, resolution=1)
+    now = time.monotonic()
+
+    wheel.schedule('a', now + 1)
+    wheel.schedule('b', now + 1)
+    wheel.schedule('c', now + 3)
+    wheel.schedule('d', now + 100)
+    wheel.cancel('b')
+
+    assert len(wheel) == 3
+    assert wheel.advance(now + 0.5) == []
+    assert wheel.advance(now + 2.5) == ['a']
+    assert wheel.advance(now + 4.5) == ['c']
+    assert sorted(wheel.advance(now + 8)) == ['d']
+    assert len(wheel) == 0
+
+
+def test_reaper_closes_idle_tunnel(proxy_port, monkeypatch):
+    reaper = Reaper(idle_timeout=0.3, resolution=0.1)
+    monkeypatch.setattr(Tunnel, 'reaper', reaper)
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as idle:
+        with socket.create_connection(('127.0.0.1', proxy_port), 5) as active:
+            active.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(active, 14) == b'SSH-2.0-test\r\n'
+
+            wait_for(lambda: len(reaper.wheel) == 2)
+            deadline = time.monotonic() + 0.6
+
+            while time.monotonic() < deadline:
+                active.sendall(b'ping')
+                assert recv_exactly(active, 4) == b'ping'
+                reaper.reap()
+                time.sleep(0.05)
+
+            idle.settimeout(5)
+            assert idle.recv(1024) == b''
+
+            active.sendall(b'ping')
+            assert recv_exactly(active, 4) == b'ping'
+
+
+def test_token_bucket_delays_after_burst():
+    bucket = TokenBucket(1000, 500)
+
+    assert bucket.delay() == 0
+    bucket.consume(1500)
+    assert 0.9 < bucket.delay() <= 1
+
+
+def test_shaper_limits_tunnel_throughput(proxy_port, monkeypatch):
+    monkeypatch.setattr(TrafficShaper, 'MIN_BURST', 0)
+    monkeypatch.setattr(Tunnel, 'shaper', TrafficShaper(tunnel_rate=100000))
+
+    data = b'SSH-2.0-test\r\n' + b'x' * 350000
+    started_at = time.monotonic()
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        threading.Thread(target=conn.sendall, args=(data,), daemon=True).start()
+        assert recv_exactly(conn, len(data)) == data
+
+    assert time.monotonic() - started_at >= 1
+
+
+def test_usage_recorder_flushes_per_user_totals(limiter, v2ray_proxy_port, monkeypatch):
+    wait_for(lambda: not any(tunnel.identity for tunnel in Tunnel.active()))
+
+    usage = UsageRecorder(limiter.database)
+    assert not usage.has_table()
+
+    engine = create_engine('sqlite:///' + limiter.database)
+    with engine.begin() as connection:
+        importlib.import_module('app.data.migrations.0003_usage').upgrade(connection)
+    engine.dispose()
+
+    assert usage.has_table()
+    monkeypatch.setattr(Tunnel, 'usage', usage)
+
+    request = b'\x00' + USER_UUID.bytes + b'\x00\x01'
+
+    for _ in range(2):
+        with socket.create_connection(('127.0.0.1', v2ray_proxy_port), 5) as conn:
+            conn.sendall(request)
+            assert recv_exactly(conn, len(request)) == request
+
+        wait_for(lambda: len(limiter) == 0)
+        assert usage.flush() == 1
+
+    conn = sqlite3.connect(limiter.database)
+    rows = conn.execute('SELECT username, upload, download FROM usage').fetchall()
+    conn.close()
+
+    assert rows == [('alice', 2 * len(request), 2 * len(request))]
+
+
+def client_frame(data: bytes, opcode: int = WebSocketCodec.OP_BINARY) -> bytes:
+    key = os.urandom(4)
+    frame = bytearray(WebSocketCodec.encode(WebSocketCodec.mask(data, key), opcode))
+    frame[1] |= 0x80
+    header = len(frame) - len(data)
+    return bytes(frame[:header] + key + frame[header:])
+
+
+def test_websocket_codec_unmasks_split_frames():
+    data = os.urandom(70000)
+    frames = client_frame(b'abc') + client_frame(data) + client_frame(b'hi', WebSocketCodec.OP_PING)
+
+    codec = WebSocketCodec()
+    payload, replies = codec.decode(frames[:5])
+    assert (payload, replies) == (b'', b'')
+
+    payload, replies = codec.decode(frames[5:])
+    assert payload == b'abc' + data
+    assert replies == WebSocketCodec.encode(b'hi', WebSocketCodec.OP_PONG)
+
+
+def test_websocket_codec_answers_close_once():
+    codec = WebSocketCodec()
+    close = client_frame(b'\x03\xe8bye', WebSocketCodec.OP_CLOSE)
+
+    _, replies = codec.decode(close + close)
+    assert replies == WebSocketCodec.encode(b'\x03\xe8', WebSocketCodec.OP_CLOSE)
+    assert codec.closed
+
+
+def test_websocket_codec_rejects_oversized_frame():
+    header = bytes((0x82, 0xFF)) + (WebSocketCodec.MAX_FRAME_SIZE + 1).to_bytes(8, 'big')
+
+    with pytest.raises(ValueError):
+        WebSocketCodec().decode(header)
+
+
+def test_proxy_completes_websocket_handshake(proxy_port, protocols):
+    protocols.websocket_frames = True
+    key = base64.b64encode(os.urandom(16))
+
+    request = (
+        b'GET /ssh HTTP/1.1\r\nHost: cdn.example.com\r\nUpgrade: websocket\r\n'
+        b'Connection: Upgrade\r\nSec-WebSocket-Key: ' + key + b'\r\n'
+        b'Sec-WebSocket-Version: 13\r\n\r\n'
+    )
+    accept = base64.b64encode(hashlib.sha1(key + WebSocketCodec.GUID).digest())
+
+    with socket.create_connection(('127.0.0.1', proxy_port), 5) as conn:
+        conn.sendall(request + client_frame(b'SSH-2.0-test\r\n'))
+
+        response = b''
+        while not response.endswith(b'\r\n\r\n'):
+            response += conn.recv(1)
+
+        assert response.startswith(b'HTTP/1.1 101 Switching Protocols\r\n')
+        assert b'Sec-WebSocket-Accept: ' + accept + b'\r\n' in response
+
+        frame = WebSocketCodec.encode(b'SSH-2.0-test\r\n')
+        assert recv_exactly(conn, len(frame)) == frame
+
+        conn.sendall(client_frame(b'', WebSocketCodec.OP_PING))
+        pong = WebSocketCodec.encode(b'', WebSocketCodec.OP_PONG)
+        assert recv_exactly(conn, len(pong)) == pong
+
+
+def test_control_socket_passes_listener(tmp_path):
+    control = ControlSocket(str(tmp_path / 'control.sock'))
+    control.bind()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    control.command('takeover', lambda request: {'fds': [listener.fileno()]})
+    control.start()
+
+    with ControlClient(control.path) as client:
+        response, fds = client.call('takeover')
+        assert response == {'fds': 1}
+
+        inherited = socket.fromfd(fds[0], socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fds[0])
+        assert inherited.getsockname() == listener.getsockname()
+        inherited.close()
+
+        response, fds = client.call('unknown')
+        assert 'error' in response and not fds
+
+    control.close()
+    listener.close()
+    assert not os.path.exists(control.path)
+
+
+def test_control_socket_serves_clients_concurrently(tmp_path):
+    control = ControlSocket(str(tmp_path / 'control.sock'))
+    control.bind()
+    control.command('status', lambda request: {'ok': True})
+    control.start()
+
+    try:
+        with ControlClient(control.path) as idle:
+            assert idle.call('status')[0] == {'ok': True}
+
+            with ControlClient(control.path, 2) as client:
+                assert client.call('status')[0] == {'ok': True}
+    finally:
+        control.close()
+
+
+def test_takeover_keeps_tunnels_and_listener(tmp_path, echo_backend):
+    port = free_port()
+    command = [
+        sys.executable,
+        SOCKS_PATH,
+        '--host', '127.0.0.1',
+        '--port', str(port),
+        '--ssh-port', str(echo_backend[1]),
+        '--control-socket', str(tmp_path / 'control.sock'),
+        '--log', 'WARNING',
+        '--http',
+    ]
+
+    old = subprocess.Popen(command)
+    new = None
+
+    try:
+        wait_port(port)
+
+        with socket.create_connection(('127.0.0.1', port), 5) as tunnel:
+            tunnel.sendall(b'SSH-2.0-old\r\n')
+            assert recv_exactly(tunnel, 13) == b'SSH-2.0-old\r\n'
+
+            inode = os.stat(str(tmp_path / 'control.sock')).st_ino
+            new = subprocess.Popen(command + ['--takeover'])
+
+            def replaced():
+                try:
+                    return os.stat(str(tmp_path / 'control.sock')).st_ino != inode
+                except FileNotFoundError:
+                    return False
+
+            wait_for(replaced)
+
+            with socket.create_connection(('127.0.0.1', port), 5) as conn:
+                conn.sendall(b'SSH-2.0-new\r\n')
+                assert recv_exactly(conn, 13) == b'SSH-2.0-new\r\n'
+
+            tunnel.sendall(b'ping')
+            assert recv_exactly(tunnel, 4) == b'ping'
+            assert old.poll() is None
+
+        assert old.wait(10) == 0
+        assert new.poll() is None
+    finally:
+        for process in (old, new):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+def test_takeover_with_workers_survives_worker_respawn(tmp_path, echo_backend):
+    port = free_port()
+    command = [
+        sys.executable,
+        SOCKS_PATH,
+        '--host', '127.0.0.1',
+        '--port', str(port),
+        '--ssh-port', str(echo_backend[1]),
+        '--control-socket', str(tmp_path / 'control.sock'),
+        '--workers', '2',
+        '--log', 'WARNING',
+        '--http',
+    ]
+
+    def children(process: subprocess.Popen) -> set:
+        with open('/proc/%s/task/%s/children' % (process.pid, process.pid)) as f:
+            return set(int(pid) for pid in f.read().split())
+
+    old = subprocess.Popen(command)
+    new = None
+
+    try:
+        wait_port(port)
+        wait_for(lambda: os.path.exists(str(tmp_path / 'control.sock.0')))
+
+        new = subprocess.Popen(command + ['--takeover'])
+        assert old.wait(10) == 0
+
+        wait_for(lambda: len(children(new)) == 2)
+        killed = children(new)
+        for pid in killed:
+            os.kill(pid, signal.SIGKILL)
+
+        wait_for(lambda: len(children(new) - killed) == 2)
+        workers = children(new)
+        time.sleep(WorkerPool.RESPAWN_DELAY * 2)
+        assert children(new) == workers
+
+        with socket.create_connection(('127.0.0.1', port), 5) as conn:
+            conn.sendall(b'SSH-2.0-new\r\n')
+            assert recv_exactly(conn, 13) == b'SSH-2.0-new\r\n'
+    finally:
+        for process in (old, new):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+def test_control_status_and_set_backend(tmp_path, echo_backend):
+    port = free_port()
+    path = str(tmp_path / 'control.sock')
+    proxy = subprocess.Popen(
+        [
+            sys.executable,
+            SOCKS_PATH,
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--ssh-port', '1',
+            '--control-socket', path,
+            '--log', 'WARNING',
+            '--http',
+        ]
+    )
+
+    try:
+        wait_port(port)
+        wait_for(lambda: os.path.exists(path))
+
+        with ControlClient(path) as client:
+            response, _ = client.call('set-backend', backend='ssh', port=echo_backend[1])
+            assert response['address'] == ['127.0.0.1', echo_backend[1]]
+
+            response, _ = client.call('set-backend', backend='nope', port=1)
+            assert 'error' in response
+
+        with socket.create_connection(('127.0.0.1', port), 5) as tunnel:
+            tunnel.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(tunnel, 14) == b'SSH-2.0-test\r\n'
+
+            with ControlClient(path) as client:
+                status, _ = client.call('status')
+
+        assert status['listeners'] == [{'port': port, 'mode': 'http'}]
+        assert status['accepting'] is True
+        assert status['backends']['ssh'] == ['127.0.0.1', echo_backend[1]]
+        assert status['tunnels'] == 1
+
+        with ControlClient(path) as client:
+            assert client.call('drain')[0] == {'ok': True}
+
+        assert proxy.wait(10) == 0
+    finally:
+        if proxy.poll() is None:
+            proxy.terminate()
+            proxy.wait()
+
+
+def test_signal_watcher_runs_handlers_outside_the_signal_frame():
+    lock = threading.Lock()
+    threads = []
+    handled = threading.Event()
+
+    def handler():
+        with lock:
+            threads.append(threading.current_thread().name)
+        handled.set()
+
+    previous = signal.getsignal(signal.SIGUSR1)
+    watcher = SignalWatcher()
+    watcher.register(signal.SIGUSR1, handler)
+    watcher.start()
+
+    try:
+        with lock:
+            for _ in range(50):
+                os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.1)
+
+        assert handled.wait(5)
+        assert threads and set(threads) == {'signals'}
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+        watcher.close()
+
+
+def test_signal_burst_keeps_proxy_serving(echo_backend):
+    port = free_port()
+    proxy = subprocess.Popen(
+        [
+            sys.executable,
+            SOCKS_PATH,
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--ssh-port', str(echo_backend[1]),
+            '--engine', 'epoll',
+            '--cert', CERT_PATH,
+            '--log', 'WARNING',
+            '--https',
+        ]
+    )
+
+    def echo() -> None:
+        with client_context().wrap_socket(socket.create_connection(('127.0.0.1', port), 5)) as conn:
+            conn.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(conn, 14) == b'SSH-2.0-test\r\n'
+
+    try:
+        wait_port(port)
+
+        stop = threading.Event()
+        errors = []
+
+        def traffic():
+            while not stop.is_set():
+                try:
+                    echo()
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        thread = threading.Thread(target=traffic, daemon=True)
+        thread.start()
+
+        for _ in range(300):
+            proxy.send_signal(signal.SIGUSR1)
+            time.sleep(0.002)
+
+        stop.set()
+        thread.join(10)
+
+        assert not thread.is_alive()
+        assert not errors
+        assert proxy.poll() is None
+        echo()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sigusr2_drains_proxy(workers, echo_backend):
+    port = free_port()
+    proxy = subprocess.Popen(
+        [
+            sys.executable,
+            SOCKS_PATH,
+            '--host', '127.0.0.1',
+            '--port', str(port),
+            '--ssh-port', str(echo_backend[1]),
+            '--engine', 'epoll',
+            '--workers', str(workers),
+            '--log', 'WARNING',
+            '--http',
+        ]
+    )
+
+    def refused() -> bool:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+        except ConnectionRefusedError:
+            return True
+        return False
+
+    try:
+        wait_port(port)
+
+        with socket.create_connection(('127.0.0.1', port), 5) as tunnel:
+            tunnel.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(tunnel, 14) == b'SSH-2.0-test\r\n'
+
+            proxy.send_signal(signal.SIGUSR2)
+            wait_for(refused)
+
+            tunnel.sendall(b'ping')
+            assert recv_exactly(tunnel, 4) == b'ping'
+            assert proxy.poll() is None
+
+        assert proxy.wait(10) == 0
+    finally:
+        if proxy.poll() is None:
+            proxy.terminate()
+            proxy.wait()
+
+
+def test_parse_listeners():
+    assert parse_listeners('80/http, 8080, 443/HTTPS') == [
+        (80, 'http'),
+        (8080, 'http'),
+        (443, 'https'),
+    ]
+
+    for value in ('', '80/ftp', '0/http', '80 80/https'):
+        with pytest.raises(ValueError):
+            parse_listeners(value)
+
+
+@pytest.mark.parametrize('engine', ['thread', 'epoll'])
+def test_listeners_share_one_loop(engine, protocols, monkeypatch):
+    monkeypatch.setattr(TCP, 'drain_timeout', 1)
+
+    loop = EventLoop() if engine == 'epoll' else None
+    http_port, https_port = free_port(), free_port()
+    server = Listeners(
+        [
+            HTTP(('127.0.0.1', http_port), loop=loop, protocols=protocols),
+            HTTPS(('127.0.0.1', https_port), CERT_PATH, loop=loop, protocols=protocols),
+        ],
+        loop,
+    )
+
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    wait_port(http_port)
+    wait_port(https_port)
+
+    with socket.create_connection(('127.0.0.1', http_port), 5) as conn:
+        conn.sendall(b'SSH-2.0-http\r\n')
+        assert recv_exactly(conn, 14) == b'SSH-2.0-http\r\n'
+
+    conn = socket.create_connection(('127.0.0.1', https_port), 5)
+    with client_context().wrap_socket(conn) as conn:
+        conn.sendall(b'SSH-2.0-https\r\n')
+        assert recv_exactly(conn, 15) == b'SSH-2.0-https\r\n'
+
+    server.stop_accepting()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert not server.accepting
+
+
+def make_record(msg: str, *args) -> logging.LogRecord:
+    return logging.LogRecord('socks', logging.INFO, __file__, 1, msg, args, None)
+
+
+def test_log_sampler_limits_each_message():
+    sampler = LogSampler(10, 3)
+
+    kept = [sampler.filter(make_record('%s -> enviado %s bytes', 'a', n)) for n in range(10)]
+    assert kept == [True] * 3 + [False] * 7
+    assert sampler.filter(make_record('%s conectado', 'a'))
+
+    time.sleep(0.2)
+    record = make_record('%s -> enviado %s bytes', 'a', 0)
+    assert sampler.filter(record)
+    assert record.suppressed == 7
+
+
+def test_log_queue_handler_writes_json_lines():
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter())
+
+    handler = LogQueueHandler(target, 100)
+    handler.start()
+    handler.handle(make_record('%s conectado', '127.0.0.1:1234'))
+    handler.close()
+
+    entry = json.loads(stream.getvalue())
+    assert entry['level'] == 'info'
+    assert entry['event'] == '%s conectado'
+    assert entry['message'] == '127.0.0.1:1234 conectado'
+
+
+def test_log_queue_handler_drops_when_full():
+    def dropped() -> float:
+        match = re.search(r'^socks_log_dropped_total (\S+)$', socks.metrics.render(), re.M)
+        return float(match.group(1)) if match else 0
+
+    handler = LogQueueHandler(logging.NullHandler(), 2)
+    before = dropped()
+
+    for n in range(5):
+        handler.handle(make_record('%s', n))
+
+    assert handler.queue.qsize() == 2
+    assert dropped() - before == 3
+
+
+def test_proxy_header_round_trip():
+    for source, destination in (
+        (('203.0.113.7', 51000), ('198.51.100.1', 443)),
+        (('2001:db8::7', 51000), ('2001:db8::1', 80)),
+    ):
+        for version in (1, 2):
+            data = ProxyHeader(source, destination).encode(version)
+            header = ProxyHeader.parse(data)
+
+            assert (header.source, header.destination, header.version) == (
+                source,
+                destination,
+                version,
+            )
+
+    assert ProxyHeader(('203.0.113.7', 1)).encode(1) == b'PROXY UNKNOWN\r\n'
+    assert ProxyHeader.parse(b'PROXY UNKNOWN\r\n').source is None
+    assert ProxyHeader.parse(ProxyHeader.V2_SIGNATURE + b'\x20\x00\x00\x00').source is None
+
+    for data in (
+        b'PROXY TCP4 999.0.0.1 127.0.0.1 1 2\r\n',
+        b'PROXY TCP4 127.0.0.1 127.0.0.1 1\r\n',
+        b'PROXY TCP9 127.0.0.1 127.0.0.1 1 2\r\n',
+        ProxyHeader.V2_SIGNATURE + b'\x13\x00\x00\x00',
+        b'GET / HTTP/1.1\r\n',
+    ):
+        with pytest.raises(ValueError):
+            ProxyHeader.parse(data)
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_proxy_header_reader_leaves_payload(version):
+    data = ProxyHeader(('203.0.113.7', 51000), ('198.51.100.1', 80)).encode(version)
+    left, right = socket.socketpair()
+    right.setblocking(False)
+    reader = ProxyHeaderReader()
+
+    with left, right:
+        chunks = [data[pos : pos + 7] for pos in range(0, len(data), 7)]
+
+        for chunk in chunks[:-1]:
+            left.sendall(chunk)
+            assert reader.read(right) is None
+
+        left.sendall(chunks[-1] + b'SSH-2.0-test\r\n')
+        header = reader.read(right)
+
+        assert header.source == ('203.0.113.7', 51000)
+        assert right.recv(100) == b'SSH-2.0-test\r\n'
+
+    with pytest.raises(ValueError):
+        left, right = socket.socketpair()
+        with left, right:
+            left.sendall(b'SSH-2.0-test\r\nxx')
+            ProxyHeaderReader().read(right)
+
+
+@pytest.mark.parametrize('engine', ['thread', 'epoll'])
+def test_proxy_header_times_out_on_slow_client(engine, protocols, monkeypatch):
+    def timeouts() -> float:
+        match = re.search(
+            r'^socks_proxy_headers_total\{result="timeout",version=""\} (\S+)$',
+            socks.metrics.render(),
+            re.M,
+        )
+        return float(match.group(1)) if match else 0
+
+    monkeypatch.setattr(TCP, 'proxy_protocol', True)
+    monkeypatch.setattr(TCP, 'proxy_timeout', 0.3)
+
+    port = free_port()
+    loop = EventLoop() if engine == 'epoll' else None
+    server = HTTP(('127.0.0.1', port), 128, loop, protocols=protocols)
+
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_port(port)
+
+    before = timeouts()
+
+    try:
+        with socket.create_connection(('127.0.0.1', port), 5) as conn:
+            conn.sendall(b'PROXY TCP4 203.0.113.7 ')
+            deadline = time.monotonic() + 3
+            closed = False
+
+            while not closed and time.monotonic() < deadline:
+                try:
+                    conn.sendall(b'1')
+                except OSError:
+                    closed = True
+                    break
+
+                r, _, _ = select.select([conn], [], [], 0.1)
+                if r:
+                    try:
+                        closed = conn.recv(100) == b''
+                    except OSError:
+                        closed = True
+
+            assert closed
+            assert time.monotonic() < deadline - 1.5
+            assert timeouts() == before + 1
+    finally:
+        if loop is not None:
+            loop.stop()
+
+
+@pytest.mark.parametrize('engine', ['thread', 'epoll'])
+@pytest.mark.parametrize('tls', [False, True])
+def test_proxy_protocol_ingress_and_egress(engine, tls, protocols, monkeypatch):
+    monkeypatch.setattr(TCP, 'proxy_protocol', True)
+    protocols.add_proxy_protocol('ssh', 1)
+
+    port = free_port()
+    loop = EventLoop() if engine == 'epoll' else None
+
+    if tls:
+        server = HTTPS(('127.0.0.1', port), CERT_PATH, 128, loop, protocols=protocols)
+    else:
+        server = HTTP(('127.0.0.1', port), 128, loop, protocols=protocols)
+
+    threading.Thread(target=server.run, daemon=True).start()
+    wait_port(port)
+
+    header = ProxyHeader(('203.0.113.7', 51000), ('198.51.100.1', 443))
+    expected = header.encode(1) + b'SSH-2.0-test\r\n'
+
+    try:
+        conn = socket.create_connection(('127.0.0.1', port), 5)
+        conn.sendall(header.encode(2))
+
+        if tls:
+            conn = client_context().wrap_socket(conn)
+
+        with conn:
+            conn.sendall(b'SSH-2.0-test\r\n')
+            assert recv_exactly(conn, len(expected)) == expected
+
+            assert any(
+                tunnel.client.addr == ('203.0.113.7', 51000) for tunnel in Tunnel.active()
+            )
+    finally:
+        if loop is not None:
+            loop.stop()
@@ -0,0 +1,55 @@
+import shlex
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from app.modules.console import socks_console
+from app.modules.console.socks_console import FlagUtils, SocksManager
+
+
+def free_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@pytest.fixture
+def processes(tmp_path, monkeypatch):
+    control = str(tmp_path / 'socks-%s.sock')
+    processes = []
+
+    def system(command: str) -> int:
+        args = shlex.split(command)[3:]
+        args[0] = sys.executable
+        port = args[args.index('--port') + 1]
+
+        processes.append(
+            subprocess.Popen(
+                args + ['--host', '127.0.0.1', '--control-socket', control % port, '--log', 'ERROR']
+            )
+        )
+        return 0
+
+    monkeypatch.setattr(socks_console, 'CONTROL_SOCKET', control)
+    monkeypatch.setattr(socks_console.os, 'system', system)
+
+    yield processes
+
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def test_start_waits_for_the_control_socket(processes):
+    port = free_port()
+
+    assert SocksManager().start('http', port, FlagUtils())
+    assert SocksManager.get_running_socks() == {port: 'http'}
+
+
+def test_wait_started_times_out_without_a_proxy(processes):
+    assert not SocksManager.wait_started(free_port(), 0, timeout=0.3)
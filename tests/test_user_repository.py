@@ -1,11 +1,16 @@
 import datetime
+import sqlite3
 
-from app.__main__ import create_all
+from sqlalchemy import event
+
+from app.data.config import DBConnection, migrate
+from app.data.config.db_config import DATABASE_URI
 
 from app.data.repositories import UserRepository
+from app.domain.dtos import UserDtoFilter
 from app.domain.entities import User
 
-create_all()
+migrate()
 
 
 def test_user_repository_create_user():
@@ -67,3 +72,140 @@ def test_user_repository_get_user_by_username():
     assert user_got.expiration_date == user.expiration_date
 
     user_repository.delete(user_created.id)
+
+
+def test_user_repository_create_many_reports_conflicts():
+    user_repository = UserRepository()
+    users = [
+        User(
+            username='bulk%d' % index,
+            password='test',
+            connection_limit=1,
+            expiration_date=datetime.datetime.now() + datetime.timedelta(days=30),
+        )
+        for index in range(3)
+    ]
+    duplicate = User(
+        username='bulk1',
+        password='test',
+        connection_limit=1,
+        expiration_date=datetime.datetime.now() + datetime.timedelta(days=30),
+    )
+
+    result = user_repository.create_many(users + [duplicate])
+
+    assert [user.username for user in result.succeeded] == ['bulk0', 'bulk1', 'bulk2']
+    assert all(user.id is not None for user in result.succeeded)
+    assert [user for user, _ in result.failed] == [duplicate]
+
+    user_repository.delete_many([user.id for user in result.succeeded])
+
+
+def test_user_repository_update_and_delete_many():
+    user_repository = UserRepository()
+    users = user_repository.create_many(
+        [
+            User(
+                username='bulk%d' % index,
+                password='test',
+                connection_limit=1,
+                expiration_date=datetime.datetime.now() + datetime.timedelta(days=30),
+            )
+            for index in range(2)
+        ]
+    ).succeeded
+    ids = [user.id for user in users]
+
+    result = user_repository.update_many(
+        [
+            User(id=ids[0], password='changed'),
+            User(id=ids[1], username='bulk0'),
+            User(id=-1, password='missing'),
+        ]
+    )
+
+    assert [(user.id, user.password) for user in result.succeeded] == [(ids[0], 'changed')]
+    assert [user.id for user, _ in result.failed] == [-1, ids[1]]
+    assert user_repository.get_by_id(ids[1]).username == 'bulk1'
+    assert user_repository.get_by_id(ids[1]).password == 'test'
+
+    result = user_repository.delete_many(ids + [-1])
+
+    assert sorted(user.id for user in result.succeeded) == sorted(ids)
+    assert result.failed == [(-1, 'User not found')]
+    assert user_repository.get_by_id(ids[0]) is None
+
+
+def test_user_repository_pages_and_filters():
+    user_repository = UserRepository()
+    now = datetime.datetime.now()
+    users = user_repository.create_many(
+        [
+            User(
+                username='page%d' % index,
+                password='test',
+                connection_limit=1,
+                expiration_date=now + datetime.timedelta(days=days),
+            )
+            for index, days in enumerate([-1, 2, 5, 30, 60])
+        ]
+    ).succeeded
+    ids = [user.id for user in users]
+    prefix = UserDtoFilter(username_prefix='page')
+
+    first = user_repository.get_page(prefix, limit=2, columns=('username',))
+    second = user_repository.get_page(prefix, after_id=first[-1].id, limit=2)
+
+    assert [row.username for row in first] == ['page0', 'page1']
+    assert first[0]._fields == ('id', 'username')
+    assert [row.username for row in second] == ['page2', 'page3']
+    assert [row.id for row in user_repository.iter_all(prefix, page_size=2)] == ids
+
+    def usernames(**kwargs) -> list:
+        user_filter = UserDtoFilter(username_prefix='page', **kwargs)
+        return [row.username for row in user_repository.iter_all(user_filter)]
+
+    assert usernames(expired=True) == ['page0']
+    assert usernames(expired=False) == ['page1', 'page2', 'page3', 'page4']
+    assert usernames(expiring_in_days=7) == ['page1', 'page2']
+    assert usernames(ids=ids[3:]) == ['page3', 'page4']
+    assert usernames(ids=[]) == []
+    assert user_repository.count(UserDtoFilter(username_prefix='page_')) == 0
+    assert user_repository.count(prefix) == 5
+
+    user_repository.delete_many(ids)
+
+
+def test_user_repository_filters_more_ids_than_sqlite_variables():
+    user_repository = UserRepository()
+    users = user_repository.create_many(
+        [
+            User(
+                username='many%d' % index,
+                password='test',
+                connection_limit=1,
+                expiration_date=datetime.datetime.now() + datetime.timedelta(days=30),
+            )
+            for index in range(1200)
+        ]
+    ).succeeded
+    ids = [user.id for user in users]
+
+    DBConnection.dispose(DATABASE_URI)
+    event.listen(
+        DBConnection().engine,
+        'connect',
+        lambda connection, record: connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999),
+    )
+
+    try:
+        user_filter = UserDtoFilter(ids=ids + [-1])
+
+        assert user_repository.count(user_filter) == 1200
+        assert [row.id for row in user_repository.iter_all(user_filter, ('id',))] == ids
+
+        page = user_repository.get_page(user_filter, after_id=ids[550], limit=100)
+        assert [row.id for row in page] == ids[551:651]
+    finally:
+        DBConnection.dispose(DATABASE_URI)
+        user_repository.delete_many(ids)
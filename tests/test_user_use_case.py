@@ -0,0 +1,89 @@
+import datetime
+import subprocess
+
+import pytest
+
+from app.data.config import migrate
+from app.data.repositories import UserRepository
+from app.domain.dtos import UserDto, UserDtoFilter
+from app.domain.entities import User
+from app.domain.use_cases import UserUseCase, user_use_case
+
+migrate()
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    calls = []
+
+    def exec_with_input(command, data):
+        calls.append((command, data))
+        stdout = stderr = ''
+
+        if command == ['bash', '-s'] and 'useradd' in data:
+            stdout = 'bulk1\n'
+        elif command == ['chpasswd']:
+            stderr = 'chpasswd: (line 2, user bulk2) password not changed\n'
+
+        return subprocess.CompletedProcess(command, 0, stdout, stderr)
+
+    monkeypatch.setattr(user_use_case, 'exec_with_input', exec_with_input)
+    yield calls
+
+
+def test_create_many_feeds_system_commands_once(commands):
+    use_case = UserUseCase(UserRepository())
+    result = use_case.create_many(
+        [
+            UserDto(
+                username='bulk%d' % index,
+                password='test',
+                connection_limit=1,
+                expiration_date=(datetime.date.today() + datetime.timedelta(days=30)).strftime(
+                    '%d/%m/%Y'
+                ),
+            )
+            for index in range(3)
+        ]
+        + [UserDto(username='bulk3', password='test', connection_limit=1, expiration_date='?')]
+    )
+
+    assert [user.username for user in result.succeeded] == ['bulk0']
+    assert sorted(user.username for user, _ in result.failed) == ['bulk1', 'bulk2', 'bulk3']
+
+    useradd, chpasswd, userdel = commands
+    assert useradd[1].count('useradd') == 3
+    assert chpasswd == (['chpasswd'], 'bulk0:test\nbulk2:test\n')
+    assert 'userdel --force bulk2' in userdel[1]
+
+    assert UserRepository.get_by_username('bulk1') is None
+    assert UserRepository.get_by_username('bulk2') is None
+
+    use_case.delete_many([result.succeeded[0].id])
+    assert UserRepository.get_by_username('bulk0') is None
+
+
+def test_get_page_returns_projected_dtos_and_cursor():
+    use_case = UserUseCase(UserRepository())
+    users = UserRepository.create_many(
+        [
+            User(
+                username='cursor%d' % index,
+                password='test',
+                connection_limit=1,
+                expiration_date=datetime.datetime.now(),
+            )
+            for index in range(3)
+        ]
+    ).succeeded
+    user_filter = UserDtoFilter(username_prefix='cursor')
+
+    page, next_id = use_case.get_page(user_filter, limit=2, columns=('username',))
+    assert [user.username for user in page] == ['cursor0', 'cursor1']
+    assert page[0].password is None
+
+    page, next_id = use_case.get_page(user_filter, after_id=next_id, limit=2)
+    assert [user.username for user in page] == ['cursor2']
+    assert next_id is None
+
+    UserRepository.delete_many([user.id for user in users])